@@ -1,15 +1,9 @@
 import streamlit as st
-import yaml
-from yaml.loader import SafeLoader
-import streamlit_authenticator as stauth
-from database import Database
-from auth_handler import AuthHandler
-from payment_handler import PaymentHandler
-from email_handler import EmailHandler
+from services import get_database, get_payment_handler, get_email_handler
 from navigation import add_navigation  # ← MAKE SURE THIS LINE EXISTS
-import importlib.util
-import sys
-import os
+from entitlements import grant, current_entitlement, premium_expiry
+from renewal_scheduler import start_renewal_scheduler
+from email_outbox import start_outbox_worker
 
 # Page configuration
 st.set_page_config(
@@ -19,20 +13,15 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize database and handlers
-@st.cache_resource
-def init_app():
-    db = Database()
-    auth_handler = AuthHandler(db)
-    payment_handler = PaymentHandler()
-    email_handler = EmailHandler()
-    return db, auth_handler, payment_handler, email_handler
+# Shared, lazily built services - Stripe and Mailjet clients are only
+# built on the code paths that use them
+db = get_database()
 
-db, auth_handler, payment_handler, email_handler = init_app()
-
-# ✅ AUTOMATIC DAILY RENEWAL CHECK
-# This runs once per day when anyone visits the site
-db.auto_check_all_renewals()
+# ✅ AUTOMATIC RENEWAL CHECK
+# Sweeps run on a background thread (one replica at a time), never in the page render
+start_renewal_scheduler(db)
+# Delivers mail left queued (or backing off) by a previous process, not just new sends
+start_outbox_worker(db)
 
 # Add shared navigation to sidebar
 add_navigation()
@@ -62,117 +51,77 @@ if reset_token:
 # ✅ FIXED: Payment success handling with session state management
 if query_params.get("upgrade") == "success" and query_params.get("session_id"):
     session_id = query_params.get("session_id")
-    
-    # ✅ Check if this payment has already been processed
+
+    # This browser session already showed the result - skip even the database check
     payment_processed_key = f"payment_processed_{session_id}"
-    
+
     if not st.session_state.get(payment_processed_key, False):
-        # Mark as processed immediately to prevent duplicates
-        st.session_state[payment_processed_key] = True
-        
-        # Show big success message at the top
-        st.success("🎉 **PAYMENT SUCCESSFUL!** Welcome to Kaspa Analytics Premium!")
-        st.balloons()
-        
-        # Try to get username from Stripe session metadata
-        try:
-            import stripe
-            stripe.api_key = payment_handler.stripe_secret_key
-            stripe_session = stripe.checkout.Session.retrieve(session_id)
-            username_from_stripe = stripe_session.metadata.get('username')
-            
-            if username_from_stripe:
-                # ✅ Get current user data to check for existing premium
-                current_user = db.get_user(username_from_stripe)
-                
-                # Upgrade the user in database
-                payment_result = payment_handler.handle_successful_payment(session_id, username_from_stripe)
-                if payment_result.get('success'):
-                    expires_at = payment_result.get('expires_at')
-                    subscription_id = payment_result.get('subscription_id')
-                    
-                    # ✅ FIXED: Reset cancellation status for resubscriptions
-                    # If user was previously cancelled, reset their subscription status
-                    if current_user and current_user.get('stripe_subscription_id') == 'CANCELLED':
-                        st.write("Debug: Reactivating cancelled subscription...")
-                    
-                    db.update_premium_status(username_from_stripe, True, expires_at, subscription_id)
-                    
-                    # ✅ FIXED: Update session state with new database values
-                    # Get fresh user data after database update
-                    updated_user = db.get_user(username_from_stripe)
-                    if updated_user:
-                        # Auto-login the user if they're not logged in
-                        if not st.session_state.get('authentication_status'):
-                            st.session_state['authentication_status'] = True
-                            st.session_state['username'] = username_from_stripe
-                            st.session_state['name'] = updated_user['name']
-                        
-                        # ✅ Update session state with FRESH database values
-                        st.session_state['is_premium'] = updated_user['is_premium']
-                        st.session_state['premium_expires_at'] = updated_user['premium_expires_at']
-                        
-                        st.write(f"Debug: Session state updated - expires at: {updated_user['premium_expires_at']}")
-                    else:
-                        # Fallback to payment result values
-                        st.session_state['is_premium'] = True
-                        st.session_state['premium_expires_at'] = expires_at
-                    
-                    # ✅ Send premium subscription email ONLY ONCE with correct plan type
-                    email_sent_key = f"email_sent_{session_id}"
-                    if not st.session_state.get(email_sent_key, False):
-                        try:
-                            user = db.get_user(username_from_stripe)
-                            if user:
-                                # ✅ FIXED: Determine plan type based on amount from payment result
-                                amount = payment_result.get('amount', 0)
-                                if amount >= 9900:  # $99 or more = Annual
-                                    plan_type = "Annual Premium"
-                                elif amount >= 999:  # $9.99 or more = Monthly
-                                    plan_type = "Monthly Premium"
-                                else:
-                                    # Fallback to session state
-                                    plan = st.session_state.get('selected_plan', {'interval': 'month'})
-                                    plan_type = "Annual Premium" if plan['interval'] == 'year' else "Monthly Premium"
-                                
-                                st.write(f"Debug: Sending {plan_type} email (amount: ${amount/100:.2f})")
-                                email_handler.send_premium_subscription_email(user['email'], user['name'], plan_type)
-                                st.session_state[email_sent_key] = True
-                                st.info("📧 Premium welcome email sent to your inbox!")
-                        except Exception as e:
-                            st.write(f"Debug: Could not send premium email: {e}")
-                    
-                    # Show premium access confirmation
-                    st.info("✅ **Your account has been upgraded to Premium!** You now have access to all advanced analytics features.")
-                    
-                    # Add button to explore premium features
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        if st.button("🔬 Explore Premium Analytics", use_container_width=True):
-                            st.switch_page("pages/8_👑_Premium_Analytics.py")
-                    with col2:
-                        if st.button("📊 View Advanced Metrics", use_container_width=True):
-                            st.switch_page("pages/9_👑_Advanced_Metrics.py")
-                    with col3:
-                        if st.button("🏠 Continue to Home", use_container_width=True):
-                            st.query_params.clear()
-                            st.rerun()
-                    
-                else:
-                    st.error("Payment verification failed. Please contact support.")
+        # ✅ Applied once across all sessions and replicas (processed_checkouts): the first
+        # view fetches the checkout from Stripe, upgrades the user and queues the email;
+        # refreshes, other tabs and other replicas read the stored result
+        checkout = get_payment_handler().process_checkout(db, session_id, get_email_handler())
+
+        if checkout['status'] == 'done':
+            st.session_state[payment_processed_key] = True
+            username_from_stripe = checkout['username']
+
+            # Show big success message at the top
+            st.success("🎉 **PAYMENT SUCCESSFUL!** Welcome to Kaspa Analytics Premium!")
+            st.balloons()
+
+            # ✅ Re-issue the entitlement token from FRESH database values
+            updated_user = db.load_session_profile(username_from_stripe)
+            if updated_user:
+                # Auto-login the user if they're not logged in
+                if not st.session_state.get('authentication_status'):
+                    st.session_state['authentication_status'] = True
+                    st.session_state['username'] = username_from_stripe
+                    st.session_state['name'] = updated_user['name']
+
+                grant(username_from_stripe, updated_user)
             else:
-                st.error("Could not identify user from payment. Please contact support.")
-                
-        except Exception as e:
-            st.error(f"Error processing upgrade: {str(e)}")
-    
+                # Fallback to the stored checkout result
+                grant(username_from_stripe, {
+                    'is_premium': True,
+                    'premium_expires_at': checkout['expires_at']
+                })
+
+            st.info(f"📧 Your {checkout['plan_type']} welcome email has been queued and will arrive shortly.")
+
+            # Show premium access confirmation
+            st.info("✅ **Your account has been upgraded to Premium!** You now have access to all advanced analytics features.")
+
+            # Add button to explore premium features
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                if st.button("🔬 Explore Premium Analytics", use_container_width=True):
+                    st.switch_page("pages/8_👑_Premium_Analytics.py")
+            with col2:
+                if st.button("📊 View Advanced Metrics", use_container_width=True):
+                    st.switch_page("pages/9_👑_Advanced_Metrics.py")
+            with col3:
+                if st.button("🏠 Continue to Home", use_container_width=True):
+                    st.query_params.clear()
+                    st.rerun()
+
+        elif checkout['status'] == 'processing':
+            # Another tab or replica is applying it right now
+            st.info("⏳ Confirming your payment... this only takes a moment.")
+            if st.button("🔄 Refresh", use_container_width=True):
+                st.rerun()
+
+        else:
+            st.error("Payment verification failed. Please contact support.")
+            if st.button("🔄 Try Again", use_container_width=True):
+                st.rerun()
+
     else:
         # Payment already processed - show simple confirmation
         st.success("✅ **Payment Confirmed** - Your premium access is active!")
         if st.button("🏠 Continue to Home", use_container_width=True):
             st.query_params.clear()
             st.rerun()
-    
+
     # Clear URL parameters button
     if st.button("Close Success Message"):
         st.query_params.clear()
@@ -230,15 +179,12 @@ with col2:
         welcome_msg = f"Welcome, {st.session_state['name']}!"
         if st.session_state.get('is_premium'):
             welcome_msg += " 👑 PREMIUM"
-            if st.session_state.get('premium_expires_at'):
+            expires = premium_expiry(current_entitlement())
+            if expires:
                 from datetime import datetime
-                try:
-                    expires = datetime.fromisoformat(st.session_state['premium_expires_at'].replace('Z', '+00:00'))
-                    days_left = (expires - datetime.now()).days
-                    if days_left > 0:
-                        welcome_msg += f" ({days_left} days left)"
-                except:
-                    pass
+                days_left = (expires - datetime.now()).days
+                if days_left > 0:
+                    welcome_msg += f" ({days_left} days left)"
         st.write(welcome_msg)
         
         if st.button("👤 Account", key="header_account"):
@@ -251,16 +197,26 @@ with col2:
 st.title("⚡ Welcome to Kaspa Analytics")
 st.write("Your comprehensive platform for Kaspa blockchain analytics and insights.")
 
-# Quick stats cards
+# Quick stats cards - newest stored point and its change over 24h (written by metrics_ingest.py)
+from metrics_store import get_metric_store, format_delta, format_value, DAY
+
+metric_store = get_metric_store()
+
+
+def quick_stat(label, metric, fmt):
+    value, change = metric_store.change(metric, DAY)
+    st.metric(label, format_value(value, fmt), format_delta(change))
+
+
 col1, col2, col3, col4 = st.columns(4)
 with col1:
-    st.metric("Current Price", "$0.125", "+2.4%")
+    quick_stat("Current Price", 'price', lambda v: f"${v:.3f}")
 with col2:
-    st.metric("Market Cap", "$3.1B", "+1.8%")
+    quick_stat("Market Cap", 'market_cap', lambda v: f"${v / 1e9:.1f}B")
 with col3:
-    st.metric("24h Volume", "$45M", "-5.2%")
+    quick_stat("24h Volume", 'volume_24h', lambda v: f"${v / 1e6:.0f}M")
 with col4:
-    st.metric("Hashrate", "1.2 EH/s", "+0.8%")
+    quick_stat("Hashrate", 'hashrate', lambda v: f"{v / 1e18:.1f} EH/s")
 
 # Navigation sections
 st.subheader("📊 Analytics Sections")
@@ -310,7 +266,7 @@ elif not st.session_state.get('is_premium', False):
         st.write("• Cancel anytime")
         if st.button("Subscribe Monthly", key="home_monthly", use_container_width=True):
             st.session_state['selected_plan'] = {'amount': 999, 'interval': 'month'}
-            payment_url = payment_handler.create_checkout_session(st.session_state['username'])
+            payment_url = get_payment_handler().create_checkout_session(st.session_state['username'])
             if payment_url:
                 st.markdown(f"[💳 Complete Payment]({payment_url})")
                 
@@ -321,7 +277,7 @@ elif not st.session_state.get('is_premium', False):
         st.write("• 2 months free")
         if st.button("Subscribe Annually", key="home_annual", use_container_width=True):
             st.session_state['selected_plan'] = {'amount': 9900, 'interval': 'year'}
-            payment_url = payment_handler.create_checkout_session(st.session_state['username'])
+            payment_url = get_payment_handler().create_checkout_session(st.session_state['username'])
             if payment_url:
                 st.markdown(f"[💳 Complete Payment]({payment_url})")
 else:
@@ -1,16 +1,39 @@
-import bcrypt
 from database import Database
+from password_hasher import get_hasher
+from rate_limiter import LoginThrottle
 
 class AuthHandler:
-    def __init__(self, database):
+    def __init__(self, database, hasher=None, throttle=None):
         self.db = database
-    
+        self.hasher = hasher or get_hasher()
+        self.throttle = throttle or LoginThrottle(database)
+
+    def _check_password(self, username, password, hashed):
+        """Verify on the hashing pool; upgrade the stored hash if its cost is out of date.
+        Raises HasherBusy when the pool is saturated."""
+        if not self.hasher.verify(password, hashed):
+            return False
+        if self.hasher.needs_rehash(hashed):
+            self.hasher.rehash_in_background(
+                password, lambda new_hash: self.db.update_password_hash(username, hashed, new_hash))
+        return True
+
     def authenticate(self, username, password):
         """Authenticate user with username and password"""
         user = self.db.get_user(username)
-        if user and bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
-            return True
-        return False
+        return bool(user) and self._check_password(username, password, user['password'])
+
+    def login(self, username, password, client=None, limit_user=True):
+        """Verify credentials and return the session profile (one DB round trip).
+        Returns None when the username or password is wrong; raises RateLimited
+        (before any hashing) when throttled and HasherBusy under overload."""
+        self.throttle.check(username if limit_user else None, client)
+        profile = self.db.load_session_profile(username)
+        if profile and self._check_password(username, password, profile['password']):
+            profile = dict(profile)
+            del profile['password']
+            return profile
+        return None
     
     def is_premium_user(self, username):
         """Check if user has premium access"""
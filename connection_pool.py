@@ -0,0 +1,241 @@
+import threading
+import time
+import sqlite3
+import weakref
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+
+class PostgresPool:
+    """Thread-safe pool of long-lived PostgreSQL connections.
+
+    Connections are health-checked when they have been idle for a while and
+    recycled once they pass ``max_lifetime`` seconds, so a dropped Supabase
+    connection never reaches a caller.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, max_lifetime=1800,
+                 idle_check_after=30, acquire_timeout=10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.idle_check_after = idle_check_after
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = []  # (conn, created_at, last_used_at)
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0,
+                       'created': 0, 'recycled': 0, 'failed_health_checks': 0}
+
+        # Warm the pool; if the server is unreachable, connect on demand later
+        try:
+            for _ in range(min_size):
+                self._idle.append(self._connect())
+                self._open += 1
+        except Exception:
+            pass
+
+    def _connect(self):
+        # Imported on first use so SQLite-only processes never load psycopg2
+        import psycopg2
+        conn = psycopg2.connect(self.dsn)
+        now = time.monotonic()
+        with self._cond:
+            self._stats['created'] += 1
+        return conn, now, now
+
+    def _discard(self, conn):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, entry):
+        conn, created_at, last_used_at = entry
+        now = time.monotonic()
+        if conn.closed or now - created_at > self.max_lifetime:
+            with self._cond:
+                self._stats['recycled'] += 1
+            return False
+        if now - last_used_at > self.idle_check_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except Exception:
+                with self._cond:
+                    self._stats['failed_health_checks'] += 1
+                return False
+        return True
+
+    def acquire(self):
+        """Check out a connection, waiting up to ``acquire_timeout`` seconds"""
+        deadline = time.monotonic() + self.acquire_timeout
+        waited = False
+        with self._cond:
+            self._stats['checkouts'] += 1
+
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.max_size:
+                    if not waited:
+                        self._stats['waits'] += 1
+                        waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    # Reserve the slot, then connect outside the lock
+                    entry = None
+                    self._open += 1
+
+            if entry is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+
+            # Health checks also run outside the lock
+            if self._is_healthy(entry):
+                return entry
+            self._discard(entry[0])
+
+    def release(self, entry, broken=False):
+        """Return a connection to the pool (or drop it if it is broken)"""
+        conn, created_at, _ = entry
+        if not broken and not conn.closed:
+            try:
+                # Never hand out a connection with an open transaction
+                conn.rollback()
+                with self._cond:
+                    self._idle.append((conn, created_at, time.monotonic()))
+                    self._cond.notify()
+                return
+            except Exception:
+                pass
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        import psycopg2
+        entry = self.acquire()
+        broken = False
+        try:
+            yield entry[0]
+        except psycopg2.InterfaceError:
+            broken = True
+            raise
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            self.release(entry, broken)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, open_connections=self._open,
+                        idle_connections=len(self._idle),
+                        in_use=self._open - len(self._idle),
+                        max_size=self.max_size)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+class _SQLiteConnection(sqlite3.Connection):
+    """sqlite3.Connection that supports weak references"""
+
+
+class SQLiteConnections:
+    """One persistent SQLite connection per thread.
+
+    Streamlit runs every session's script in its own thread, so each thread
+    keeps its own connection open instead of reconnecting on every query.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._stats = {'checkouts': 0, 'waits': 0, 'created': 0}
+
+    def _get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, factory=_SQLiteConnection)
+            self._local.conn = conn
+            # The connection closes when its thread exits and the
+            # thread-local is dropped; keep the open count honest then too
+            self._local.finalizer = weakref.finalize(conn, self._closed)
+            with self._lock:
+                self._open += 1
+                self._stats['created'] += 1
+        return conn
+
+    def _closed(self):
+        with self._lock:
+            self._open -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self._get()
+        with self._lock:
+            self._stats['checkouts'] += 1
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        finally:
+            self._local.depth = depth
+            # Leave no transaction open once the outermost checkout ends
+            if depth == 0 and conn.in_transaction:
+                conn.rollback()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, open_connections=self._open)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            self._local.finalizer()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_url, min_size=1, max_size=10):
+    """Return the process-wide pool for ``database_url``, creating it once"""
+    with _pools_lock:
+        pool = _pools.get(database_url)
+        if pool is None:
+            if database_url.startswith('postgresql://'):
+                pool = PostgresPool(database_url, min_size=min_size, max_size=max_size)
+            else:
+                path = database_url[len('sqlite:///'):] if database_url.startswith('sqlite:///') else 'kaspa_users.db'
+                pool = SQLiteConnections(path or 'kaspa_users.db')
+            _pools[database_url] = pool
+        return pool
@@ -1,10 +1,48 @@
-import psycopg2
-import bcrypt
 import os
 import streamlit as st
 from urllib.parse import urlparse
 import secrets
+import hashlib
+import logging
+import time
 from datetime import datetime, timedelta
+from connection_pool import get_pool
+from user_cache import UserCache
+from password_hasher import get_hasher
+from migrations import apply_migrations, is_current
+
+logger = logging.getLogger(__name__)
+
+# Shared by every Database instance in the process so a write through one
+# instance invalidates what the others would read
+user_cache = UserCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('USER_CACHE_TTL', '60'))
+)
+
+# bcrypt hash of the demo password "demo123", precomputed so seeding the
+# demo users doesn't cost a cost-12 hash on startup
+DEMO_PASSWORD_HASH = '$2b$12$x1SCbkF7ns9svi2KU7.Gh.pfsz59qkJ.XEW7.hUiKN0zb2St5MWfC'
+
+# Password reset tokens: lifetime and how many may be live per user at once
+RESET_TOKEN_TTL_SECONDS = int(os.getenv('RESET_TOKEN_TTL_SECONDS', '3600'))
+RESET_TOKENS_PER_USER = int(os.getenv('RESET_TOKENS_PER_USER', '3'))
+
+
+def hash_token(token):
+    """SHA-256 hex digest under which a reset token is stored"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def parse_timestamp(value):
+    """Parse a stored timestamp (datetime or ISO string) into a naive local datetime"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
 
 class Database:
     def __init__(self):
@@ -17,6 +55,14 @@ class Database:
             except:
                 self.database_url = os.getenv('DATABASE_URL', 'sqlite:///kaspa_users.db')
         
+        # Connections are pooled per process and shared by every Database instance
+        self.pool = get_pool(
+            self.database_url,
+            min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+            max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+        )
+        self.user_cache = user_cache
+        
         # Check if using PostgreSQL (Supabase) or fallback to SQLite
         if self.database_url.startswith('postgresql://'):
             self.use_postgres = True
@@ -26,84 +72,73 @@ class Database:
             self.init_sqlite_database()
     
     def get_connection(self):
-        """Get database connection"""
-        if self.use_postgres:
-            return psycopg2.connect(self.database_url)
-        else:
-            import sqlite3
-            return sqlite3.connect('kaspa_users.db')
+        """Check out a pooled database connection.
+        
+        Use as a context manager - the connection goes back to the pool
+        (with any uncommitted work rolled back) when the block exits.
+        """
+        return self.pool.connection()
+    
+    def pool_stats(self):
+        """Connection pool counters (checkouts, waits, open connections)"""
+        return self.pool.stats()
+    
+    def cache_stats(self):
+        """User cache counters (hits, misses, size)"""
+        return self.user_cache.stats()
     
     def init_postgres_database(self):
-        """Initialize PostgreSQL database with users table"""
+        """Initialize PostgreSQL database: apply schema migrations, create demo users.
+        Costs a single query when the schema is already up to date."""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Create users table with all columns
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) UNIQUE NOT NULL,
-                email VARCHAR(100) UNIQUE NOT NULL,
-                password VARCHAR(255) NOT NULL,
-                name VARCHAR(100) NOT NULL,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_expires_at TIMESTAMP NULL,
-                stripe_customer_id VARCHAR(100),
-                stripe_subscription_id VARCHAR(100),
-                reset_token VARCHAR(100) NULL,
-                reset_token_expires TIMESTAMP NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            conn.commit()
-            
-            # Create demo users
-            self.create_demo_users_postgres(cursor)
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                if is_current(conn):
+                    return
+                
+                apply_migrations(conn, use_postgres=True)
+                
+                # Create demo users
+                cursor = conn.cursor()
+                self.create_demo_users_postgres(cursor)
+                conn.commit()
             
         except Exception as e:
-            try:
-                conn.close()
-            except:
-                pass
+            logger.warning("Database initialisation failed: %s", e)
     
     def init_sqlite_database(self):
-        """Initialize SQLite database (fallback)"""
+        """Initialize SQLite database (fallback): apply schema migrations, create demo users.
+        Costs a single query when the schema is already up to date."""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                name TEXT NOT NULL,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_expires_at TIMESTAMP NULL,
-                stripe_customer_id TEXT,
-                stripe_subscription_id TEXT,
-                reset_token TEXT NULL,
-                reset_token_expires TIMESTAMP NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            self.create_demo_users_sqlite(cursor)
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                if is_current(conn):
+                    return
+                
+                apply_migrations(conn, use_postgres=False)
+                
+                cursor = conn.cursor()
+                self.create_demo_users_sqlite(cursor)
+                conn.commit()
             
         except Exception as e:
-            pass
+            logger.warning("Database initialisation failed: %s", e)
+    
+    def _ts(self, value):
+        """
+        Timestamp parameter for the current backend. Postgres takes datetimes
+        and ISO strings natively; SQLite stores 'YYYY-MM-DD HH:MM:SS' text so
+        comparisons and index range scans sort correctly.
+        """
+        if self.use_postgres or value is None:
+            return value
+        try:
+            return parse_timestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return value
     
     def create_demo_users_postgres(self, cursor):
         """Create demo users for PostgreSQL"""
         try:
-            demo_password = bcrypt.hashpw("demo123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            demo_password = DEMO_PASSWORD_HASH
             
             # Check existing users
             cursor.execute('SELECT username FROM users WHERE username IN (%s, %s)', ('demo_user', 'premium_user'))
@@ -127,7 +162,7 @@ class Database:
     def create_demo_users_sqlite(self, cursor):
         """Create demo users for SQLite"""
         try:
-            demo_password = bcrypt.hashpw("demo123".encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            demo_password = DEMO_PASSWORD_HASH
             
             users = [
                 ("demo_user", "demo@kaspa.com", demo_password, "Demo User", False),
@@ -146,45 +181,50 @@ class Database:
     def add_user(self, username, email, password, name):
         """Add a new user to the database"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            
-            if self.use_postgres:
-                cursor.execute('''
-                INSERT INTO users (username, email, password, name, is_premium)
-                VALUES (%s, %s, %s, %s, %s)
-                ''', (username, email, hashed_password, name, False))
-            else:
-                cursor.execute('''
-                INSERT INTO users (username, email, password, name, is_premium)
-                VALUES (?, ?, ?, ?, ?)
-                ''', (username, email, hashed_password, name, False))
+            # Hash before checking out a connection so it isn't held during bcrypt
+            hashed_password = get_hasher().hash(password)
             
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                    INSERT INTO users (username, email, password, name, is_premium)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ''', (username, email, hashed_password, name, False))
+                else:
+                    cursor.execute('''
+                    INSERT INTO users (username, email, password, name, is_premium)
+                    VALUES (?, ?, ?, ?, ?)
+                    ''', (username, email, hashed_password, name, False))
+                
+                conn.commit()
+            self.user_cache.invalidate(username=username)
+            self.user_cache.invalidate(email=email)
             return True
             
         except Exception as e:
             return False
     
     def get_user(self, username):
-        """Get user by username"""
+        """Get user by username (served from the user cache when fresh)"""
+        cached = self.user_cache.get(username)
+        if cached is not None:
+            return cached
+        
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('SELECT * FROM users WHERE username = %s', (username,))
-            else:
-                cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-            
-            user = cursor.fetchone()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('SELECT * FROM users WHERE username = %s', (username,))
+                else:
+                    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+                
+                user = cursor.fetchone()
             
             if user:
-                return {
+                user = {
                     'id': user[0],
                     'username': user[1],
                     'email': user[2],
@@ -198,27 +238,32 @@ class Database:
                     'reset_token_expires': user[10] if len(user) > 10 else None,
                     'subscription_cancelled': bool(user[11]) if len(user) > 11 else False
                 }
+                self.user_cache.put(user)
+                return dict(user)
             return None
                 
         except Exception as e:
             return None
     
     def get_user_by_email(self, email):
-        """Get user by email address"""
+        """Get user by email address (served from the user cache when fresh)"""
+        cached = self.user_cache.get_by_email(email)
+        if cached is not None:
+            return cached
+        
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('SELECT * FROM users WHERE email = %s', (email,))
-            else:
-                cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-            
-            user = cursor.fetchone()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('SELECT * FROM users WHERE email = %s', (email,))
+                else:
+                    cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
+                
+                user = cursor.fetchone()
             
             if user:
-                return {
+                user = {
                     'id': user[0],
                     'username': user[1],
                     'email': user[2],
@@ -231,59 +276,80 @@ class Database:
                     'reset_token': user[9] if len(user) > 9 else None,
                     'reset_token_expires': user[10] if len(user) > 10 else None
                 }
+                self.user_cache.put(user)
+                return dict(user)
             return None
                 
         except Exception as e:
             return None
     
     def create_reset_token(self, email):
-        """Create a password reset token for user"""
+        """
+        Create a password reset token for the user with this email. Only the
+        token's SHA-256 is stored. Returns None if the email is unknown or the
+        user already has RESET_TOKENS_PER_USER live tokens.
+        """
         try:
             token = secrets.token_urlsafe(32)
-            expires_at = datetime.now() + timedelta(hours=1)
-            
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('''
-                    UPDATE users 
-                    SET reset_token = %s, reset_token_expires = %s 
-                    WHERE email = %s
-                ''', (token, expires_at, email))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET reset_token = ?, reset_token_expires = ? 
-                    WHERE email = ?
-                ''', (token, expires_at, email))
+            now = time.time()
+            expires_at = now + RESET_TOKEN_TTL_SECONDS
             
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # One statement: the per-user limit can't be raced past by parallel requests
+                if self.use_postgres:
+                    cursor.execute('''
+                        INSERT INTO password_reset_tokens (token_hash, username, created_at, expires_at)
+                        SELECT %s, username, %s, %s FROM users
+                        WHERE email = %s AND (
+                            SELECT COUNT(*) FROM password_reset_tokens t
+                            WHERE t.username = users.username AND t.expires_at > %s
+                        ) < %s
+                    ''', (hash_token(token), now, expires_at, email, now, RESET_TOKENS_PER_USER))
+                else:
+                    cursor.execute('''
+                        INSERT INTO password_reset_tokens (token_hash, username, created_at, expires_at)
+                        SELECT ?, username, ?, ? FROM users
+                        WHERE email = ? AND (
+                            SELECT COUNT(*) FROM password_reset_tokens t
+                            WHERE t.username = users.username AND t.expires_at > ?
+                        ) < ?
+                    ''', (hash_token(token), now, expires_at, email, now, RESET_TOKENS_PER_USER))
+                
+                created = cursor.rowcount == 1
+                conn.commit()
+            if not created:
+                logger.info("No reset token created for %s (unknown email or per-user limit)", email)
+                return None
             return token
             
         except Exception as e:
             return None
     
     def verify_reset_token(self, token):
-        """Verify reset token and return user if valid"""
+        """Verify reset token and return user if valid (one primary-key lookup on the token hash)"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('''
-                    SELECT * FROM users 
-                    WHERE reset_token = %s AND reset_token_expires > %s
-                ''', (token, datetime.now()))
-            else:
-                cursor.execute('''
-                    SELECT * FROM users 
-                    WHERE reset_token = ? AND reset_token_expires > ?
-                ''', (token, datetime.now()))
-            
-            user = cursor.fetchone()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        SELECT u.id, u.username, u.email, u.password, u.name, u.is_premium,
+                               u.premium_expires_at, u.stripe_customer_id, u.stripe_subscription_id, t.expires_at
+                        FROM password_reset_tokens t JOIN users u ON u.username = t.username
+                        WHERE t.token_hash = %s AND t.expires_at > %s
+                    ''', (hash_token(token), time.time()))
+                else:
+                    cursor.execute('''
+                        SELECT u.id, u.username, u.email, u.password, u.name, u.is_premium,
+                               u.premium_expires_at, u.stripe_customer_id, u.stripe_subscription_id, t.expires_at
+                        FROM password_reset_tokens t JOIN users u ON u.username = t.username
+                        WHERE t.token_hash = ? AND t.expires_at > ?
+                    ''', (hash_token(token), time.time()))
+                
+                user = cursor.fetchone()
+                conn.rollback()
             
             if user:
                 return {
@@ -295,7 +361,8 @@ class Database:
                     'is_premium': bool(user[5]),
                     'premium_expires_at': user[6],
                     'stripe_customer_id': user[7],
-                    'stripe_subscription_id': user[8]
+                    'stripe_subscription_id': user[8],
+                    'reset_token_expires': datetime.fromtimestamp(user[9])
                 }
             return None
                 
@@ -303,37 +370,112 @@ class Database:
             return None
     
     def reset_password(self, token, new_password):
-        """Reset password using valid token"""
+        """Reset password using valid token. The token is single-use; every other
+        outstanding token and every remember-me session of the user is revoked with it."""
         try:
             user = self.verify_reset_token(token)
             if not user:
                 return False
             
-            hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('''
-                    UPDATE users 
-                    SET password = %s, reset_token = NULL, reset_token_expires = NULL 
-                    WHERE reset_token = %s
-                ''', (hashed_password, token))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET password = ?, reset_token = NULL, reset_token_expires = NULL 
-                    WHERE reset_token = ?
-                ''', (hashed_password, token))
+            hashed_password = get_hasher().hash(new_password)
             
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Consuming the token decides the race between two submits of the same link
+                if self.use_postgres:
+                    cursor.execute('''
+                        DELETE FROM password_reset_tokens WHERE token_hash = %s AND expires_at > %s
+                    ''', (hash_token(token), time.time()))
+                    if cursor.rowcount != 1:
+                        conn.rollback()
+                        return False
+                    cursor.execute('UPDATE users SET password = %s WHERE username = %s',
+                                   (hashed_password, user['username']))
+                    cursor.execute('DELETE FROM password_reset_tokens WHERE username = %s', (user['username'],))
+                    # Remember-me cookies issued before the reset stop working with it
+                    cursor.execute('DELETE FROM user_sessions WHERE username = %s', (user['username'],))
+                else:
+                    cursor.execute('''
+                        DELETE FROM password_reset_tokens WHERE token_hash = ? AND expires_at > ?
+                    ''', (hash_token(token), time.time()))
+                    if cursor.rowcount != 1:
+                        conn.rollback()
+                        return False
+                    cursor.execute('UPDATE users SET password = ? WHERE username = ?',
+                                   (hashed_password, user['username']))
+                    cursor.execute('DELETE FROM password_reset_tokens WHERE username = ?', (user['username'],))
+                    # Remember-me cookies issued before the reset stop working with it
+                    cursor.execute('DELETE FROM user_sessions WHERE username = ?', (user['username'],))
+                
+                conn.commit()
+            self.user_cache.invalidate(username=user['username'])
             return True
             
         except Exception as e:
             return False
     
+    def purge_expired_reset_tokens(self, batch_size=1000):
+        """
+        Delete expired reset tokens in batches of ``batch_size`` rows, each
+        in its own short transaction so the purge never holds long locks.
+        Returns the number of rows deleted.
+        """
+        purged = 0
+        try:
+            now = time.time()
+            while True:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    
+                    if self.use_postgres:
+                        cursor.execute('''
+                            DELETE FROM password_reset_tokens WHERE token_hash IN (
+                                SELECT token_hash FROM password_reset_tokens
+                                WHERE expires_at < %s LIMIT %s
+                            )
+                        ''', (now, batch_size))
+                    else:
+                        cursor.execute('''
+                            DELETE FROM password_reset_tokens WHERE token_hash IN (
+                                SELECT token_hash FROM password_reset_tokens
+                                WHERE expires_at < ? LIMIT ?
+                            )
+                        ''', (now, batch_size))
+                    
+                    deleted = cursor.rowcount
+                    conn.commit()
+                purged += deleted
+                if deleted < batch_size:
+                    return purged
+                
+        except Exception as e:
+            logger.warning("Could not purge expired reset tokens: %s", e)
+            return purged
+    
+    def update_password_hash(self, username, old_hash, new_hash):
+        """Replace a password hash (cost upgrade on login). Only applies if the
+        stored hash is still ``old_hash``, so it never undoes a concurrent reset."""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    cursor.execute('UPDATE users SET password = %s WHERE username = %s AND password = %s',
+                                   (new_hash, username, old_hash))
+                else:
+                    cursor.execute('UPDATE users SET password = ? WHERE username = ? AND password = ?',
+                                   (new_hash, username, old_hash))
+                updated = cursor.rowcount > 0
+
+                conn.commit()
+            self.user_cache.invalidate(username=username)
+            return updated
+
+        except Exception as e:
+            logger.warning("Could not update password hash for %s: %s", username, e)
+            return False
+
     def cancel_premium_subscription(self, username):
         """Cancel user's premium subscription (mark for end of current period)"""
         try:
@@ -350,25 +492,25 @@ class Database:
                 return False, "Subscription is already cancelled"
             
             # Simple approach - mark subscription as cancelled by setting stripe_subscription_id to 'CANCELLED'
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('''
-                    UPDATE users 
-                    SET stripe_subscription_id = 'CANCELLED'
-                    WHERE username = %s AND stripe_subscription_id IS NOT NULL AND stripe_subscription_id != 'CANCELLED'
-                ''', (username,))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET stripe_subscription_id = 'CANCELLED'
-                    WHERE username = ? AND stripe_subscription_id IS NOT NULL AND stripe_subscription_id != 'CANCELLED'
-                ''', (username,))
-            
-            rows_affected = cursor.rowcount
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        UPDATE users 
+                        SET stripe_subscription_id = 'CANCELLED'
+                        WHERE username = %s AND stripe_subscription_id IS NOT NULL AND stripe_subscription_id != 'CANCELLED'
+                    ''', (username,))
+                else:
+                    cursor.execute('''
+                        UPDATE users 
+                        SET stripe_subscription_id = 'CANCELLED'
+                        WHERE username = ? AND stripe_subscription_id IS NOT NULL AND stripe_subscription_id != 'CANCELLED'
+                    ''', (username,))
+                
+                rows_affected = cursor.rowcount
+                conn.commit()
+            self.user_cache.invalidate(username=username)
             
             if rows_affected > 0:
                 # Calculate days remaining
@@ -455,25 +597,25 @@ class Database:
             else:
                 final_expires_at = expires_at
             
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = %s, premium_expires_at = %s, stripe_subscription_id = %s 
-                    WHERE username = %s
-                ''', (is_premium, final_expires_at, subscription_id, username))
-            else:
-                cursor.execute('''
-                    UPDATE users 
-                    SET is_premium = ?, premium_expires_at = ?, stripe_subscription_id = ? 
-                    WHERE username = ?
-                ''', (is_premium, final_expires_at, subscription_id, username))
-            
-            rows_affected = cursor.rowcount
-            conn.commit()
-            conn.close()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        UPDATE users 
+                        SET is_premium = %s, premium_expires_at = %s, stripe_subscription_id = %s 
+                        WHERE username = %s
+                    ''', (is_premium, final_expires_at, subscription_id, username))
+                else:
+                    cursor.execute('''
+                        UPDATE users 
+                        SET is_premium = ?, premium_expires_at = ?, stripe_subscription_id = ? 
+                        WHERE username = ?
+                    ''', (is_premium, self._ts(final_expires_at), subscription_id, username))
+                
+                rows_affected = cursor.rowcount
+                conn.commit()
+            self.user_cache.invalidate(username=username)
             return rows_affected > 0
                 
         except Exception as e:
@@ -483,19 +625,11 @@ class Database:
     def check_premium_expiration(self, username):
         """Check if user's premium subscription has expired"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            if self.use_postgres:
-                cursor.execute('SELECT premium_expires_at, is_premium FROM users WHERE username = %s', (username,))
-            else:
-                cursor.execute('SELECT premium_expires_at, is_premium FROM users WHERE username = ?', (username,))
-            
-            result = cursor.fetchone()
-            conn.close()
+            # Read through the user cache - usually no round trip at all
+            user = self.get_user(username)
             
-            if result and result[1]:  # is_premium is True
-                expires_at = result[0]
+            if user and user['is_premium']:
+                expires_at = user['premium_expires_at']
                 if expires_at:
                     try:
                         if isinstance(expires_at, str):
@@ -517,29 +651,572 @@ class Database:
         except Exception as e:
             return False, "Error"
 
-    # AUTOMATIC SUBSCRIPTION RENEWAL SYSTEM
+    def load_session_profile(self, username):
+        """
+        Load everything a login needs in one round trip:
+        the password hash plus a compact profile with a parsed expiry.
+        Expired premium users with nothing left to renew are downgraded
+        in the same statement; users with a live Stripe subscription are
+        reported as not premium but left for the renewal sweep.
+        """
+        try:
+            now = datetime.now()
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    cursor.execute('''
+                        WITH expired AS (
+                            UPDATE users
+                            SET is_premium = FALSE
+                            WHERE username = %s
+                            AND is_premium = TRUE
+                            AND premium_expires_at < %s
+                            AND (stripe_subscription_id IS NULL OR stripe_subscription_id = 'CANCELLED')
+                            RETURNING id
+                        )
+                        SELECT username, email, password, name, is_premium, premium_expires_at,
+                               EXISTS (SELECT 1 FROM expired) AS downgraded
+                        FROM users
+                        WHERE username = %s
+                    ''', (username, now, username))
+                    row = cursor.fetchone()
+                    conn.commit()
+                else:
+                    # SQLite is in-process, so a second statement costs no round trip
+                    cursor.execute('''
+                        SELECT username, email, password, name, is_premium, premium_expires_at,
+                               stripe_subscription_id
+                        FROM users
+                        WHERE username = ?
+                    ''', (username,))
+                    row = cursor.fetchone()
+                    if row:
+                        expiry = parse_timestamp(row[5])
+                        downgraded = (bool(row[4]) and expiry is not None and expiry < now
+                                      and row[6] in (None, 'CANCELLED'))
+                        if downgraded:
+                            cursor.execute('UPDATE users SET is_premium = 0 WHERE username = ?', (username,))
+                            conn.commit()
+                        row = row[:6] + (downgraded,)
+
+            if not row:
+                return None
+
+            if row[6]:
+                self.user_cache.invalidate(username=username)
+
+            expires_at = parse_timestamp(row[5])
+            is_premium = bool(row[4]) and not row[6] and (expires_at is None or expires_at > now)
+
+            return {
+                'username': row[0],
+                'email': row[1],
+                'password': row[2],
+                'name': row[3],
+                'is_premium': is_premium,
+                'premium_expires_at': expires_at
+            }
+
+        except Exception as e:
+            return None
+
+    # BACKGROUND JOB COORDINATION
     
-    def auto_check_all_renewals(self):
+    def claim_due_job(self, job_name, owner, interval_seconds, lease_seconds):
         """
-        Automatically check ALL users for renewals
-        This runs automatically when the app starts
+        Atomically claim a job if it is due and nobody else holds its lease.
+        The lease lives in the database, so only one process (replica)
+        runs the job at a time. Returns True if this owner got the job.
         """
         try:
-            # Only run this check once per day per app session
-            current_date = datetime.now().strftime('%Y-%m-%d')
+            now = time.time()
             
-            if st.session_state.get('last_renewal_check') == current_date:
-                return  # Already checked today
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        INSERT INTO job_runs (job_name) VALUES (%s)
+                        ON CONFLICT (job_name) DO NOTHING
+                    ''', (job_name,))
+                    cursor.execute('''
+                        UPDATE job_runs 
+                        SET locked_by = %s, locked_until = %s 
+                        WHERE job_name = %s 
+                        AND (locked_until IS NULL OR locked_until < %s) 
+                        AND (last_run_at IS NULL OR last_run_at <= %s)
+                    ''', (owner, now + lease_seconds, job_name, now, now - interval_seconds))
+                else:
+                    cursor.execute('INSERT OR IGNORE INTO job_runs (job_name) VALUES (?)', (job_name,))
+                    cursor.execute('''
+                        UPDATE job_runs 
+                        SET locked_by = ?, locked_until = ? 
+                        WHERE job_name = ? 
+                        AND (locked_until IS NULL OR locked_until < ?) 
+                        AND (last_run_at IS NULL OR last_run_at <= ?)
+                    ''', (owner, now + lease_seconds, job_name, now, now - interval_seconds))
+                
+                claimed = cursor.rowcount == 1
+                conn.commit()
+            return claimed
             
-            st.write("🔄 Running daily subscription renewal check...")
+        except Exception as e:
+            logger.warning("Could not claim job %s: %s", job_name, e)
+            return False
+    
+    def complete_job(self, job_name, owner, result=None):
+        """Record a finished run and release the job's lease"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        UPDATE job_runs 
+                        SET last_run_at = %s, last_result = %s, locked_by = NULL, locked_until = NULL 
+                        WHERE job_name = %s AND locked_by = %s
+                    ''', (time.time(), result, job_name, owner))
+                else:
+                    cursor.execute('''
+                        UPDATE job_runs 
+                        SET last_run_at = ?, last_result = ?, locked_by = NULL, locked_until = NULL 
+                        WHERE job_name = ? AND locked_by = ?
+                    ''', (time.time(), result, job_name, owner))
+                
+                conn.commit()
+            
+        except Exception as e:
+            logger.warning("Could not record run of job %s: %s", job_name, e)
+    
+    def get_job_status(self, job_name):
+        """Last run time (epoch seconds), last result and current lease holder of a job"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('SELECT last_run_at, last_result, locked_by, locked_until FROM job_runs WHERE job_name = %s', (job_name,))
+                else:
+                    cursor.execute('SELECT last_run_at, last_result, locked_by, locked_until FROM job_runs WHERE job_name = ?', (job_name,))
+                
+                row = cursor.fetchone()
             
-            conn = self.get_connection()
+            if row:
+                return {'last_run_at': row[0], 'last_result': row[1], 'locked_by': row[2], 'locked_until': row[3]}
+            return None
+            
+        except Exception as e:
+            return None
+    
+    # LOGIN THROTTLING
+    
+    def consume_throttle_token(self, bucket_key, rate, burst):
+        """
+        Take one token from a shared login_throttle bucket, refilling it at
+        ``rate`` tokens/second up to ``burst``. Returns False when the bucket
+        is empty. Fails open: the in-process buckets still apply.
+        """
+        try:
+            now = time.time()
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    cursor.execute('''
+                        INSERT INTO login_throttle (bucket_key, tokens, updated_at) VALUES (%s, %s, %s)
+                        ON CONFLICT (bucket_key) DO NOTHING
+                    ''', (bucket_key, burst, now))
+                    cursor.execute('''
+                        UPDATE login_throttle
+                        SET tokens = LEAST(%s, tokens + (%s - updated_at) * %s) - 1, updated_at = %s
+                        WHERE bucket_key = %s AND LEAST(%s, tokens + (%s - updated_at) * %s) >= 1
+                    ''', (burst, now, rate, now, bucket_key, burst, now, rate))
+                else:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO login_throttle (bucket_key, tokens, updated_at) VALUES (?, ?, ?)
+                    ''', (bucket_key, burst, now))
+                    cursor.execute('''
+                        UPDATE login_throttle
+                        SET tokens = MIN(?, tokens + (? - updated_at) * ?) - 1, updated_at = ?
+                        WHERE bucket_key = ? AND MIN(?, tokens + (? - updated_at) * ?) >= 1
+                    ''', (burst, now, rate, now, bucket_key, burst, now, rate))
+
+                allowed = cursor.rowcount == 1
+                conn.commit()
+            return allowed
+
+        except Exception as e:
+            logger.warning("Could not check shared login throttle: %s", e)
+            return True
+
+    def purge_throttle_buckets(self, idle_before):
+        """Delete login_throttle buckets untouched since ``idle_before`` (epoch seconds)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute('DELETE FROM login_throttle WHERE updated_at < %s', (idle_before,))
+                else:
+                    cursor.execute('DELETE FROM login_throttle WHERE updated_at < ?', (idle_before,))
+                purged = cursor.rowcount
+                conn.commit()
+            return purged
+        except Exception as e:
+            logger.warning("Could not purge login throttle buckets: %s", e)
+            return 0
+
+    # REMEMBER-ME SESSIONS
+    
+    def create_user_session(self, id_hash, username, expires_at):
+        """Store a remember-me session under the sha256 of its id"""
+        try:
+            now = time.time()
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    cursor.execute('''
+                        INSERT INTO user_sessions (id_hash, username, created_at, last_seen_at, expires_at)
+                        VALUES (%s, %s, %s, %s, %s)
+                    ''', (id_hash, username, now, now, expires_at))
+                else:
+                    cursor.execute('''
+                        INSERT INTO user_sessions (id_hash, username, created_at, last_seen_at, expires_at)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (id_hash, username, now, now, expires_at))
+
+                conn.commit()
+            return True
+
+        except Exception as e:
+            logger.warning("Could not create session for %s: %s", username, e)
+            return False
+
+    def resume_user_session(self, id_hash):
+        """
+        One primary-key lookup joined to the user row: returns the compact
+        session profile for a live session, or None if unknown or expired.
+        """
+        try:
+            now = time.time()
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    cursor.execute('''
+                        SELECT u.username, u.name, u.is_premium, u.premium_expires_at
+                        FROM user_sessions s JOIN users u ON u.username = s.username
+                        WHERE s.id_hash = %s AND s.expires_at > %s
+                    ''', (id_hash, now))
+                else:
+                    cursor.execute('''
+                        SELECT u.username, u.name, u.is_premium, u.premium_expires_at
+                        FROM user_sessions s JOIN users u ON u.username = s.username
+                        WHERE s.id_hash = ? AND s.expires_at > ?
+                    ''', (id_hash, now))
+
+                row = cursor.fetchone()
+                conn.rollback()
+
+            if not row:
+                return None
+            expires_at = parse_timestamp(row[3])
+            return {
+                'username': row[0],
+                'name': row[1],
+                # Expired premium reads as free; the entitlement refresh settles the rest
+                'is_premium': bool(row[2]) and (expires_at is None or expires_at > datetime.now()),
+                'premium_expires_at': expires_at
+            }
+
+        except Exception as e:
+            logger.warning("Could not resume session: %s", e)
+            return None
+
+    def touch_user_sessions(self, seen, ttl_seconds):
+        """
+        Batched sliding expiry: ``seen`` maps id_hash -> last seen epoch
+        seconds; each session is pushed out to last seen + ``ttl_seconds``.
+        """
+        if not seen:
+            return 0
+        try:
+            rows = [(last_seen, last_seen + ttl_seconds, id_hash) for id_hash, last_seen in seen.items()]
+
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+
+                if self.use_postgres:
+                    from psycopg2.extras import execute_batch
+                    execute_batch(cursor, '''
+                        UPDATE user_sessions SET last_seen_at = %s, expires_at = %s WHERE id_hash = %s
+                    ''', rows)
+                else:
+                    cursor.executemany('''
+                        UPDATE user_sessions SET last_seen_at = ?, expires_at = ? WHERE id_hash = ?
+                    ''', rows)
+
+                conn.commit()
+            return len(rows)
+
+        except Exception as e:
+            logger.warning("Could not update session last-seen times: %s", e)
+            return 0
+
+    def delete_user_session(self, id_hash):
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute('DELETE FROM user_sessions WHERE id_hash = %s', (id_hash,))
+                else:
+                    cursor.execute('DELETE FROM user_sessions WHERE id_hash = ?', (id_hash,))
+                conn.commit()
+            return True
+        except Exception as e:
+            logger.warning("Could not delete session: %s", e)
+            return False
+
+    def purge_expired_sessions(self):
+        """Delete expired sessions (range scan on idx_user_sessions_expires)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute('DELETE FROM user_sessions WHERE expires_at < %s', (time.time(),))
+                else:
+                    cursor.execute('DELETE FROM user_sessions WHERE expires_at < ?', (time.time(),))
+                purged = cursor.rowcount
+                conn.commit()
+            return purged
+        except Exception as e:
+            logger.warning("Could not purge expired sessions: %s", e)
+            return 0
+
+    # EMAIL OUTBOX
+    
+    def enqueue_email(self, idempotency_key, to_email, to_name, subject, text_part, html_part):
+        """
+        Add a message to the outbox. A message whose idempotency key is
+        already queued (or sent) is ignored. Returns True if it was added.
+        """
+        try:
+            now = time.time()
+            
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        INSERT INTO email_outbox (idempotency_key, to_email, to_name, subject, text_part, html_part,
+                                                  next_attempt_at, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (idempotency_key) DO NOTHING
+                    ''', (idempotency_key, to_email, to_name, subject, text_part, html_part, now, now))
+                else:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO email_outbox (idempotency_key, to_email, to_name, subject, text_part,
+                                                            html_part, next_attempt_at, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (idempotency_key, to_email, to_name, subject, text_part, html_part, now, now))
+                
+                added = cursor.rowcount == 1
+                conn.commit()
+            return added
+            
+        except Exception as e:
+            logger.warning("Could not queue email to %s: %s", to_email, e)
+            return False
+    
+    def claim_outbox_batch(self, limit, lease_seconds):
+        """
+        Claim up to ``limit`` due messages for sending. Claimed rows are
+        marked 'sending' and pushed ``lease_seconds`` into the future, so a
+        worker that dies mid-send leaves them to be picked up again.
+        Returns a list of dicts.
+        """
+        try:
+            now = time.time()
+            columns = 'id, idempotency_key, to_email, to_name, subject, text_part, html_part, attempts'
+            
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute(f'''
+                        UPDATE email_outbox
+                        SET status = 'sending', attempts = attempts + 1, next_attempt_at = %s
+                        WHERE id IN (
+                            SELECT id FROM email_outbox
+                            WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s
+                            ORDER BY next_attempt_at
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING {columns}
+                    ''', (now + lease_seconds, now, limit))
+                    rows = cursor.fetchall()
+                else:
+                    # Write lock up front so two workers can't select the same rows
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute(f'''
+                        SELECT {columns} FROM email_outbox
+                        WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                        ORDER BY next_attempt_at
+                        LIMIT ?
+                    ''', (now, limit))
+                    rows = cursor.fetchall()
+                    cursor.executemany('''
+                        UPDATE email_outbox
+                        SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+                        WHERE id = ?
+                    ''', [(now + lease_seconds, row[0]) for row in rows])
+                
+                conn.commit()
+            
+            return [
+                {
+                    'id': row[0],
+                    'idempotency_key': row[1],
+                    'to_email': row[2],
+                    'to_name': row[3],
+                    'subject': row[4],
+                    'text_part': row[5],
+                    'html_part': row[6],
+                    'attempts': row[7] + (0 if self.use_postgres else 1)
+                }
+                for row in rows
+            ]
+            
+        except Exception as e:
+            logger.warning("Could not claim outbox messages: %s", e)
+            return []
+    
+    def complete_outbox_message(self, message_id, sent, error=None, retry_at=None):
+        """
+        Record a send attempt: 'sent' on success, back to 'pending' until
+        ``retry_at`` on a retryable failure, or 'dead' when ``retry_at`` is None.
+        A sent or dead message's body is cleared: it may hold a live link
+        (a password reset URL) that shouldn't outlast delivery.
+        """
+        try:
+            now = time.time()
+            if sent:
+                status, next_attempt_at = 'sent', now
+            elif retry_at is not None:
+                status, next_attempt_at = 'pending', retry_at
+            else:
+                status, next_attempt_at = 'dead', now
+            
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        UPDATE email_outbox
+                        SET status = %s, next_attempt_at = %s, last_error = %s, sent_at = %s,
+                            text_part = CASE WHEN %s = 'pending' THEN text_part END,
+                            html_part = CASE WHEN %s = 'pending' THEN html_part END
+                        WHERE id = %s
+                    ''', (status, next_attempt_at, error, now if sent else None, status, status, message_id))
+                else:
+                    cursor.execute('''
+                        UPDATE email_outbox
+                        SET status = ?, next_attempt_at = ?, last_error = ?, sent_at = ?,
+                            text_part = CASE WHEN ? = 'pending' THEN text_part END,
+                            html_part = CASE WHEN ? = 'pending' THEN html_part END
+                        WHERE id = ?
+                    ''', (status, next_attempt_at, error, now if sent else None, status, status, message_id))
+                
+                conn.commit()
+            return True
+            
+        except Exception as e:
+            logger.warning("Could not update outbox message %s: %s", message_id, e)
+            return False
+    
+    def purge_outbox(self, retention_seconds, batch_size=1000):
+        """
+        Delete sent and dead messages finished more than ``retention_seconds``
+        ago, in batches like purge_expired_reset_tokens. Pending and in-flight
+        messages are never touched. Returns the number of rows deleted.
+        """
+        purged = 0
+        try:
+            cutoff = time.time() - retention_seconds
+            while True:
+                with self.get_connection() as conn:
+                    cursor = conn.cursor()
+                    
+                    if self.use_postgres:
+                        cursor.execute('''
+                            DELETE FROM email_outbox WHERE id IN (
+                                SELECT id FROM email_outbox
+                                WHERE status IN ('sent', 'dead') AND next_attempt_at < %s LIMIT %s
+                            )
+                        ''', (cutoff, batch_size))
+                    else:
+                        cursor.execute('''
+                            DELETE FROM email_outbox WHERE id IN (
+                                SELECT id FROM email_outbox
+                                WHERE status IN ('sent', 'dead') AND next_attempt_at < ? LIMIT ?
+                            )
+                        ''', (cutoff, batch_size))
+                    
+                    deleted = cursor.rowcount
+                    conn.commit()
+                purged += deleted
+                if deleted < batch_size:
+                    return purged
+        except Exception as e:
+            logger.warning("Could not purge the email outbox: %s", e)
+            return purged
+    
+    def get_outbox_stats(self):
+        """Message counts by status"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT status, COUNT(*) FROM email_outbox GROUP BY status')
+                stats = dict(cursor.fetchall())
+                conn.rollback()
+            return stats
+        except Exception as e:
+            return {}
+    
+    # AUTOMATIC SUBSCRIPTION RENEWAL SYSTEM
+    
+    def run_renewal_sweep(self):
+        """
+        Check ALL expired premium users for renewals.
+        Runs from the background scheduler (renewal_scheduler.py), never
+        inside a page render, so it reports through logging only.
+        Returns (renewed_count, cancelled_count).
+        """
+        try:
+            # Import here to avoid circular imports
+            from renewal_engine import RenewalEngine
+            
+            report = RenewalEngine(self).run()
+            return report['renewed'], report['cancelled']
+            
+        except Exception as e:
+            logger.exception("Error in renewal sweep: %s", e)
+            return 0, 0
+    
+    def get_renewal_candidates(self):
+        """Load every expired premium user with a live Stripe subscription in one query"""
+        with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Find users who might need renewal
             if self.use_postgres:
                 cursor.execute('''
-                    SELECT username, premium_expires_at, stripe_subscription_id
+                    SELECT username, email, name, premium_expires_at, stripe_subscription_id
                     FROM users 
                     WHERE is_premium = TRUE 
                     AND premium_expires_at < %s 
@@ -548,35 +1225,103 @@ class Database:
                 ''', (datetime.now(),))
             else:
                 cursor.execute('''
-                    SELECT username, premium_expires_at, stripe_subscription_id
+                    SELECT username, email, name, premium_expires_at, stripe_subscription_id
                     FROM users 
                     WHERE is_premium = 1 
                     AND premium_expires_at < ? 
                     AND stripe_subscription_id IS NOT NULL 
                     AND stripe_subscription_id != 'CANCELLED'
-                ''', (datetime.now(),))
+                ''', (self._ts(datetime.now()),))
             
-            expired_users = cursor.fetchall()
-            conn.close()
-            
-            renewed_count = 0
-            cancelled_count = 0
-            
-            for username, old_expiry, subscription_id in expired_users:
-                result = self.simple_renewal_check(username)
-                if result == True:
-                    renewed_count += 1
-                elif result == False:
-                    cancelled_count += 1
+            rows = cursor.fetchall()
+        
+        return [
+            {
+                'username': row[0],
+                'email': row[1],
+                'name': row[2],
+                'premium_expires_at': row[3],
+                'stripe_subscription_id': row[4]
+            }
+            for row in rows
+        ]
+    
+    def apply_renewal_batch(self, extensions, cancellations):
+        """
+        Apply a batch of renewal decisions in one transaction.
+        extensions: list of (username, new_expires_at) - premium is extended
+        cancellations: list of usernames - premium removed, subscription CANCELLED
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             
-            if renewed_count > 0 or cancelled_count > 0:
-                st.success(f"✅ Renewal check complete: {renewed_count} renewed, {cancelled_count} cancelled")
+            if self.use_postgres:
+                from psycopg2.extras import execute_values
+                
+                if extensions:
+                    execute_values(cursor, '''
+                        UPDATE users AS u 
+                        SET is_premium = TRUE, premium_expires_at = v.expires_at::timestamp 
+                        FROM (VALUES %s) AS v(username, expires_at) 
+                        WHERE u.username = v.username
+                    ''', extensions, page_size=1000)
+                if cancellations:
+                    cursor.execute('''
+                        UPDATE users 
+                        SET is_premium = FALSE, premium_expires_at = NULL, stripe_subscription_id = 'CANCELLED' 
+                        WHERE username = ANY(%s)
+                    ''', (list(cancellations),))
+            else:
+                if extensions:
+                    cursor.executemany('''
+                        UPDATE users SET is_premium = 1, premium_expires_at = ? WHERE username = ?
+                    ''', [(self._ts(expires_at), username) for username, expires_at in extensions])
+                if cancellations:
+                    cursor.executemany('''
+                        UPDATE users 
+                        SET is_premium = 0, premium_expires_at = NULL, stripe_subscription_id = 'CANCELLED' 
+                        WHERE username = ?
+                    ''', [(username,) for username in cancellations])
             
-            # Mark as checked for today
-            st.session_state['last_renewal_check'] = current_date
+            conn.commit()
+        
+        for username, _ in extensions:
+            self.user_cache.invalidate(username=username)
+        for username in cancellations:
+            self.user_cache.invalidate(username=username)
+    
+    def iter_subscribed_users(self, fetch_size=2000):
+        """
+        Stream (username, stripe_subscription_id, is_premium, premium_expires_at)
+        for every user with a Stripe subscription, ordered by subscription id.
+        Postgres uses a server-side cursor so rows are never all in memory.
+        """
+        with self.get_connection() as conn:
+            if self.use_postgres:
+                # Named cursor = server-side; COLLATE "C" matches Python string ordering
+                cursor = conn.cursor(name='subscribed_users')
+                cursor.itersize = fetch_size
+                cursor.execute('''
+                    SELECT username, stripe_subscription_id, is_premium, premium_expires_at
+                    FROM users 
+                    WHERE stripe_subscription_id IS NOT NULL 
+                    AND stripe_subscription_id != 'CANCELLED'
+                    ORDER BY stripe_subscription_id COLLATE "C"
+                ''')
+            else:
+                cursor = conn.cursor()
+                cursor.arraysize = fetch_size
+                cursor.execute('''
+                    SELECT username, stripe_subscription_id, is_premium, premium_expires_at
+                    FROM users 
+                    WHERE stripe_subscription_id IS NOT NULL 
+                    AND stripe_subscription_id != 'CANCELLED'
+                    ORDER BY stripe_subscription_id
+                ''')
             
-        except Exception as e:
-            st.write(f"Debug: Error in auto renewal check: {e}")
+            for row in cursor:
+                yield row[0], row[1], bool(row[2]), row[3]
+            cursor.close()
     
     def simple_renewal_check(self, username):
         """
@@ -604,59 +1349,62 @@ class Database:
                 
                 # If expired, check Stripe to see if subscription is still active
                 if datetime.now() > expiry_date:
-                    st.write(f"Debug: {username} premium expired, checking Stripe...")
+                    logger.info("%s premium expired, checking Stripe", username)
                     
                     try:
                         import stripe
                         stripe.api_key = st.secrets["default"]["STRIPE_SECRET_KEY"]
                         subscription = stripe.Subscription.retrieve(user['stripe_subscription_id'])
                         
-                        if subscription.status == 'active':
-                            # Stripe says subscription is active, extend premium
-                            if subscription.plan.interval == 'year':
-                                new_expiry = datetime.now() + timedelta(days=365)
-                                plan_name = "Annual"
-                            else:
-                                new_expiry = datetime.now() + timedelta(days=30)
-                                plan_name = "Monthly"
+                        from stripe_subscriptions import ACTIVE_STATUSES, REVOKED_STATUSES, billing_interval, current_period_end
+                        if subscription.status in ACTIVE_STATUSES:
+                            # Stripe says subscription is active, extend premium to the end of the paid period
+                            annual = billing_interval(subscription) == 'year'
+                            new_expiry = current_period_end(subscription) or datetime.now() + timedelta(days=365 if annual else 30)
+                            plan_name = "Annual" if annual else "Monthly"
                             
                             # Update database
                             success = self.update_premium_status(username, True, new_expiry.isoformat(), user['stripe_subscription_id'])
                             
                             if success:
-                                st.success(f"✅ {username}: {plan_name} subscription auto-renewed until {new_expiry.strftime('%Y-%m-%d')}")
+                                logger.info("%s: %s subscription auto-renewed until %s", username, plan_name, new_expiry.strftime('%Y-%m-%d'))
                                 
                                 # ✅ NEW: Send renewal notification email
                                 try:
-                                    # Import email handler here to avoid circular imports
-                                    from email_handler import EmailHandler
-                                    email_handler = EmailHandler()
+                                    # Import here to avoid circular imports; the handler is built once per process
+                                    from services import get_email_handler
+                                    email_handler = get_email_handler()
                                     
                                     # Send renewal notification
                                     email_handler.send_renewal_notification_email(
                                         user['email'], 
                                         user['name'], 
                                         plan_name,
-                                        new_expiry.strftime('%Y-%m-%d')
+                                        new_expiry.strftime('%Y-%m-%d'),
+                                        idempotency_key=f"renewal:{user['username']}:{new_expiry:%Y-%m-%d}"
                                     )
-                                    st.info(f"📧 Renewal notification sent to {user['email']}")
+                                    logger.info("Renewal notification sent to %s", user['email'])
                                     
                                 except Exception as email_error:
-                                    st.write(f"Debug: Could not send renewal email: {email_error}")
+                                    logger.warning("Could not send renewal email: %s", email_error)
                                     # Don't fail the renewal if email fails
                                 
                                 return True  # Renewed
                             else:
-                                st.error(f"❌ {username}: Database update failed")
+                                logger.error("%s: database update failed during renewal", username)
                                 return None
-                        else:
-                            # Stripe says subscription is not active, remove premium
+                        elif subscription.status in REVOKED_STATUSES:
+                            # Stripe says subscription has ended, remove premium
                             self.update_premium_status(username, False, None, 'CANCELLED')
-                            st.warning(f"⚠️ {username}: Subscription {subscription.status} - premium access removed")
+                            logger.warning("%s: subscription %s - premium access removed", username, subscription.status)
                             return False  # Cancelled
+                        else:
+                            # past_due / incomplete / paused: leave it while Stripe retries payment
+                            logger.info("%s: subscription %s - waiting on Stripe", username, subscription.status)
+                            return None
                             
                     except Exception as e:
-                        st.write(f"Debug: Could not check Stripe for {username}: {e}")
+                        logger.warning("Could not check Stripe for %s: %s", username, e)
                         # If we can't reach Stripe, don't change anything
                         return None  # Unknown
                 else:
@@ -666,5 +1414,404 @@ class Database:
             return None  # Not applicable
             
         except Exception as e:
-            st.write(f"Debug: Error in renewal check for {username}: {e}")
+            logger.warning("Error in renewal check for %s: %s", username, e)
+            return None
+    
+    # EMAIL CAMPAIGNS
+    
+    def iter_campaign_recipients(self, audience='premium', after_id=0, fetch_size=2000):
+        """
+        Stream (id, username, email, name) for a campaign audience ('premium'
+        or 'all') in id order, starting after ``after_id``. Postgres uses a
+        server-side cursor. SQLite reads keyset pages instead, so no read
+        transaction stays open while results are written in between.
+        """
+        premium_only = audience == 'premium'
+        
+        if self.use_postgres:
+            with self.get_connection() as conn:
+                cursor = conn.cursor(name='campaign_recipients')
+                cursor.itersize = fetch_size
+                cursor.execute(f'''
+                    SELECT id, username, email, name FROM users
+                    WHERE id > %s {"AND is_premium = TRUE" if premium_only else ""}
+                    ORDER BY id
+                ''', (after_id,))
+                for row in cursor:
+                    yield row
+                cursor.close()
+            return
+        
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT id, username, email, name FROM users
+                    WHERE id > ? {"AND is_premium = 1" if premium_only else ""}
+                    ORDER BY id LIMIT ?
+                ''', (after_id, fetch_size))
+                rows = cursor.fetchall()
+                conn.rollback()
+            for row in rows:
+                yield row
+            if len(rows) < fetch_size:
+                return
+            after_id = rows[-1][0]
+    
+    def start_campaign(self, campaign_id, subject, audience):
+        """Create the campaign if it is new and return its row (with the resume checkpoint)"""
+        now = time.time()
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            if self.use_postgres:
+                cursor.execute('''
+                    INSERT INTO email_campaigns (campaign_id, subject, audience, created_at, updated_at)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (campaign_id) DO NOTHING
+                ''', (campaign_id, subject, audience, now, now))
+                cursor.execute('''
+                    UPDATE email_campaigns SET status = 'running', updated_at = %s WHERE campaign_id = %s
+                ''', (now, campaign_id))
+            else:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO email_campaigns (campaign_id, subject, audience, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (campaign_id, subject, audience, now, now))
+                cursor.execute('''
+                    UPDATE email_campaigns SET status = 'running', updated_at = ? WHERE campaign_id = ?
+                ''', (now, campaign_id))
+            
+            conn.commit()
+        return self.get_campaign(campaign_id)
+    
+    def get_campaign(self, campaign_id):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    SELECT campaign_id, subject, audience, status, last_user_id, sent, failed
+                    FROM email_campaigns WHERE campaign_id = %s
+                ''', (campaign_id,))
+            else:
+                cursor.execute('''
+                    SELECT campaign_id, subject, audience, status, last_user_id, sent, failed
+                    FROM email_campaigns WHERE campaign_id = ?
+                ''', (campaign_id,))
+            row = cursor.fetchone()
+            conn.rollback()
+        
+        if not row:
             return None
+        return {
+            'campaign_id': row[0],
+            'subject': row[1],
+            'audience': row[2],
+            'status': row[3],
+            'last_user_id': row[4],
+            'sent': row[5],
+            'failed': row[6]
+        }
+    
+    def get_campaign_sent_ids(self, campaign_id, after_id):
+        """User ids past the checkpoint that already have a 'sent' result (skipped on resume)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    SELECT user_id FROM email_campaign_results
+                    WHERE campaign_id = %s AND user_id > %s AND status = 'sent'
+                ''', (campaign_id, after_id))
+            else:
+                cursor.execute('''
+                    SELECT user_id FROM email_campaign_results
+                    WHERE campaign_id = ? AND user_id > ? AND status = 'sent'
+                ''', (campaign_id, after_id))
+            sent_ids = {row[0] for row in cursor.fetchall()}
+            conn.rollback()
+        return sent_ids
+    
+    def record_campaign_results(self, campaign_id, results, checkpoint=None):
+        """
+        Store per-recipient results [(user_id, status, error)] for one batch
+        and, if given, move the resume checkpoint forward, in one transaction.
+        """
+        sent = sum(1 for _, status, _ in results if status == 'sent')
+        failed = len(results) - sent
+        now = time.time()
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            if self.use_postgres:
+                from psycopg2.extras import execute_values
+                execute_values(cursor, '''
+                    INSERT INTO email_campaign_results (campaign_id, user_id, status, error) VALUES %s
+                    ON CONFLICT (campaign_id, user_id) DO UPDATE SET status = EXCLUDED.status, error = EXCLUDED.error
+                ''', [(campaign_id, user_id, status, error) for user_id, status, error in results])
+                cursor.execute('''
+                    UPDATE email_campaigns
+                    SET sent = sent + %s, failed = failed + %s, updated_at = %s,
+                        last_user_id = GREATEST(last_user_id, %s)
+                    WHERE campaign_id = %s
+                ''', (sent, failed, now, checkpoint or 0, campaign_id))
+            else:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO email_campaign_results (campaign_id, user_id, status, error)
+                    VALUES (?, ?, ?, ?)
+                ''', [(campaign_id, user_id, status, error) for user_id, status, error in results])
+                cursor.execute('''
+                    UPDATE email_campaigns
+                    SET sent = sent + ?, failed = failed + ?, updated_at = ?,
+                        last_user_id = MAX(last_user_id, ?)
+                    WHERE campaign_id = ?
+                ''', (sent, failed, now, checkpoint or 0, campaign_id))
+            
+            conn.commit()
+    
+    def finish_campaign(self, campaign_id, status='done'):
+        """Close the campaign; totals are recounted from the results so resumed batches aren't double counted"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    UPDATE email_campaigns SET status = %s, updated_at = %s,
+                        sent = (SELECT COUNT(*) FROM email_campaign_results r
+                                WHERE r.campaign_id = email_campaigns.campaign_id AND r.status = 'sent'),
+                        failed = (SELECT COUNT(*) FROM email_campaign_results r
+                                  WHERE r.campaign_id = email_campaigns.campaign_id AND r.status != 'sent')
+                    WHERE campaign_id = %s
+                ''', (status, time.time(), campaign_id))
+            else:
+                cursor.execute('''
+                    UPDATE email_campaigns SET status = ?, updated_at = ?,
+                        sent = (SELECT COUNT(*) FROM email_campaign_results r
+                                WHERE r.campaign_id = email_campaigns.campaign_id AND r.status = 'sent'),
+                        failed = (SELECT COUNT(*) FROM email_campaign_results r
+                                  WHERE r.campaign_id = email_campaigns.campaign_id AND r.status != 'sent')
+                    WHERE campaign_id = ?
+                ''', (status, time.time(), campaign_id))
+            conn.commit()
+
+    # STRIPE CHECKOUTS
+    
+    def claim_checkout(self, session_id, owner, lease_seconds):
+        """
+        Claim a Stripe checkout session for processing, like claim_due_job: only
+        one owner across sessions and replicas holds it at a time, and a claim
+        whose owner died lapses after lease_seconds.
+        Returns (claimed, row); row holds the stored result once status is 'done'.
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    INSERT INTO processed_checkouts (session_id, created_at) VALUES (%s, %s)
+                    ON CONFLICT (session_id) DO NOTHING
+                ''', (session_id, now))
+                cursor.execute('''
+                    UPDATE processed_checkouts SET locked_by = %s, locked_until = %s
+                    WHERE session_id = %s AND status != 'done'
+                    AND (locked_until IS NULL OR locked_until < %s)
+                ''', (owner, now + lease_seconds, session_id, now))
+                claimed = cursor.rowcount == 1
+                cursor.execute('''
+                    SELECT session_id, status, username, subscription_id, expires_at, amount, plan_type, error
+                    FROM processed_checkouts WHERE session_id = %s
+                ''', (session_id,))
+            else:
+                cursor.execute('INSERT OR IGNORE INTO processed_checkouts (session_id, created_at) VALUES (?, ?)',
+                               (session_id, now))
+                cursor.execute('''
+                    UPDATE processed_checkouts SET locked_by = ?, locked_until = ?
+                    WHERE session_id = ? AND status != 'done'
+                    AND (locked_until IS NULL OR locked_until < ?)
+                ''', (owner, now + lease_seconds, session_id, now))
+                claimed = cursor.rowcount == 1
+                cursor.execute('''
+                    SELECT session_id, status, username, subscription_id, expires_at, amount, plan_type, error
+                    FROM processed_checkouts WHERE session_id = ?
+                ''', (session_id,))
+            row = cursor.fetchone()
+            conn.commit()
+
+        return claimed, {
+            'session_id': row[0],
+            'status': row[1],
+            'username': row[2],
+            'subscription_id': row[3],
+            'expires_at': parse_timestamp(row[4]),
+            'amount': row[5],
+            'plan_type': row[6],
+            'error': row[7]
+        }
+
+    def complete_checkout(self, session_id, owner, username, subscription_id, expires_at, amount, plan_type):
+        """Store a processed checkout's result and release the claim"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute('''
+                    UPDATE processed_checkouts
+                    SET status = 'done', locked_by = NULL, locked_until = NULL, error = NULL, processed_at = %s,
+                        username = %s, subscription_id = %s, expires_at = %s, amount = %s, plan_type = %s
+                    WHERE session_id = %s AND locked_by = %s
+                ''', (time.time(), username, subscription_id, expires_at, amount, plan_type, session_id, owner))
+            else:
+                cursor.execute('''
+                    UPDATE processed_checkouts
+                    SET status = 'done', locked_by = NULL, locked_until = NULL, error = NULL, processed_at = ?,
+                        username = ?, subscription_id = ?, expires_at = ?, amount = ?, plan_type = ?
+                    WHERE session_id = ? AND locked_by = ?
+                ''', (time.time(), username, subscription_id, self._ts(expires_at), amount, plan_type, session_id, owner))
+            completed = cursor.rowcount == 1
+            conn.commit()
+        return completed
+
+    def fail_checkout(self, session_id, owner, error):
+        """Record why a checkout couldn't be processed and release the claim so a later view retries it"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute('''
+                        UPDATE processed_checkouts SET status = 'failed', error = %s, locked_by = NULL, locked_until = NULL
+                        WHERE session_id = %s AND locked_by = %s
+                    ''', (str(error)[:500], session_id, owner))
+                else:
+                    cursor.execute('''
+                        UPDATE processed_checkouts SET status = 'failed', error = ?, locked_by = NULL, locked_until = NULL
+                        WHERE session_id = ? AND locked_by = ?
+                    ''', (str(error)[:500], session_id, owner))
+                conn.commit()
+        except Exception as e:
+            logger.warning("Could not record failed checkout %s: %s", session_id, e)
+
+    # STRIPE WEBHOOK EVENTS
+    
+    def apply_stripe_event(self, event_id, event_type, created, change=None):
+        """
+        Record a Stripe webhook event and apply its premium change in one transaction.
+        change: {'action': 'link' | 'extend' | 'revoke', 'username', 'subscription_id', 'expires_at'}
+          link   - checkout completed: attach the subscription to the user
+          extend - subscription paid/active: premium until expires_at
+          revoke - subscription ended: premium removed, subscription CANCELLED
+        Returns 'duplicate', 'ignored', 'applied', 'stale' (a newer event was already
+        applied to the subscription) or 'unmatched' (no user has the subscription).
+        """
+        subscription_id = change.get('subscription_id') if change else None
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+
+            # The primary key claims the event: a redelivery inserts nothing
+            if self.use_postgres:
+                cursor.execute('''
+                    INSERT INTO stripe_events (event_id, event_type, subscription_id, created, received_at, outcome)
+                    VALUES (%s, %s, %s, %s, %s, 'received')
+                    ON CONFLICT (event_id) DO NOTHING
+                ''', (event_id, event_type, subscription_id, created, time.time()))
+            else:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO stripe_events (event_id, event_type, subscription_id, created, received_at, outcome)
+                    VALUES (?, ?, ?, ?, ?, 'received')
+                ''', (event_id, event_type, subscription_id, created, time.time()))
+            if cursor.rowcount == 0:
+                return 'duplicate'
+
+            usernames = []
+            if change is None:
+                outcome = 'ignored'
+            elif change['action'] == 'link':
+                usernames = self._link_subscription(cursor, change)
+                outcome = 'applied' if usernames else 'ignored'
+            else:
+                usernames = self._apply_subscription_change(cursor, change, created)
+                if usernames:
+                    outcome = 'applied'
+                elif self._newer_stripe_event_applied(cursor, subscription_id, created):
+                    outcome = 'stale'
+                else:
+                    outcome = 'unmatched'
+
+            if self.use_postgres:
+                cursor.execute('UPDATE stripe_events SET outcome = %s WHERE event_id = %s', (outcome, event_id))
+            else:
+                cursor.execute('UPDATE stripe_events SET outcome = ? WHERE event_id = ?', (outcome, event_id))
+            conn.commit()
+
+        for username in usernames:
+            self.user_cache.invalidate(username=username)
+        return outcome
+
+    def _link_subscription(self, cursor, change):
+        """Attach a checkout's subscription to the user. Only the first link sets the
+        (provisional) expiry; a paid invoice may already have set the real one."""
+        if self.use_postgres:
+            cursor.execute('''
+                UPDATE users SET is_premium = TRUE, premium_expires_at = %s, stripe_subscription_id = %s
+                WHERE username = %s AND stripe_subscription_id IS DISTINCT FROM %s
+                RETURNING username
+            ''', (change['expires_at'], change['subscription_id'], change['username'], change['subscription_id']))
+        else:
+            cursor.execute('''
+                UPDATE users SET is_premium = 1, premium_expires_at = ?, stripe_subscription_id = ?
+                WHERE username = ? AND stripe_subscription_id IS NOT ?
+                RETURNING username
+            ''', (self._ts(change['expires_at']), change['subscription_id'], change['username'], change['subscription_id']))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _apply_subscription_change(self, cursor, change, created):
+        """Extend or revoke by subscription id, unless a newer event for it was applied.
+        An extension also matches by username while the user has no live subscription
+        (none yet, or CANCELLED), so paying again reactivates a cancelled account."""
+        subscription_id = change['subscription_id']
+        if self.use_postgres:
+            if change['action'] == 'extend':
+                cursor.execute('''
+                    UPDATE users SET is_premium = TRUE, premium_expires_at = %s, stripe_subscription_id = %s
+                    WHERE (stripe_subscription_id = %s
+                           OR (username = %s AND (stripe_subscription_id IS NULL OR stripe_subscription_id = 'CANCELLED')))
+                    AND NOT EXISTS (SELECT 1 FROM stripe_events e
+                                    WHERE e.subscription_id = %s AND e.outcome = 'applied' AND e.created > %s)
+                    RETURNING username
+                ''', (change['expires_at'], subscription_id, subscription_id, change.get('username'), subscription_id, created))
+            else:
+                cursor.execute('''
+                    UPDATE users SET is_premium = FALSE, premium_expires_at = NULL, stripe_subscription_id = 'CANCELLED'
+                    WHERE stripe_subscription_id = %s
+                    AND NOT EXISTS (SELECT 1 FROM stripe_events e
+                                    WHERE e.subscription_id = %s AND e.outcome = 'applied' AND e.created > %s)
+                    RETURNING username
+                ''', (subscription_id, subscription_id, created))
+        else:
+            if change['action'] == 'extend':
+                cursor.execute('''
+                    UPDATE users SET is_premium = 1, premium_expires_at = ?, stripe_subscription_id = ?
+                    WHERE (stripe_subscription_id = ?
+                           OR (username = ? AND (stripe_subscription_id IS NULL OR stripe_subscription_id = 'CANCELLED')))
+                    AND NOT EXISTS (SELECT 1 FROM stripe_events e
+                                    WHERE e.subscription_id = ? AND e.outcome = 'applied' AND e.created > ?)
+                    RETURNING username
+                ''', (self._ts(change['expires_at']), subscription_id, subscription_id, change.get('username'), subscription_id, created))
+            else:
+                cursor.execute('''
+                    UPDATE users SET is_premium = 0, premium_expires_at = NULL, stripe_subscription_id = 'CANCELLED'
+                    WHERE stripe_subscription_id = ?
+                    AND NOT EXISTS (SELECT 1 FROM stripe_events e
+                                    WHERE e.subscription_id = ? AND e.outcome = 'applied' AND e.created > ?)
+                    RETURNING username
+                ''', (subscription_id, subscription_id, created))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _newer_stripe_event_applied(self, cursor, subscription_id, created):
+        if self.use_postgres:
+            cursor.execute('''
+                SELECT 1 FROM stripe_events WHERE subscription_id = %s AND outcome = 'applied' AND created > %s LIMIT 1
+            ''', (subscription_id, created))
+        else:
+            cursor.execute('''
+                SELECT 1 FROM stripe_events WHERE subscription_id = ? AND outcome = 'applied' AND created > ? LIMIT 1
+            ''', (subscription_id, created))
+        return cursor.fetchone() is not None
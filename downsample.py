@@ -0,0 +1,178 @@
+"""
+Server-side downsampling for line charts.
+
+A chart can't show more points than it has pixels, so series are reduced
+before they are handed to go.Scatter:
+
+    x, y = downsample(timestamps, values, FULL_WIDTH_PX)     # the line
+    x, low, high = envelope(timestamps, values, FULL_WIDTH_PX)  # min/max band
+
+downsample is MinMaxLTTB: a vectorized min/max pass keeps the extremes of
+small buckets (a few points per output point), then Largest-Triangle-Three-
+Buckets picks one point per bucket from those. Each LTTB choice depends on
+the previous one, so the triangle areas are computed for every pair of
+candidates at once and only the final walk through the choices is a Python
+loop over the output points. Results are deterministic (ties go to the
+earliest point). Values must be finite.
+
+envelope gives the per-bucket minimum and maximum, for a shaded band
+(envelope_traces) that keeps spikes visible however far the line is reduced.
+
+    python downsample.py     # time 10M points down to 2k
+"""
+import time
+
+import numpy as np
+
+# Plot area of a full-width chart on a wide-layout page, and of one in st.columns(2)
+FULL_WIDTH_PX = 1400
+HALF_WIDTH_PX = 700
+
+# Candidates kept per output point by the min/max pass
+MINMAX_RATIO = 4
+
+
+def points_for_width(width_px, points_per_pixel=1.5):
+    """Output points worth drawing across ``width_px`` pixels"""
+    return max(3, int(width_px * points_per_pixel))
+
+
+def _bucket_edges(length, buckets):
+    """Start offsets (and the final end) of ``buckets`` near-equal runs over ``length`` items"""
+    return np.arange(buckets + 1) * length // buckets
+
+
+def _minmax_indices(y, buckets):
+    """Indices of the min and max of each of ``buckets`` near-equal runs of y, in order"""
+    length = len(y)
+    size = -(-length // buckets)
+    full = length // size
+    rows = y[:full * size].reshape(full, size)
+    picks = np.stack([rows.argmin(axis=1), rows.argmax(axis=1)], axis=1) + (np.arange(full) * size)[:, None]
+    if full * size < length:
+        tail = y[full * size:]
+        picks = np.vstack([picks, [[full * size + tail.argmin(), full * size + tail.argmax()]]])
+    picks.sort(axis=1)
+    return picks.ravel()
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the ``n_out`` points LTTB keeps from (x, y); first and last are
+    always kept. Meant for inputs of up to a few points per output point -
+    call downsample for anything larger.
+    """
+    length = len(x)
+    if n_out >= length or n_out < 3:
+        return np.arange(length)
+
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.asarray(y, dtype=np.float64)
+    buckets = n_out - 2
+    edges = _bucket_edges(length - 2, buckets) + 1
+    sizes = np.diff(edges)
+
+    # Candidate indices per bucket, padded (with the bucket's last index) to equal width
+    width = int(sizes.max())
+    candidates = np.minimum(edges[:-1, None] + np.arange(width), (edges[1:] - 1)[:, None])
+
+    # The third vertex of each bucket's triangle: the next bucket's average, or the last point
+    sums_x = np.add.reduceat(x[1:-1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:-1], edges[:-1] - 1)
+    next_x = np.append(sums_x[1:] / sizes[1:], x[-1])[:, None, None]
+    next_y = np.append(sums_y[1:] / sizes[1:], y[-1])[:, None, None]
+
+    # areas[b, i, j]: triangle of candidate i of bucket b-1 (the point before), candidate j
+    # of bucket b and bucket b's third vertex. Bucket 0's point before is always the first point.
+    prev = np.vstack([np.zeros((1, width), dtype=candidates.dtype), candidates[:-1]])
+    ax, ay = x[prev][:, :, None], y[prev][:, :, None]
+    px, py = x[candidates][:, None, :], y[candidates][:, None, :]
+    areas = np.abs((ax - next_x) * (py - ay) - (ax - px) * (next_y - ay))
+    best = areas.argmax(axis=2).tolist()
+
+    # Walk the choices: each bucket's pick depends on the previous bucket's
+    picks = [0]
+    choice = best[0][0]
+    picks.append(choice)
+    for row in best[1:]:
+        choice = row[choice]
+        picks.append(choice)
+    chosen = candidates[np.arange(buckets), picks[1:]]
+    return np.concatenate([[0], chosen, [length - 1]])
+
+
+def downsample_indices(x, y, n_out):
+    """Indices of at most ``n_out`` representative points (MinMaxLTTB), ascending"""
+    length = len(x)
+    if n_out >= length or n_out < 3:
+        return np.arange(length)
+    y = np.asarray(y)
+    if length > MINMAX_RATIO * n_out:
+        inner = _minmax_indices(y[1:-1], MINMAX_RATIO * n_out // 2) + 1
+        preselected = np.unique(np.concatenate([[0], inner, [length - 1]]))
+    else:
+        preselected = np.arange(length)
+    return preselected[lttb_indices(np.asarray(x)[preselected], y[preselected], n_out)]
+
+
+def downsample(x, y, width_px=FULL_WIDTH_PX):
+    """(x, y) reduced to what a chart ``width_px`` wide can show; x keeps its dtype"""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    indices = downsample_indices(x, y, points_for_width(width_px))
+    return x[indices], y[indices]
+
+
+def envelope(x, y, width_px=FULL_WIDTH_PX, high=None):
+    """
+    (bucket start x, bucket min y, bucket max y) with one bucket per pixel.
+    With ``high`` (rollup lows and highs), y is the lows and the band's top comes from high.
+    """
+    x = np.asarray(x)
+    low = np.asarray(y)
+    high = low if high is None else np.asarray(high)
+    buckets = min(len(low), max(1, int(width_px)))
+    if buckets == 0:
+        return x, low, high
+    starts = _bucket_edges(len(low), buckets)[:-1]
+    return x[starts], np.minimum.reduceat(low, starts), np.maximum.reduceat(high, starts)
+
+
+def envelope_traces(x, low, high, fillcolor, name='Range'):
+    """Two go.Scatter traces that shade between ``low`` and ``high``; add them before the line"""
+    import plotly.graph_objects as go
+    edge = dict(width=0)
+    return [
+        go.Scatter(x=x, y=high, mode='lines', line=edge, hoverinfo='skip', showlegend=False),
+        go.Scatter(x=x, y=low, mode='lines', line=edge, fill='tonexty', fillcolor=fillcolor,
+                   name=name, hoverinfo='skip', showlegend=False),
+    ]
+
+
+def main():
+    rng = np.random.default_rng(0)
+    n = 10_000_000
+    timestamps = np.arange(n, dtype=np.int64) + 1_600_000_000
+    values = np.cumsum(rng.normal(0, 1, n))
+    n_out = 2000
+
+    for name, run in (
+        ("downsample (MinMaxLTTB)", lambda: downsample_indices(timestamps, values, n_out)),
+        ("envelope", lambda: envelope(timestamps, values, n_out)),
+    ):
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f"{name:<24} {n:,} -> {len(result[0]) if isinstance(result, tuple) else len(result):,} points  "
+              f"median {timings[2] * 1000:.1f} ms  max {timings[-1] * 1000:.1f} ms")
+
+    first = downsample_indices(timestamps, values, n_out)
+    again = downsample_indices(timestamps, values, n_out)
+    print("deterministic:", bool(np.array_equal(first, again)))
+
+
+if __name__ == '__main__':
+    main()
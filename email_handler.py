@@ -1,6 +1,10 @@
 import streamlit as st
-from mailjet_rest import Client
+import logging
 import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
 
 class EmailHandler:
     def __init__(self):
@@ -10,536 +14,105 @@ class EmailHandler:
             self.from_email = st.secrets["default"]["RESET_EMAIL_FROM"]
             self.from_name = st.secrets["default"].get("RESET_EMAIL_FROM_NAME", "Kaspa Analytics")
             self.domain = st.secrets["default"]["DOMAIN"]
-            self.mailjet = Client(auth=(self.api_key, self.api_secret), version='v3.1')
+            # Imported here so pages that never send email don't load the client
+            from email_outbox import get_sender
+            from email_templates import get_templates
+            # Both are built once per process and shared by every handler
+            self.mailjet = get_sender().client
+            self.templates = get_templates(self.domain)
             st.write("Debug: Mailjet email handler initialized successfully!")
         except Exception as e:
             st.write(f"Debug: Error initializing Mailjet handler: {e}")
             self.mailjet = None
-    
-    def send_password_reset_email(self, to_email, reset_token, username):
+
+    def _send_template(self, name, to_email, username, idempotency_key=None, **fields):
+        """Render a compiled template for one recipient and queue it"""
+        subject, text_content, html_content = self.templates[name].render(username=username, **fields)
+        return self._send_email(to_email, username, subject, html_content, text_content, idempotency_key)
+
+    def send_password_reset_email(self, to_email, reset_token, username, idempotency_key=None):
         """Send password reset email with reset link via Mailjet"""
         try:
             if not self.mailjet:
                 st.write("Debug: Mailjet not configured, simulating email...")
                 return self.simulate_email(to_email, reset_token, username, "password_reset")
-            
-            reset_url = f"{self.domain}/C_🔄_Reset_Password?reset_token={reset_token}"
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>Password Reset - Kaspa Analytics</title>
-            </head>
-            <body>
-                <h1>Password Reset Request</h1>
-                <p>Hello {username},</p>
-                <p>Click the link below to reset your password:</p>
-                <a href="{reset_url}">Reset My Password</a>
-                <p>This link will expire in 1 hour.</p>
-            </body>
-            </html>
-            """
-            
-            text_content = f"""
-            Hello {username},
-            
-            Click this link to reset your password: {reset_url}
-            
-            This link will expire in 1 hour.
-            
-            © 2025 Kaspa Analytics
-            """
-            
-            return self._send_email(to_email, username, "Reset Your Kaspa Analytics Password", html_content, text_content)
-            
+
+            return self._send_template('password_reset', to_email, username, idempotency_key, reset_token=reset_token)
+
         except Exception as e:
             st.write(f"Debug: Error sending password reset email: {e}")
             return self.simulate_email(to_email, reset_token, username, "password_reset")
-    
-    def send_welcome_email(self, to_email, username):
+
+    def send_welcome_email(self, to_email, username, idempotency_key=None):
         """Send welcome email to new users"""
         try:
             if not self.mailjet:
                 st.write("Debug: Mailjet not configured, simulating welcome email...")
                 return self.simulate_email(to_email, None, username, "welcome")
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>Welcome to Kaspa Analytics</title>
-                <style>
-                    body {{ 
-                        font-family: Arial, sans-serif; 
-                        line-height: 1.6; 
-                        color: #333; 
-                        margin: 0;
-                        padding: 20px;
-                        background-color: #f4f4f4;
-                    }}
-                    .container {{ 
-                        max-width: 600px; 
-                        margin: 0 auto; 
-                        background: white;
-                        border-radius: 10px;
-                        overflow: hidden;
-                        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-                    }}
-                    .header {{ 
-                        background: linear-gradient(135deg, #28a745 0%, #20c997 100%); 
-                        color: white; 
-                        padding: 40px 30px; 
-                        text-align: center; 
-                    }}
-                    .content {{ 
-                        padding: 40px 30px; 
-                    }}
-                    .button {{ 
-                        display: inline-block; 
-                        background: #667eea;
-                        color: white; 
-                        padding: 15px 30px; 
-                        text-decoration: none; 
-                        border-radius: 8px; 
-                        margin: 20px 0;
-                        font-weight: bold;
-                    }}
-                    .feature-box {{
-                        background: #f8f9fa;
-                        border-left: 4px solid #28a745;
-                        padding: 20px;
-                        margin: 20px 0;
-                        border-radius: 5px;
-                    }}
-                    .footer {{ 
-                        background: #f8f9fa;
-                        text-align: center; 
-                        padding: 30px; 
-                        color: #666; 
-                        font-size: 14px; 
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🎉 Welcome to Kaspa Analytics!</h1>
-                        <p>Your gateway to advanced Kaspa blockchain insights</p>
-                    </div>
-                    <div class="content">
-                        <p>Hello <strong>{username}</strong>,</p>
-                        
-                        <p>Welcome to Kaspa Analytics! We're excited to have you join our community of crypto enthusiasts and analysts.</p>
-                        
-                        <div class="feature-box">
-                            <h3>🚀 What you can do now:</h3>
-                            <ul>
-                                <li><strong>⛏️ Mining Analytics</strong> - Track network hashrate and difficulty</li>
-                                <li><strong>💰 Market Data</strong> - Real-time price, volume, and market cap</li>
-                                <li><strong>📱 Social Insights</strong> - Community sentiment and trends</li>
-                                <li><strong>📊 Interactive Charts</strong> - Beautiful data visualizations</li>
-                            </ul>
-                        </div>
-                        
-                        <div style="text-align: center; margin: 30px 0;">
-                            <a href="{self.domain}" class="button">🔥 Start Exploring Analytics</a>
-                        </div>
-                        
-                        <p>Thank you for choosing Kaspa Analytics!</p>
-                        
-                        <p>Best regards,<br>
-                        <strong>The Kaspa Analytics Team</strong></p>
-                    </div>
-                    <div class="footer">
-                        <p><strong>© 2025 Kaspa Analytics</strong></p>
-                        <p>Advanced Cryptocurrency Analytics Platform</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_content = f"""
-            Welcome to Kaspa Analytics!
-            
-            Hello {username},
-            
-            Welcome to Kaspa Analytics! We're excited to have you join our community.
-            
-            Start exploring: {self.domain}
-            
-            © 2025 Kaspa Analytics
-            """
-            
-            return self._send_email(to_email, username, "Welcome to Kaspa Analytics!", html_content, text_content)
-            
+
+            return self._send_template('welcome', to_email, username, idempotency_key)
+
         except Exception as e:
             st.write(f"Debug: Error sending welcome email: {e}")
             return self.simulate_email(to_email, None, username, "welcome")
-    
-    def send_cancellation_email(self, to_email, username):
+
+    def send_cancellation_email(self, to_email, username, idempotency_key=None):
         """Send subscription cancellation confirmation email"""
         try:
             if not self.mailjet:
                 st.write("Debug: Mailjet not configured, simulating cancellation email...")
                 return self.simulate_email(to_email, None, username, "cancellation")
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>Subscription Cancelled - Kaspa Analytics</title>
-            </head>
-            <body>
-                <h1>Subscription Cancelled</h1>
-                <p>Hello {username},</p>
-                <p>We've successfully processed your premium subscription cancellation request.</p>
-                <p>You'll keep premium access until your current billing period ends.</p>
-                <p><a href="{self.domain}">Continue Using Free Features</a></p>
-            </body>
-            </html>
-            """
-            
-            text_content = f"""
-            Subscription Cancelled - Kaspa Analytics
-            
-            Hello {username},
-            
-            We've successfully processed your premium subscription cancellation request.
-            You'll keep premium access until your current billing period ends.
-            
-            Continue using: {self.domain}
-            
-            © 2025 Kaspa Analytics
-            """
-            
-            return self._send_email(to_email, username, "Subscription Cancelled - Kaspa Analytics", html_content, text_content)
-            
+
+            return self._send_template('cancellation', to_email, username, idempotency_key)
+
         except Exception as e:
             st.write(f"Debug: Error sending cancellation email: {e}")
             return self.simulate_email(to_email, None, username, "cancellation")
-    
-    def send_premium_subscription_email(self, to_email, username, plan_type="Premium"):
+
+    def send_premium_subscription_email(self, to_email, username, plan_type="Premium", idempotency_key=None):
         """Send premium subscription confirmation email"""
         try:
             if not self.mailjet:
                 st.write("Debug: Mailjet not configured, simulating premium subscription email...")
                 return self.simulate_email(to_email, None, username, "premium_subscription")
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>Welcome to Premium - Kaspa Analytics</title>
-                <style>
-                    body {{ 
-                        font-family: Arial, sans-serif; 
-                        line-height: 1.6; 
-                        color: #333; 
-                        margin: 0;
-                        padding: 20px;
-                        background-color: #f4f4f4;
-                    }}
-                    .container {{ 
-                        max-width: 600px; 
-                        margin: 0 auto; 
-                        background: white;
-                        border-radius: 10px;
-                        overflow: hidden;
-                        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-                    }}
-                    .header {{ 
-                        background: linear-gradient(135deg, #ffd700 0%, #ffed4e 100%); 
-                        color: #333; 
-                        padding: 40px 30px; 
-                        text-align: center; 
-                    }}
-                    .content {{ 
-                        padding: 40px 30px; 
-                    }}
-                    .button {{ 
-                        display: inline-block; 
-                        background: #667eea;
-                        color: white; 
-                        padding: 15px 30px; 
-                        text-decoration: none; 
-                        border-radius: 8px; 
-                        margin: 20px 0;
-                        font-weight: bold;
-                    }}
-                    .feature-box {{
-                        background: #fff3cd;
-                        border: 1px solid #ffeaa7;
-                        padding: 20px;
-                        margin: 20px 0;
-                        border-radius: 8px;
-                        border-left: 4px solid #ffd700;
-                    }}
-                    .footer {{ 
-                        background: #f8f9fa;
-                        text-align: center; 
-                        padding: 30px; 
-                        color: #666; 
-                        font-size: 14px; 
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>👑 Welcome to Premium!</h1>
-                        <h2>Kaspa Analytics Premium Activated</h2>
-                        <p style="font-size: 18px; margin: 0;">Thank you for upgrading, {username}!</p>
-                    </div>
-                    <div class="content">
-                        <p>Hello <strong>{username}</strong>,</p>
-                        
-                        <p>🎉 <strong>Congratulations!</strong> Your {plan_type} subscription has been successfully activated.</p>
-                        
-                        <div class="feature-box">
-                            <h3>🚀 Your Premium Features Are Now Active:</h3>
-                            <ul>
-                                <li><strong>🤖 AI-Powered Insights</strong> - Machine learning market predictions</li>
-                                <li><strong>🐋 Whale Tracking</strong> - Monitor large holder transactions</li>
-                                <li><strong>🔔 Custom Alerts</strong> - Get notified of important events</li>
-                                <li><strong>📈 Advanced Charts</strong> - Professional trading tools</li>
-                                <li><strong>📊 Data Export</strong> - Download data in CSV/PDF format</li>
-                                <li><strong>💎 Priority Support</strong> - Get help when you need it most</li>
-                            </ul>
-                        </div>
-                        
-                        <div style="text-align: center; margin: 30px 0;">
-                            <a href="{self.domain}" class="button">🔬 Explore Premium Analytics</a>
-                        </div>
-                        
-                        <p>Thank you for choosing Kaspa Analytics Premium!</p>
-                        
-                        <p>Best regards,<br>
-                        <strong>The Kaspa Analytics Team</strong></p>
-                    </div>
-                    <div class="footer">
-                        <p><strong>© 2025 Kaspa Analytics</strong></p>
-                        <p>Advanced Cryptocurrency Analytics Platform</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_content = f"""
-            Welcome to Premium - Kaspa Analytics!
-            
-            Hello {username},
-            
-            Congratulations! Your {plan_type} subscription has been successfully activated.
-            All premium features are now available to you.
-            
-            Start exploring: {self.domain}
-            
-            © 2025 Kaspa Analytics
-            """
-            
-            return self._send_email(to_email, username, "Welcome to Premium - Kaspa Analytics!", html_content, text_content)
-            
+
+            return self._send_template('premium_subscription', to_email, username, idempotency_key, plan_type=plan_type)
+
         except Exception as e:
             st.write(f"Debug: Error sending premium subscription email: {e}")
             return self.simulate_email(to_email, None, username, "premium_subscription")
 
-    def send_renewal_notification_email(self, to_email, username, plan_type, new_expiry_date):
+    def send_renewal_notification_email(self, to_email, username, plan_type, new_expiry_date, idempotency_key=None):
         """Send automatic renewal notification email"""
         try:
             if not self.mailjet:
                 st.write("Debug: Mailjet not configured, simulating renewal notification email...")
                 return self.simulate_email(to_email, None, username, "renewal_notification")
-            
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>Subscription Renewed - Kaspa Analytics</title>
-                <style>
-                    body {{ 
-                        font-family: Arial, sans-serif; 
-                        line-height: 1.6; 
-                        color: #333; 
-                        margin: 0;
-                        padding: 20px;
-                        background-color: #f4f4f4;
-                    }}
-                    .container {{ 
-                        max-width: 600px; 
-                        margin: 0 auto; 
-                        background: white;
-                        border-radius: 10px;
-                        overflow: hidden;
-                        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-                    }}
-                    .header {{ 
-                        background: linear-gradient(135deg, #28a745 0%, #20c997 100%); 
-                        color: white; 
-                        padding: 40px 30px; 
-                        text-align: center; 
-                    }}
-                    .content {{ 
-                        padding: 40px 30px; 
-                    }}
-                    .button {{ 
-                        display: inline-block; 
-                        background: #667eea;
-                        color: white; 
-                        padding: 15px 30px; 
-                        text-decoration: none; 
-                        border-radius: 8px; 
-                        margin: 20px 0;
-                        font-weight: bold;
-                    }}
-                    .success-box {{
-                        background: #d4edda;
-                        border: 1px solid #c3e6cb;
-                        color: #155724;
-                        padding: 20px;
-                        margin: 20px 0;
-                        border-radius: 8px;
-                        border-left: 4px solid #28a745;
-                    }}
-                    .info-box {{
-                        background: #e9ecef;
-                        border: 1px solid #ced4da;
-                        padding: 20px;
-                        margin: 20px 0;
-                        border-radius: 8px;
-                    }}
-                    .footer {{ 
-                        background: #f8f9fa;
-                        text-align: center; 
-                        padding: 30px; 
-                        color: #666; 
-                        font-size: 14px; 
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🎉 Subscription Renewed!</h1>
-                        <h2>Kaspa Analytics Premium</h2>
-                        <p style="font-size: 18px; margin: 0;">Your premium access continues seamlessly</p>
-                    </div>
-                    <div class="content">
-                        <p>Hello <strong>{username}</strong>,</p>
-                        
-                        <div class="success-box">
-                            <h3>✅ Your {plan_type} subscription has been automatically renewed!</h3>
-                            <p><strong>🗓️ Your premium access is now extended until: {new_expiry_date}</strong></p>
-                        </div>
-                        
-                        <p>Great news! We've successfully processed your subscription renewal. You can continue enjoying all premium features without any interruption.</p>
-                        
-                        <div class="info-box">
-                            <h3>📊 Your Premium Features Continue:</h3>
-                            <ul>
-                                <li><strong>🤖 AI-Powered Insights</strong> - Advanced market predictions</li>
-                                <li><strong>🐋 Whale Tracking</strong> - Monitor large transactions</li>
-                                <li><strong>🔔 Custom Alerts</strong> - Real-time notifications</li>
-                                <li><strong>📈 Advanced Charts</strong> - Professional trading tools</li>
-                                <li><strong>📊 Data Export</strong> - Download your analytics</li>
-                                <li><strong>💎 Priority Support</strong> - Get help when needed</li>
-                            </ul>
-                        </div>
-                        
-                        <div style="text-align: center; margin: 30px 0;">
-                            <a href="{self.domain}" class="button">🚀 Continue Using Premium</a>
-                        </div>
-                        
-                        <h3>💳 Billing Information:</h3>
-                        <ul>
-                            <li><strong>Plan:</strong> {plan_type}</li>
-                            <li><strong>Status:</strong> Active & Auto-Renewing</li>
-                            <li><strong>Next Renewal:</strong> {new_expiry_date}</li>
-                            <li><strong>Billing:</strong> Automatic</li>
-                        </ul>
-                        
-                        <hr style="margin: 30px 0;">
-                        
-                        <h3>🔧 Need to Make Changes?</h3>
-                        <p>You can manage your subscription, update payment methods, or cancel anytime from your account dashboard.</p>
-                        
-                        <div style="text-align: center; margin: 20px 0;">
-                            <a href="{self.domain}/A_👤_Account" class="button" style="background: #6c757d;">⚙️ Manage Subscription</a>
-                        </div>
-                        
-                        <p>Thank you for being a valued Kaspa Analytics Premium member!</p>
-                        
-                        <p>Best regards,<br>
-                        <strong>The Kaspa Analytics Team</strong></p>
-                    </div>
-                    <div class="footer">
-                        <p><strong>© 2025 Kaspa Analytics</strong></p>
-                        <p>Advanced Cryptocurrency Analytics Platform</p>
-                        <p style="margin-top: 16px; opacity: 0.7;">You received this email because your subscription was automatically renewed.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_content = f"""
-            Subscription Renewed - Kaspa Analytics!
-            
-            Hello {username},
-            
-            Great news! Your {plan_type} subscription has been automatically renewed.
-            Your premium access is now extended until: {new_expiry_date}
-            
-            Continue using premium: {self.domain}
-            Manage subscription: {self.domain}/A_👤_Account
-            
-            © 2025 Kaspa Analytics
-            """
-            
-            return self._send_email(to_email, username, "Subscription Renewed - Kaspa Analytics", html_content, text_content)
-            
+
+            return self._send_template('renewal_notification', to_email, username, idempotency_key,
+                                       plan_type=plan_type, new_expiry_date=new_expiry_date)
+
         except Exception as e:
             st.write(f"Debug: Error sending renewal notification email: {e}")
             return self.simulate_email(to_email, None, username, "renewal_notification")
-    
-    def _send_email(self, to_email, username, subject, html_content, text_content):
-        """Helper method to send email via Mailjet"""
+
+    def _send_email(self, to_email, username, subject, html_content, text_content, idempotency_key=None):
+        """Queue the email in the outbox; the background worker delivers it.
+        Callers that may repeat themselves (page reruns, retried jobs) pass a
+        stable idempotency_key so the message is only sent once."""
         try:
-            data = {
-                'Messages': [
-                    {
-                        "From": {
-                            "Email": self.from_email,
-                            "Name": self.from_name
-                        },
-                        "To": [
-                            {
-                                "Email": to_email,
-                                "Name": username
-                            }
-                        ],
-                        "Subject": subject,
-                        "TextPart": text_content,
-                        "HTMLPart": html_content
-                    }
-                ]
-            }
-            
-            result = self.mailjet.send.create(data=data)
-            
-            if result.status_code == 200:
-                st.write(f"Debug: Email sent successfully via Mailjet! Status: {result.status_code}")
-                return True
+            # Import here to avoid circular imports
+            from services import get_database
+            from email_outbox import start_outbox_worker
+            
+            db = get_database()
+            key = idempotency_key or uuid.uuid4().hex
+            if db.enqueue_email(key, to_email, username, subject, text_content, html_content):
+                start_outbox_worker(db).wake()
+                st.write(f"Debug: Email queued for delivery: {subject}")
             else:
-                st.write(f"Debug: Mailjet API error: {result.status_code}")
-                return False
+                st.write(f"Debug: Email already queued (key {key[:16]}...)")
+            return True
             
         except Exception as e:
             st.write(f"Debug: Error in _send_email: {e}")
@@ -606,3 +179,158 @@ class EmailHandler:
             """)
         
         return True
+
+
+class BulkEmailSender:
+    """
+    Campaign sender for large audiences (renewal reminders, digests, announcements).
+
+    Recipients are streamed from the users table, packed up to Mailjet's
+    per-call limit (50 messages) into each request, and the requests run on
+    a small thread pool under a shared rate limit. Every recipient's result
+    is stored in email_campaign_results; the campaign's checkpoint only
+    moves past a batch once it and every batch before it are recorded, so a
+    crashed run resumes where it left off without mailing anyone twice
+    (beyond the batches that were in flight at the crash).
+    """
+
+    def __init__(self, db, sender=None, batch_size=None, max_workers=None, requests_per_second=None, max_attempts=3):
+        from email_outbox import MailjetSender, get_sender
+        from rate_limiter import RateLimiter
+        self.db = db
+        self.sender = sender or get_sender()
+        self.batch_size = min(MailjetSender.MAX_MESSAGES_PER_CALL,
+                              int(batch_size or os.getenv('EMAIL_BULK_BATCH_SIZE', '50')))
+        self.max_workers = int(max_workers or os.getenv('EMAIL_BULK_WORKERS', '4'))
+        self.rate_limiter = RateLimiter(float(requests_per_second or os.getenv('EMAIL_BULK_RPS', '10')))
+        self.max_attempts = max_attempts
+
+    def _send_batch(self, campaign_id, template, recipients):
+        """Send one batch; returns [(user_id, status, error)]"""
+        rendered = template.render_batch(
+            {'name': name, 'username': username, 'email': email}
+            for _, username, email, name in recipients
+        )
+        messages = [
+            self.sender.build_message(
+                email, name, subject, text_part, html_part,
+                custom_id=f"{campaign_id}:{user_id}", campaign=campaign_id
+            )
+            for (user_id, username, email, name), (subject, text_part, html_part) in zip(recipients, rendered)
+        ]
+
+        for attempt in range(1, self.max_attempts + 1):
+            self.rate_limiter.wait()
+            sent, errors, retryable = self.sender.send_many(messages)
+            if not retryable or attempt == self.max_attempts:
+                break
+            time.sleep(2 ** attempt)
+
+        return [
+            (recipient[0], 'sent' if ok else 'failed', error)
+            for recipient, ok, error in zip(recipients, sent, errors)
+        ]
+
+    def send_campaign(self, campaign_id, subject, text_template, html_template=None, audience='premium'):
+        """
+        Send (or resume) a campaign. Templates use $name, $username and $email.
+        Returns a report with counts and throughput.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from email_templates import EmailTemplate
+
+        started = time.perf_counter()
+        # Parsed once for the whole campaign, not once per recipient
+        template = EmailTemplate(subject, text_template, html_template, dollar=True)
+        campaign = self.db.start_campaign(campaign_id, subject, audience)
+        if campaign['audience'] != audience:
+            logger.warning("Campaign %s was started for audience %r; resuming with it, not %r",
+                           campaign_id, campaign['audience'], audience)
+        # A resumed campaign keeps the audience it started with, so the checkpoint means the same thing
+        audience = campaign['audience']
+        checkpoint = campaign['last_user_id']
+        already_sent = self.db.get_campaign_sent_ids(campaign_id, checkpoint)
+        report = {'campaign_id': campaign_id, 'audience': audience, 'resumed_from': checkpoint, 'skipped': len(already_sent),
+                  'sent': 0, 'failed': 0, 'requests': 0}
+
+        # Batches in submission order: [last_user_id, future, recorded]
+        in_flight = []
+        max_in_flight = self.max_workers * 2
+
+        def record_completed():
+            """Wait for at least one batch, store its results and advance the checkpoint"""
+            done, _ = wait([entry[1] for entry in in_flight if not entry[2]], return_when=FIRST_COMPLETED)
+            results = []
+            for entry in in_flight:
+                if entry[1] in done:
+                    entry[2] = True
+                    results.extend(entry[1].result())
+                    report['requests'] += 1
+            # Checkpoint = last id of the longest prefix of recorded batches
+            new_checkpoint = None
+            while in_flight and in_flight[0][2]:
+                new_checkpoint = in_flight.pop(0)[0]
+            self.db.record_campaign_results(campaign_id, results, new_checkpoint)
+            for _, status, _ in results:
+                report['sent' if status == 'sent' else 'failed'] += 1
+
+        def outstanding():
+            return sum(1 for entry in in_flight if not entry[2])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bulk-email') as pool:
+            batch = []
+
+            def submit(batch):
+                future = pool.submit(self._send_batch, campaign_id, template, batch)
+                in_flight.append([batch[-1][0], future, False])
+
+            for recipient in self.db.iter_campaign_recipients(audience, checkpoint):
+                if recipient[0] in already_sent:
+                    continue
+                batch.append(recipient)
+                if len(batch) == self.batch_size:
+                    submit(batch)
+                    batch = []
+                    # Backpressure: never more than a couple of batches per worker in memory
+                    while outstanding() >= max_in_flight:
+                        record_completed()
+            if batch:
+                submit(batch)
+            while outstanding():
+                record_completed()
+
+        self.db.finish_campaign(campaign_id)
+        report['seconds'] = time.perf_counter() - started
+        report['messages_per_second'] = (report['sent'] + report['failed']) / report['seconds'] if report['seconds'] else 0
+        return report
+
+
+def main(argv=None):
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description="Send (or resume) a bulk email campaign")
+    parser.add_argument('campaign_id', help="unique campaign name; re-running it resumes from its checkpoint")
+    parser.add_argument('--subject', required=True)
+    parser.add_argument('--text-file', required=True, help="plain-text template ($name, $username, $email)")
+    parser.add_argument('--html-file', help="HTML template")
+    parser.add_argument('--audience', choices=['premium', 'all'], default='premium')
+    parser.add_argument('--rps', type=float, help="Mailjet requests per second (default EMAIL_BULK_RPS or 10)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    from database import Database
+    with open(args.text_file) as f:
+        text_template = f.read()
+    html_template = None
+    if args.html_file:
+        with open(args.html_file) as f:
+            html_template = f.read()
+
+    sender = BulkEmailSender(Database(), requests_per_second=args.rps)
+    print(sender.send_campaign(args.campaign_id, args.subject, text_template, html_template, args.audience))
+
+
+if __name__ == '__main__':
+    main()
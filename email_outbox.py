@@ -0,0 +1,257 @@
+"""
+Background delivery of queued email.
+
+EmailHandler writes messages to the email_outbox table and returns
+straight away; an OutboxWorker thread claims due messages in batches and
+sends them through Mailjet. Failures are retried with exponential backoff
+and jitter; after EMAIL_MAX_ATTEMPTS a message is marked 'dead' and left
+in the table for inspection.
+
+MAILJET_API_URL points the sender at a local stand-in instead of
+https://api.mailjet.com/ (same idea as stripe_reconcile's --api-base).
+
+    python email_outbox.py --drain     # send everything that is due, then exit
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    """Read an outbox setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+class MailjetSender:
+    """Sends one outbox message per Mailjet v3.1 call. Returns (sent, error, retryable)."""
+
+    def __init__(self, api_key, api_secret, from_email, from_name, api_url=None, timeout=15):
+        from mailjet_rest import Client
+        kwargs = {'api_url': api_url} if api_url else {}
+        self.client = Client(auth=(api_key, api_secret), version='v3.1', timeout=timeout, **kwargs)
+        self.from_email = from_email
+        self.from_name = from_name
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            _setting('MAILJET_API_KEY', None),
+            _setting('MAILJET_API_SECRET', None),
+            _setting('RESET_EMAIL_FROM', None),
+            _setting('RESET_EMAIL_FROM_NAME', 'Kaspa Analytics'),
+            api_url=_setting('MAILJET_API_URL', None)
+        )
+
+    # Mailjet's Send API v3.1 accepts at most this many messages per call
+    MAX_MESSAGES_PER_CALL = 50
+
+    def build_message(self, to_email, to_name, subject, text_part, html_part, custom_id=None, campaign=None):
+        message = {
+            "From": {
+                "Email": self.from_email,
+                "Name": self.from_name
+            },
+            "To": [
+                {
+                    "Email": to_email,
+                    "Name": to_name
+                }
+            ],
+            "Subject": subject,
+            "TextPart": text_part,
+            "HTMLPart": html_part
+        }
+        if custom_id:
+            # Mailjet echoes this back; lets a delivery be traced to its row
+            message["CustomID"] = custom_id[:64]
+        if campaign:
+            message["CustomCampaign"] = campaign
+        return message
+
+    def send(self, message):
+        sent, error, retryable = self.send_many([self.build_message(
+            message['to_email'], message['to_name'], message['subject'],
+            message['text_part'], message['html_part'], custom_id=message['idempotency_key']
+        )])
+        return sent[0], error[0], retryable
+
+    def send_many(self, messages):
+        """
+        Send up to MAX_MESSAGES_PER_CALL messages in one request.
+        Returns ([sent per message], [error per message], retryable) where
+        retryable says whether the whole call failed in a way worth retrying.
+        """
+        count = len(messages)
+        try:
+            result = self.client.send.create(data={'Messages': messages})
+        except Exception as e:
+            # Newer mailjet_rest versions raise on HTTP errors instead of returning the response
+            status = getattr(e, 'status_code', None)
+            per_message = _per_message_results(getattr(e, 'response_body', None), count)
+            if per_message:
+                return per_message[0], per_message[1], False
+            return [False] * count, [str(e)[:500]] * count, status is None or _retryable(status)
+
+        if result.status_code == 200:
+            return [True] * count, [None] * count, False
+        per_message = _per_message_results(result.text, count)
+        if per_message:
+            return per_message[0], per_message[1], False
+        error = f"Mailjet API error {result.status_code}: {result.text[:500]}"
+        return [False] * count, [error] * count, _retryable(result.status_code)
+
+
+def _per_message_results(body, count):
+    """
+    A v3.1 call with some invalid messages answers 400 with one status per
+    message; returns ([sent], [error]) from such a body, or None.
+    """
+    try:
+        results = json.loads(body)['Messages']
+    except Exception:
+        return None
+    if len(results) != count:
+        return None
+    sent = [result.get('Status') == 'success' for result in results]
+    errors = [
+        None if ok else '; '.join(error.get('ErrorMessage', '') for error in result.get('Errors', []))[:500]
+        for ok, result in zip(sent, results)
+    ]
+    return sent, errors
+
+
+def _retryable(status_code):
+    # 4xx other than throttling means the message itself is bad; retrying won't help
+    return status_code == 429 or status_code >= 500
+
+
+class OutboxWorker(threading.Thread):
+    """Process-wide thread that drains the email outbox"""
+
+    def __init__(self, db, sender=None, poll_seconds=None, batch_size=None, max_attempts=None,
+                 base_backoff_seconds=None, lease_seconds=None):
+        super().__init__(name='email-outbox', daemon=True)
+        self.db = db
+        self.sender = sender
+        self.poll_seconds = float(poll_seconds or _setting('EMAIL_POLL_SECONDS', 10))
+        self.batch_size = int(batch_size or _setting('EMAIL_BATCH_SIZE', 20))
+        self.max_attempts = int(max_attempts or _setting('EMAIL_MAX_ATTEMPTS', 6))
+        self.base_backoff_seconds = float(base_backoff_seconds or _setting('EMAIL_BACKOFF_SECONDS', 30))
+        # A message claimed by a worker that died is retried after this long
+        self.lease_seconds = float(lease_seconds or _setting('EMAIL_LEASE_SECONDS', 300))
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    def backoff(self, attempts):
+        """Exponential backoff with full jitter, capped at an hour"""
+        return random.uniform(0, min(3600.0, self.base_backoff_seconds * 2 ** (attempts - 1)))
+
+    def wake(self):
+        """Ask for an immediate pass (called after a message is queued)"""
+        self._wake.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            # Cleared before draining, so a wake() that lands mid-drain triggers another pass
+            self._wake.clear()
+            try:
+                while self.run_once() and not self._stop_event.is_set():
+                    pass
+            except Exception as e:
+                logger.exception("Email outbox pass failed: %s", e)
+            self._wake.wait(self.poll_seconds)
+
+    def run_once(self):
+        """Send one batch of due messages. Returns the number of messages claimed."""
+        messages = self.db.claim_outbox_batch(self.batch_size, self.lease_seconds)
+        if not messages:
+            return 0
+        if self.sender is None:
+            self.sender = get_sender()
+
+        for message in messages:
+            sent, error, retryable = self.sender.send(message)
+            if sent:
+                self.db.complete_outbox_message(message['id'], True)
+            elif retryable and message['attempts'] < self.max_attempts:
+                retry_at = time.time() + self.backoff(message['attempts'])
+                logger.warning("Email %s to %s failed (attempt %d), retrying: %s",
+                               message['id'], message['to_email'], message['attempts'], error)
+                self.db.complete_outbox_message(message['id'], False, error, retry_at)
+            else:
+                logger.error("Email %s to %s dead-lettered after %d attempts: %s",
+                             message['id'], message['to_email'], message['attempts'], error)
+                self.db.complete_outbox_message(message['id'], False, error)
+        return len(messages)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """Process-wide MailjetSender, so its client (and HTTP connections) are reused"""
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                _sender = MailjetSender.from_settings()
+    return _sender
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_outbox_worker(db):
+    """
+    Start the process-wide outbox worker once; later calls are no-ops.
+    Called at process start (Home, the webhook sidecar) so messages queued
+    before a restart are delivered without waiting for a new send.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = OutboxWorker(db)
+            _worker.start()
+        return _worker
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send queued email from the outbox")
+    parser.add_argument('--drain', action='store_true', help="send everything that is due, then exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    from database import Database
+    db = Database()
+    worker = OutboxWorker(db)
+    if args.drain:
+        while worker.run_once():
+            pass
+    else:
+        worker.run()
+    print(db.get_outbox_stats())
+
+
+if __name__ == '__main__':
+    main()
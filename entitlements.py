@@ -0,0 +1,125 @@
+"""
+Signed entitlement tokens for premium gating.
+
+Login and payment success issue a short-lived HS256 token holding the
+user, tier and premium expiry. Every page verifies it in-process (no I/O)
+through ``current_entitlement()``, which is called from add_navigation();
+the database is only read again when the token is about to expire.
+"""
+import logging
+import os
+import secrets
+import time
+from datetime import datetime
+
+import jwt
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'entitlement'
+ALGORITHM = 'HS256'
+
+
+def _setting(name, default):
+    """Read an entitlement setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+TOKEN_TTL_SECONDS = int(_setting('ENTITLEMENT_TTL_SECONDS', 900))
+# Tokens this close to expiry are re-issued from the database
+REFRESH_BEFORE_SECONDS = int(_setting('ENTITLEMENT_REFRESH_SECONDS', 60))
+
+# Tokens never leave the server (they live in session_state), so a per-process
+# key is enough when none is configured; sessions just refresh after a restart
+_SECRET = _setting('ENTITLEMENT_SECRET', None) or secrets.token_hex(32)
+
+
+def issue_token(username, is_premium, premium_expires_at=None, ttl=None):
+    """Sign an entitlement token. A premium token never outlives the subscription."""
+    now = int(time.time())
+    expires = now + int(ttl or TOKEN_TTL_SECONDS)
+    premium_until = None
+    if is_premium and premium_expires_at:
+        premium_until = int(premium_expires_at.timestamp())
+        expires = max(now + 1, min(expires, premium_until))
+    claims = {
+        'sub': username,
+        'tier': 'premium' if is_premium else 'free',
+        'pexp': premium_until,
+        'iat': now,
+        'exp': expires
+    }
+    return jwt.encode(claims, _SECRET, algorithm=ALGORITHM)
+
+
+def verify_token(token):
+    """Return the token's claims, or None if it is missing, forged or expired"""
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, _SECRET, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+
+def premium_expiry(claims):
+    """Premium expiry from the claims as a naive local datetime (None for lifetime or free)"""
+    if not claims or not claims.get('pexp'):
+        return None
+    return datetime.fromtimestamp(claims['pexp'])
+
+
+def _store(claims, token):
+    st.session_state[SESSION_KEY] = token
+    # Kept in step for the pages that read these keys directly
+    st.session_state['is_premium'] = claims['tier'] == 'premium'
+    expires = premium_expiry(claims)
+    st.session_state['premium_expires_at'] = expires.isoformat() if expires else None
+
+
+def grant(username, profile):
+    """Issue a token from a session profile (login, payment) and store it in the session"""
+    token = issue_token(username, profile['is_premium'], profile.get('premium_expires_at'))
+    claims = verify_token(token)
+    _store(claims, token)
+    return claims
+
+
+def current_entitlement():
+    """
+    Verified claims for the signed-in user, or None for guests.
+    Re-reads the profile from the database only when the token is
+    missing, invalid or within REFRESH_BEFORE_SECONDS of expiry.
+    """
+    username = st.session_state.get('username')
+    if not st.session_state.get('authentication_status') or not username:
+        return None
+
+    claims = verify_token(st.session_state.get(SESSION_KEY))
+    if claims and claims['sub'] == username and claims['exp'] - time.time() > REFRESH_BEFORE_SECONDS:
+        return claims
+
+    try:
+        # Import here so guests never build the database service
+        from services import get_database
+        profile = get_database().load_session_profile(username)
+    except Exception as e:
+        logger.warning("Could not refresh entitlement for %s: %s", username, e)
+        profile = None
+
+    if profile is None:
+        # Keep a still-valid token rather than dropping premium on a DB hiccup
+        if claims and claims['sub'] == username:
+            return claims
+        _store({'tier': 'free', 'pexp': None}, None)
+        return None
+    return grant(username, profile)
+
+
+def has_premium():
+    claims = current_entitlement()
+    return bool(claims) and claims['tier'] == 'premium'
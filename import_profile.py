@@ -0,0 +1,106 @@
+"""
+Import-time profile of the Streamlit page scripts.
+
+Runs each page in a fresh interpreter under ``python -X importtime`` and
+reports the cumulative import time of every top-level module the page
+pulls in. Streamlit itself is imported before the page starts (the
+server already has it loaded), so only the page's own imports count.
+
+    python import_profile.py                 # all pages, default budget
+    python import_profile.py --budget-ms 400 pages/0_🔑_Login.py
+
+Exits with status 1 when any page's cold import time is over budget.
+tests/test_import_budget.py runs the same check under pytest.
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BUDGET_MS = float(os.getenv('IMPORT_BUDGET_MS', '500'))
+
+# Runs inside the child interpreter. The marker separates streamlit's own
+# (already paid for) imports from the page's.
+_RUNNER = '''
+import sys, runpy, logging
+sys.path.insert(0, {root!r})
+import streamlit
+logging.disable(logging.WARNING)
+sys.stderr.write("--- page imports start ---\\n")
+sys.stderr.flush()
+try:
+    runpy.run_path({page!r}, run_name="__main__")
+except BaseException:
+    pass
+'''
+
+
+def import_times(page):
+    """[(module, cumulative microseconds, depth)] for one page's cold imports, depth 0 = top level"""
+    with tempfile.TemporaryDirectory() as workdir:
+        # Run from a scratch directory so the page's SQLite file lands there
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', _RUNNER.format(root=ROOT, page=os.path.abspath(page))],
+            cwd=workdir, capture_output=True, text=True
+        )
+
+    imports = []
+    started = False
+    for line in result.stderr.splitlines():
+        if line.startswith('--- page imports start ---'):
+            started = True
+            continue
+        if not started or not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # The package column is indented two spaces per nesting level after the first
+        name = parts[2]
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), int(parts[1]), depth))
+    return imports
+
+
+def profile_page(page):
+    """Return {top-level module: cumulative microseconds} for one page's cold imports"""
+    modules = {}
+    for name, micros, depth in import_times(page):
+        if depth == 0:
+            modules[name] = modules.get(name, 0) + micros
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile cold import time of the page scripts")
+    parser.add_argument('pages', nargs='*', help="page scripts (default: Home.py and pages/*.py)")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="maximum cold import time per page (default: IMPORT_BUDGET_MS or 500)")
+    parser.add_argument('--top', type=int, default=10, help="modules to list per page")
+    args = parser.parse_args(argv)
+
+    pages = args.pages or [os.path.join(ROOT, 'Home.py')] + sorted(glob.glob(os.path.join(ROOT, 'pages', '*.py')))
+
+    over_budget = []
+    for page in pages:
+        modules = profile_page(page)
+        total_ms = sum(modules.values()) / 1000
+        status = 'OK' if total_ms <= args.budget_ms else 'OVER BUDGET'
+        print(f"{os.path.basename(page)}: {total_ms:.0f} ms cold imports ({status}, budget {args.budget_ms:.0f} ms)")
+        for name, micros in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {micros / 1000:8.1f} ms  {name}")
+        if total_ms > args.budget_ms:
+            over_budget.append(page)
+
+    if over_budget:
+        print(f"{len(over_budget)} page(s) over the import budget")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
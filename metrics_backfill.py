@@ -0,0 +1,301 @@
+"""
+Historical backfill for metric_points.
+
+Splits a date range into fixed chunks and fetches them concurrently with a
+bounded pool of workers. Each chunk is upserted in one large batch
+(MetricStore.upsert_bulk: COPY on Postgres, executemany on SQLite) and then
+checkpointed in backfill_chunks, so rerunning the same command after a crash
+skips every chunk already done and retries the failed ones. Chunks are
+aligned to multiples of the chunk size, so a later run over a wider range
+reuses the checkpoints too.
+
+    coingecko   price, market cap and 24h volume history (PRICE_HISTORY_URL)
+    replay      a recording (metrics_ingest.py --record format) tiled across the range; no network
+
+    python metrics_backfill.py                                    # coingecko, genesis to now
+    python metrics_backfill.py --replay fixtures/kaspa_sample.jsonl --workers 8
+    python metrics_backfill.py --status --replay fixtures/kaspa_sample.jsonl
+
+A new source is a HistorySource subclass added to HISTORY_SOURCES.
+"""
+import argparse
+import asyncio
+import calendar
+import json
+import logging
+import os
+import random
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+import streamlit as st
+
+from metrics_ingest import get_json, http_session, read_recording
+from metrics_store import MetricStore, DAY
+
+logger = logging.getLogger(__name__)
+
+# Kaspa mainnet launch, 2021-11-07 00:00 UTC
+GENESIS = 1636243200
+
+
+def _setting(name, default):
+    """Read a backfill setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+class HistorySource:
+    """Something that can return every (metric, ts, value) point with start <= ts < end"""
+    name = None
+    uses_http = False
+    # Chunk size used unless one is given
+    chunk_seconds = 7 * DAY
+
+    async def fetch_range(self, session, start, end):
+        raise NotImplementedError
+
+
+class CoinGeckoHistory(HistorySource):
+    """KAS/USD price, market cap and 24h volume from CoinGecko's market_chart/range"""
+    name = 'coingecko'
+    uses_http = True
+    # CoinGecko returns hourly points for ranges up to 90 days and daily points beyond
+    chunk_seconds = 90 * DAY
+
+    def __init__(self, url=None):
+        self.url = url or _setting('PRICE_HISTORY_URL', 'https://api.coingecko.com/api/v3/coins/kaspa/market_chart/range')
+
+    async def fetch_range(self, session, start, end):
+        body = await get_json(session, self.url, {'vs_currency': 'usd', 'from': start, 'to': end})
+        points = []
+        for key, metric in (('prices', 'price'), ('market_caps', 'market_cap'), ('total_volumes', 'volume_24h')):
+            for ms, value in body.get(key) or ():
+                ts = int(ms // 1000)
+                if value is not None and start <= ts < end:  # the API's range is inclusive
+                    points.append((metric, ts, value))
+        return points
+
+
+class ReplayHistory(HistorySource):
+    """
+    A recording laid end to end from the epoch, so any range gets points at
+    the recorded spacing; for running and load-testing backfills offline.
+    """
+    uses_http = False
+
+    def __init__(self, path=None):
+        path = path or _setting('INGEST_REPLAY_FILE', 'fixtures/kaspa_sample.jsonl')
+        # Keyed by file, so different recordings keep separate checkpoints
+        self.name = f"replay:{os.path.basename(path)}"[:32]
+        polls = read_recording(path)
+        first, last = polls[0]['ts'], polls[-1]['ts']
+        step = (last - first) // (len(polls) - 1) if len(polls) > 1 else 60
+        self.span = last - first + max(step, 1)
+        points = sorted((poll['ts'] - first, metric, float(value))
+                        for poll in polls for metric, value in poll['values'].items() if value is not None)
+        self.offsets = [offset for offset, _, _ in points]
+        self.points = points
+
+    async def fetch_range(self, session, start, end):
+        points = []
+        for base in range(start - start % self.span, end, self.span):
+            lo = bisect_left(self.offsets, start - base)
+            hi = bisect_left(self.offsets, end - base)
+            points.extend((metric, base + offset, value) for offset, metric, value in self.points[lo:hi])
+        return points
+
+
+HISTORY_SOURCES = {
+    CoinGeckoHistory.name: CoinGeckoHistory,
+}
+
+
+class Backfill:
+    """Fetches one source's history chunk by chunk, checkpointing each in backfill_chunks"""
+
+    def __init__(self, store, source, workers=None, chunk_seconds=None, max_attempts=3, timeout=None):
+        self.store = store
+        self.db = store.db
+        self.source = source
+        self.workers = int(workers or _setting('BACKFILL_WORKERS', '4'))
+        self.chunk_seconds = int(chunk_seconds or source.chunk_seconds)
+        self.max_attempts = max_attempts
+        self.timeout = float(timeout or _setting('BACKFILL_TIMEOUT_SECONDS', '60'))
+        self.stats = {'chunks': 0, 'skipped': 0, 'done': 0, 'failed': 0, 'rows': 0}
+
+    def chunks(self, start, end):
+        """[start, end) split on multiples of chunk_seconds"""
+        bounds = [start] + list(range(start - start % self.chunk_seconds + self.chunk_seconds, end, self.chunk_seconds)) + [end]
+        return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+    def completed_chunks(self, start, end):
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('''
+                    SELECT chunk_start, chunk_end FROM backfill_chunks
+                    WHERE source = %s AND status = 'done' AND chunk_start < %s AND chunk_end > %s
+                ''', (self.source.name, end, start))
+            else:
+                cursor.execute('''
+                    SELECT chunk_start, chunk_end FROM backfill_chunks
+                    WHERE source = ? AND status = 'done' AND chunk_start < ? AND chunk_end > ?
+                ''', (self.source.name, end, start))
+            return {(int(lo), int(hi)) for lo, hi in cursor.fetchall()}
+
+    def record_chunk(self, chunk, status, rows_written, attempts, error=None):
+        """Checkpoint a chunk as 'done' or 'failed' (attempts accumulate across runs)"""
+        row = (self.source.name, chunk[0], chunk[1], status, rows_written, attempts, error, time.time())
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('''
+                    INSERT INTO backfill_chunks
+                        (source, chunk_start, chunk_end, status, rows_written, attempts, error, updated_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (source, chunk_start, chunk_end) DO UPDATE SET
+                        status = EXCLUDED.status, rows_written = EXCLUDED.rows_written,
+                        attempts = backfill_chunks.attempts + EXCLUDED.attempts,
+                        error = EXCLUDED.error, updated_at = EXCLUDED.updated_at
+                ''', row)
+            else:
+                cursor.execute('''
+                    INSERT INTO backfill_chunks
+                        (source, chunk_start, chunk_end, status, rows_written, attempts, error, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (source, chunk_start, chunk_end) DO UPDATE SET
+                        status = excluded.status, rows_written = excluded.rows_written,
+                        attempts = backfill_chunks.attempts + excluded.attempts,
+                        error = excluded.error, updated_at = excluded.updated_at
+                ''', row)
+            conn.commit()
+
+    def status(self):
+        """Chunk counts, rows and time covered per status for this source"""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('''
+                    SELECT status, COUNT(*), SUM(rows_written), MIN(chunk_start), MAX(chunk_end)
+                    FROM backfill_chunks WHERE source = %s GROUP BY status
+                ''', (self.source.name,))
+            else:
+                cursor.execute('''
+                    SELECT status, COUNT(*), SUM(rows_written), MIN(chunk_start), MAX(chunk_end)
+                    FROM backfill_chunks WHERE source = ? GROUP BY status
+                ''', (self.source.name,))
+            return {status: {'chunks': count, 'rows': int(rows or 0), 'from': _iso(lo), 'to': _iso(hi)}
+                    for status, count, rows, lo, hi in cursor.fetchall()}
+
+    async def run(self, start, end):
+        """Backfill [start, end) and return stats, including rows per second"""
+        chunks = self.chunks(int(start), int(end))
+        done = self.completed_chunks(int(start), int(end))
+        pending = [chunk for chunk in chunks if chunk not in done]
+        self.stats.update(chunks=len(chunks), skipped=len(chunks) - len(pending))
+        logger.info("%s: %d chunks, %d already done", self.source.name, len(chunks), self.stats['skipped'])
+
+        queue = asyncio.Queue()
+        for chunk in pending:
+            queue.put_nowait(chunk)
+        # SQLite takes one writer at a time; Postgres gets a write per worker
+        write_slots = asyncio.Semaphore(self.workers if self.db.use_postgres else 1)
+        session = http_session(self.timeout, limit=self.workers) if self.source.uses_http else None
+        self._started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._worker(queue, session, write_slots)
+                                   for _ in range(min(self.workers, len(pending)))))
+        finally:
+            if session is not None:
+                await session.close()
+
+        elapsed = time.perf_counter() - self._started
+        self.stats['seconds'] = round(elapsed, 3)
+        self.stats['rows_per_second'] = round(self.stats['rows'] / elapsed, 1) if elapsed else 0.0
+        return self.stats
+
+    async def _worker(self, queue, session, write_slots):
+        while not queue.empty():
+            await self._backfill_chunk(queue.get_nowait(), session, write_slots)
+
+    async def _backfill_chunk(self, chunk, session, write_slots):
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                points = await asyncio.wait_for(self.source.fetch_range(session, *chunk), self.timeout)
+                async with write_slots:
+                    # The database drivers block, so the upsert runs off the event loop
+                    rows = await asyncio.to_thread(self.store.upsert_bulk, points)
+                await asyncio.to_thread(self.record_chunk, chunk, 'done', rows, attempt)
+            except Exception as e:
+                error = e
+                if attempt < self.max_attempts:
+                    delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+                    logger.warning("Chunk %s failed (%s); retrying in %.1fs", _span(chunk), e, delay)
+                    await asyncio.sleep(delay)
+                continue
+
+            self.stats['done'] += 1
+            self.stats['rows'] += rows
+            elapsed = time.perf_counter() - self._started
+            logger.info("Chunk %s: %d rows (%d/%d chunks, %.0f rows/s)", _span(chunk), rows,
+                        self.stats['done'] + self.stats['skipped'], self.stats['chunks'],
+                        self.stats['rows'] / elapsed if elapsed else 0)
+            return
+
+        self.stats['failed'] += 1
+        logger.error("Chunk %s failed after %d attempts: %s", _span(chunk), self.max_attempts, error)
+        try:
+            await asyncio.to_thread(self.record_chunk, chunk, 'failed', 0, self.max_attempts, str(error))
+        except Exception as e:
+            logger.error("Could not record failed chunk %s: %s", _span(chunk), e)
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc).isoformat() if ts is not None else None
+
+
+def _span(chunk):
+    return f"{_iso(chunk[0])[:10]}..{_iso(chunk[1])[:10]}"
+
+
+def _timestamp(value):
+    """ISO date/time (UTC unless it says otherwise) to epoch seconds"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return calendar.timegm(parsed.timetuple())
+    return int(parsed.timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill metric history into metric_points")
+    parser.add_argument('--source', default='coingecko', choices=sorted(HISTORY_SOURCES))
+    parser.add_argument('--replay', metavar='FILE', help="backfill from a recording instead of --source")
+    parser.add_argument('--start', type=_timestamp, default=GENESIS, help="ISO date (default: 2021-11-07, mainnet launch)")
+    parser.add_argument('--end', type=_timestamp, help="ISO date (default: now)")
+    parser.add_argument('--chunk-days', type=float, help="chunk size (default depends on the source)")
+    parser.add_argument('--workers', type=int, help="concurrent chunks (default BACKFILL_WORKERS or 4)")
+    parser.add_argument('--status', action='store_true', help="show the checkpoint table for the source and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    source = ReplayHistory(args.replay) if args.replay else HISTORY_SOURCES[args.source]()
+    from database import Database
+    backfill = Backfill(MetricStore(Database()), source, workers=args.workers,
+                        chunk_seconds=args.chunk_days * DAY if args.chunk_days else None)
+    if args.status:
+        print(json.dumps(backfill.status(), indent=2))
+        return
+
+    end = args.end or int(time.time())
+    stats = asyncio.run(backfill.run(args.start, end))
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
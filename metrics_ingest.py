@@ -0,0 +1,374 @@
+"""
+Metrics ingestion daemon.
+
+Polls each configured source on its own interval and writes what it reads
+into metric_points through MetricStore, which keeps the rollups current.
+Points from every source go through one queue and are written in batches
+(one insert per flush). HTTP sources share a single aiohttp session, so
+connections are pooled and kept alive, and every poll has a timeout; a
+failing source backs off exponentially with jitter without holding up the
+others.
+
+    kaspa_api   hashrate and difficulty from a Kaspa REST API (KASPA_API_URL)
+    coingecko   price, market cap and 24h volume (PRICE_API_URL)
+    replay      polls recorded with --record, replayed from a file; no network
+
+    python metrics_ingest.py                                  # kaspa_api + coingecko
+    python metrics_ingest.py --record polls.jsonl             # ...and record every poll
+    python metrics_ingest.py --replay fixtures/kaspa_sample.jsonl --speed 60
+    python metrics_ingest.py --replay fixtures/kaspa_sample.jsonl --speed 0 --loop --duration 30
+
+--speed 0 replays as fast as the store accepts points, which with --loop and
+--duration makes a load test of the whole pipeline. A new source is a
+MetricSource subclass added to SOURCES.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import signal
+import time
+
+import streamlit as st
+
+from metrics_store import MetricStore
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    """Read an ingestion setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+def read_recording(path):
+    """Polls from a file written with --record, oldest first"""
+    with open(path, encoding='utf-8') as f:
+        polls = sorted((json.loads(line) for line in f if line.strip()), key=lambda poll: poll['ts'])
+    if not polls:
+        raise ValueError(f"{path} has no recorded polls")
+    return polls
+
+
+def http_session(timeout, limit=20):
+    """aiohttp session with pooled keep-alive connections; create it inside the event loop"""
+    import aiohttp
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        connector=aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300),
+        headers={'User-Agent': 'kaspa-analytics-ingest'},
+    )
+
+
+async def get_json(session, url, params=None):
+    """GET a JSON body over the shared aiohttp session; HTTP errors raise"""
+    async with session.get(url, params=params) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+class MetricSource:
+    """
+    Something to poll. ``fetch`` returns (ts, {metric: value}) for one poll,
+    or None once a finite source has nothing left.
+    """
+    name = None
+    uses_http = False
+
+    def __init__(self, interval=60.0):
+        self.interval = interval
+
+    async def fetch(self, session):
+        raise NotImplementedError
+
+    def next_delay(self):
+        """Seconds to wait after a successful poll"""
+        # Jittered so sources started together don't stay in lockstep
+        return self.interval * random.uniform(0.9, 1.1)
+
+
+class KaspaApiSource(MetricSource):
+    """Network hashrate and difficulty from api.kaspa.org or a self-hosted kaspa-rest-server"""
+    name = 'kaspa_api'
+    uses_http = True
+
+    def __init__(self, base_url=None, interval=None):
+        super().__init__(float(interval or _setting('KASPA_POLL_SECONDS', '60')))
+        self.base_url = (base_url or _setting('KASPA_API_URL', 'https://api.kaspa.org')).rstrip('/')
+
+    async def fetch(self, session):
+        hashrate, blockdag = await asyncio.gather(
+            get_json(session, f"{self.base_url}/info/hashrate", {'stringOnly': 'false'}),
+            get_json(session, f"{self.base_url}/info/blockdag"),
+        )
+        return int(time.time()), {
+            'hashrate': float(hashrate['hashrate']) * 1e12,  # reported in TH/s
+            'difficulty': float(blockdag['difficulty']),
+        }
+
+
+class CoinGeckoSource(MetricSource):
+    """KAS/USD price, market cap and rolling 24h volume from the CoinGecko simple price API"""
+    name = 'coingecko'
+    uses_http = True
+
+    def __init__(self, url=None, interval=None):
+        super().__init__(float(interval or _setting('PRICE_POLL_SECONDS', '60')))
+        self.url = url or _setting('PRICE_API_URL', 'https://api.coingecko.com/api/v3/simple/price')
+
+    async def fetch(self, session):
+        body = await get_json(session, self.url, {
+            'ids': 'kaspa',
+            'vs_currencies': 'usd',
+            'include_market_cap': 'true',
+            'include_24hr_vol': 'true',
+        })
+        kaspa = body['kaspa']
+        return int(time.time()), {
+            'price': kaspa['usd'],
+            'market_cap': kaspa.get('usd_market_cap'),
+            'volume_24h': kaspa.get('usd_24h_vol'),
+        }
+
+
+class ReplaySource(MetricSource):
+    """
+    Replays a file recorded with --record, one poll per line:
+    {"ts": ..., "source": ..., "values": {metric: value}}.
+
+    The recording is re-timed to start now and polls are spaced as recorded,
+    divided by ``speed`` (0 = no waiting). With ``loop`` the file repeats,
+    continuing the timeline, until the daemon stops.
+    """
+    name = 'replay'
+
+    def __init__(self, path=None, speed=1.0, loop=False):
+        super().__init__(0)
+        path = path or _setting('INGEST_REPLAY_FILE', 'fixtures/kaspa_sample.jsonl')
+        self.polls = read_recording(path)
+        self.speed = speed
+        self.loop = loop
+        first, last = self.polls[0]['ts'], self.polls[-1]['ts']
+        step = (last - first) // (len(self.polls) - 1) if len(self.polls) > 1 else 60
+        self.span = last - first + max(step, 1)  # recorded time covered by one pass
+        self.offset = int(time.time()) - first
+        self.position = 0
+
+    async def fetch(self, session):
+        if self.position == len(self.polls):
+            if not self.loop:
+                return None
+            self.position = 0
+            self.offset += self.span
+        poll = self.polls[self.position]
+        self.position += 1
+        return poll['ts'] + self.offset, poll['values']
+
+    def next_delay(self):
+        if self.speed <= 0 or self.position in (0, len(self.polls)):
+            return 0
+        return (self.polls[self.position]['ts'] - self.polls[self.position - 1]['ts']) / self.speed
+
+
+SOURCES = {
+    KaspaApiSource.name: KaspaApiSource,
+    CoinGeckoSource.name: CoinGeckoSource,
+}
+
+
+class IngestDaemon:
+    """Runs one polling task per source and a single batching writer"""
+
+    def __init__(self, store, sources, batch_size=None, flush_seconds=None, timeout=None,
+                 max_backoff=None, max_write_attempts=5, record=None):
+        self.store = store
+        self.sources = sources
+        self.batch_size = int(batch_size or _setting('INGEST_BATCH_SIZE', '500'))
+        self.flush_seconds = float(flush_seconds or _setting('INGEST_FLUSH_SECONDS', '5'))
+        self.timeout = float(timeout or _setting('INGEST_TIMEOUT_SECONDS', '10'))
+        self.max_backoff = float(max_backoff or _setting('INGEST_MAX_BACKOFF_SECONDS', '300'))
+        self.max_write_attempts = max_write_attempts
+        self.record = record  # open text file, or None
+        self.stats = {'polls': 0, 'poll_errors': 0, 'points': 0, 'batches': 0, 'dropped': 0}
+        self._stopping = None
+        self._queue = None
+
+    def backoff(self, failures):
+        """Exponential from 1s up to max_backoff, with the upper half jittered"""
+        cap = min(self.max_backoff, 2 ** min(failures - 1, 30))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self, duration=None):
+        """Poll until stopped, every source is exhausted or ``duration`` seconds pass; returns stats"""
+        self._stopping = asyncio.Event()
+        # Bounded so a slow database pushes back on the pollers instead of growing memory
+        self._queue = asyncio.Queue(maxsize=1000)
+        session = None
+        if any(source.uses_http for source in self.sources):
+            session = http_session(self.timeout)
+
+        started = time.perf_counter()
+        if duration:
+            asyncio.get_running_loop().call_later(duration, self.stop)
+        writer = asyncio.create_task(self._writer())
+        pollers = [asyncio.create_task(self._poll(source, session)) for source in self.sources]
+        try:
+            await asyncio.gather(*pollers)
+        finally:
+            self.stop()
+            for poller in pollers:
+                poller.cancel()
+            await asyncio.gather(*pollers, return_exceptions=True)
+            # Sentinel: the writer flushes what it has and exits
+            await self._queue.put(None)
+            await writer
+            if session is not None:
+                await session.close()
+
+        elapsed = time.perf_counter() - started
+        self.stats['seconds'] = round(elapsed, 3)
+        self.stats['points_per_second'] = round(self.stats['points'] / elapsed, 1) if elapsed else 0.0
+        return self.stats
+
+    async def _sleep(self, seconds):
+        """Sleep that ends early when the daemon is stopped"""
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll(self, source, session):
+        failures = 0
+        while not self._stopping.is_set():
+            try:
+                result = await asyncio.wait_for(source.fetch(session), self.timeout)
+            except Exception as e:
+                failures += 1
+                self.stats['poll_errors'] += 1
+                delay = self.backoff(failures)
+                logger.warning("%s poll failed (%s: %s); retrying in %.1fs", source.name, type(e).__name__, e, delay)
+                await self._sleep(delay)
+                continue
+
+            if result is None:
+                logger.info("%s has nothing more to replay", source.name)
+                return
+            failures = 0
+            self.stats['polls'] += 1
+            ts, values = result
+            points = []
+            for metric, value in values.items():
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if math.isfinite(value):
+                    points.append((metric, ts, value))
+            if self.record is not None:
+                self.record.write(json.dumps({'ts': ts, 'source': source.name, 'values': values}) + '\n')
+            if points:
+                await self._queue.put(points)
+            await self._sleep(source.next_delay())
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if batch else None
+            try:
+                points = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                points = ()
+            if points is None:
+                break
+            if points:
+                if not batch:
+                    deadline = loop.time() + self.flush_seconds
+                batch.extend(points)
+            if batch and (len(batch) >= self.batch_size or loop.time() >= deadline):
+                await self._flush(batch)
+                batch = []
+        if batch:
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        for attempt in range(1, self.max_write_attempts + 1):
+            try:
+                # The database drivers block, so the insert runs off the event loop
+                written = await asyncio.to_thread(self.store.append_points, batch)
+                self.stats['points'] += written
+                self.stats['batches'] += 1
+                logger.debug("Wrote %d points", written)
+                return
+            except Exception as e:
+                if attempt == self.max_write_attempts:
+                    break
+                delay = self.backoff(attempt)
+                logger.warning("Writing %d points failed (%s); retrying in %.1fs", len(batch), e, delay)
+                await asyncio.sleep(delay)
+        self.stats['dropped'] += len(batch)
+        logger.error("Dropped %d points after %d failed writes", len(batch), self.max_write_attempts)
+
+
+async def _serve(daemon, duration):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, daemon.stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # not available on this platform/thread; Ctrl+C still cancels
+    return await daemon.run(duration)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poll metric sources into metric_points")
+    parser.add_argument('--sources', default=_setting('INGEST_SOURCES', ','.join(SOURCES)),
+                        help=f"comma-separated, from: {', '.join(SOURCES)}")
+    parser.add_argument('--replay', metavar='FILE', help="replay recorded polls from FILE instead of polling sources")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier (0 = no waiting)")
+    parser.add_argument('--loop', action='store_true', help="repeat the replay file until stopped")
+    parser.add_argument('--record', metavar='FILE', help="append every poll to FILE in replay format")
+    parser.add_argument('--duration', type=float, help="stop after this many seconds")
+    parser.add_argument('--batch-size', type=int, help="points per insert (default INGEST_BATCH_SIZE or 500)")
+    parser.add_argument('--flush-seconds', type=float, help="longest a point waits to be written (default 5)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.replay:
+        sources = [ReplaySource(args.replay, args.speed, args.loop)]
+    else:
+        names = [name.strip() for name in args.sources.split(',') if name.strip()]
+        unknown = [name for name in names if name not in SOURCES]
+        if unknown:
+            parser.error(f"unknown source(s): {', '.join(unknown)}")
+        sources = [SOURCES[name]() for name in names]
+
+    from database import Database
+    record = open(args.record, 'a', encoding='utf-8', buffering=1) if args.record else None
+    try:
+        daemon = IngestDaemon(MetricStore(Database()), sources, batch_size=args.batch_size,
+                              flush_seconds=args.flush_seconds, record=record)
+        stats = asyncio.run(_serve(daemon, args.duration))
+    finally:
+        if record is not None:
+            record.close()
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,517 @@
+"""
+Time-series storage for network and market metrics.
+
+Every metric lives in one metric_points table keyed by (metric, ts), with
+ts in epoch seconds: on SQLite the table is WITHOUT ROWID so rows sit in key
+order, and on Postgres a range read walks the primary key index. Either way
+a range read is a single index scan, returned as NumPy arrays ready for
+charting.
+
+metric_rollups holds 1m, 5m, 15m, 1h, 4h and 1d buckets (open/high/low/close,
+sum, count, first and last ts) per metric. Every write refreshes the buckets it touched in
+the same transaction, so charts and window statistics over long ranges read a
+few thousand bucket rows instead of every point.
+
+    store = get_metric_store()
+    store.append('price', timestamps, values)
+    ts, values = store.range('price', start, end)                  # raw points
+    ts, close, low, high = store.series('price', start, end, 1400)  # planned resolution
+    store.aggregate('hashrate', start, end)['mean']
+
+    python metrics_store.py --seed-sample       # deterministic sample history for local development
+    python metrics_store.py --rebuild-rollups   # once, for points written before rollups existed
+    python metrics_store.py --bench             # time a year of reads, raw and planned
+"""
+import argparse
+import io
+import math
+import threading
+import time
+from itertools import chain
+
+# numpy is imported in the functions that use it: Home only reads scalar quick
+# stats (latest, value_at, change) and shouldn't pay numpy's import cost
+
+# hashrate in H/s, difficulty as reported by the node, price, market cap and
+# volumes in USD (volume is per hour, volume_24h the rolling 24h total)
+METRICS = ('hashrate', 'difficulty', 'price', 'volume', 'market_cap', 'volume_24h')
+
+HOUR = 3600
+DAY = 86400
+
+
+# Rollup bucket sizes in seconds, finest first; each level is built from the one below.
+# 5m/15m/4h sit between 1m/1h/1d so no chart range reads more than ~6x its pixel width
+RESOLUTIONS = (60, 300, 900, HOUR, 4 * HOUR, DAY)
+
+# Column order of "parts": raw points and rollup buckets in one shape, so every
+# level is aggregated (and read back) the same way
+_PART_COLUMNS = 'first_ts, last_ts, open, high, low, close, sum, count'
+FIRST_TS, LAST_TS, OPEN, HIGH, LOW, CLOSE, SUM, COUNT = range(8)
+
+
+def plan_resolution(start, end, width_px):
+    """
+    Coarsest rollup resolution that still gives at least one bucket per pixel
+    over [start, end); 0 means raw points are needed.
+    """
+    span = int(end) - int(start)
+    for resolution in reversed(RESOLUTIONS):
+        if span // resolution >= width_px:
+            return resolution
+    return 0
+
+
+def _cover(start, end, levels=tuple(reversed(RESOLUTIONS))):
+    """
+    [start, end) as (resolution, lo, hi) pieces, oldest first: whole buckets of
+    the coarsest resolution that fit, finer ones towards the edges, raw points (0)
+    for what's left - at most a couple of pieces per level.
+    """
+    if start >= end:
+        return []
+    if not levels:
+        return [(0, start, end)]
+    resolution = levels[0]
+    lo = -(-start // resolution) * resolution
+    hi = end // resolution * resolution
+    if lo >= hi:
+        return _cover(start, end, levels[1:])
+    return _cover(start, lo, levels[1:]) + [(resolution, lo, hi)] + _cover(hi, end, levels[1:])
+
+
+def _rollup(parts, resolution):
+    """Aggregate time-ordered parts into buckets of ``resolution`` seconds: (bucket starts, parts)"""
+    import numpy as np
+    buckets = parts[:, FIRST_TS].astype(np.int64) // resolution * resolution
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(parts)] - 1
+    rolled = np.empty((len(starts), len(_PART_COLUMNS.split(', '))))
+    rolled[:, FIRST_TS] = parts[starts, FIRST_TS]
+    rolled[:, LAST_TS] = parts[ends, LAST_TS]
+    rolled[:, OPEN] = parts[starts, OPEN]
+    rolled[:, HIGH] = np.maximum.reduceat(parts[:, HIGH], starts)
+    rolled[:, LOW] = np.minimum.reduceat(parts[:, LOW], starts)
+    rolled[:, CLOSE] = parts[ends, CLOSE]
+    rolled[:, SUM] = np.add.reduceat(parts[:, SUM], starts)
+    rolled[:, COUNT] = np.add.reduceat(parts[:, COUNT], starts)
+    return buckets[starts], rolled
+
+
+class MetricStore:
+    """Bulk writes, range reads and rollups over metric_points"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def append(self, metric, timestamps, values):
+        """
+        Write points for one metric in a single statement per page.
+        A point already stored at the same timestamp is overwritten.
+        Returns the number of points written.
+        """
+        return self.append_points((metric, ts, value) for ts, value in zip(timestamps, values))
+
+    def append_points(self, points):
+        """
+        Write (metric, ts, value) points for any mix of metrics in one statement
+        per page, and refresh the rollup buckets they fall in. The last of
+        several points for the same (metric, ts) wins.
+        Returns the number of points written.
+        """
+        # Deduplicated first: Postgres refuses to update the same row twice in one statement
+        rows = list({(metric, int(ts)): (metric, int(ts), float(value)) for metric, ts, value in points}.values())
+        if not rows:
+            return 0
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                from psycopg2.extras import execute_values
+                execute_values(cursor, '''
+                    INSERT INTO metric_points (metric, ts, value) VALUES %s
+                    ON CONFLICT (metric, ts) DO UPDATE SET value = EXCLUDED.value
+                ''', rows, page_size=5000)
+            else:
+                cursor.executemany('INSERT OR REPLACE INTO metric_points (metric, ts, value) VALUES (?, ?, ?)', rows)
+            self._refresh_rollups(cursor, rows)
+            conn.commit()
+        return len(rows)
+
+    def upsert_bulk(self, points):
+        """
+        append_points for large batches (backfills). On Postgres the rows are
+        streamed with COPY into a temporary table and merged from there in one
+        statement; SQLite has no COPY, so it is the same executemany.
+        Returns the number of points written.
+        """
+        if not self.db.use_postgres:
+            return self.append_points(points)
+        rows = {(metric, int(ts)): float(value) for metric, ts, value in points}
+        if not rows:
+            return 0
+        buffer = io.StringIO(''.join(f"{metric}\t{ts}\t{value!r}\n" for (metric, ts), value in rows.items()))
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            # Per-connection and emptied at commit, so pooled connections can reuse it
+            cursor.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS metric_points_load (
+                    metric VARCHAR(32), ts BIGINT, value DOUBLE PRECISION
+                ) ON COMMIT DELETE ROWS
+            ''')
+            cursor.copy_expert('COPY metric_points_load (metric, ts, value) FROM STDIN', buffer)
+            cursor.execute('''
+                INSERT INTO metric_points (metric, ts, value)
+                SELECT metric, ts, value FROM metric_points_load
+                ON CONFLICT (metric, ts) DO UPDATE SET value = EXCLUDED.value
+            ''')
+            self._refresh_rollups(cursor, [(metric, ts, value) for (metric, ts), value in rows.items()])
+            conn.commit()
+        return len(rows)
+
+    def _refresh_rollups(self, cursor, rows):
+        """Recompute every rollup bucket the written rows fall in, in the caller's transaction"""
+        spans = {}
+        for metric, ts, _ in rows:
+            spans.setdefault(metric, []).append(ts)
+        for metric, timestamps in spans.items():
+            first, last = min(timestamps), max(timestamps)
+            self._refresh_span(cursor, metric, first, last)
+
+    def _refresh_span(self, cursor, metric, first, last):
+        """
+        Rebuild the buckets covering first..last from their source - 1m from
+        raw points, each coarser level from the one below - so a point written
+        twice (a retried backfill chunk) is never counted twice. Touches only
+        the affected buckets.
+        """
+        import numpy as np
+        if self.db.use_postgres:
+            # Writers touching the same metric rebuild its buckets one after the other
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f"metric_rollups:{metric}",))
+        source, rebuilt = 0, None
+        for resolution in RESOLUTIONS:
+            start = first // resolution * resolution
+            end = last // resolution * resolution + resolution
+            if rebuilt is None:
+                parts = self._read_parts(cursor, metric, source, start, end)
+            else:
+                # The level below was just rebuilt in memory; only buckets beyond it come from the table
+                lo, hi, below = rebuilt
+                parts = np.concatenate([self._read_parts(cursor, metric, source, start, lo), below,
+                                        self._read_parts(cursor, metric, source, hi, end)])
+            rebuilt = (start, end, np.empty((0, 8)))
+            if len(parts):
+                buckets, rolled = _rollup(parts, resolution)
+                rebuilt = (start, end, rolled)
+                rows = [(metric, resolution, bucket, *values)
+                        for bucket, values in zip(buckets.tolist(), rolled.tolist())]
+                if self.db.use_postgres:
+                    from psycopg2.extras import execute_values
+                    execute_values(cursor, f'''
+                        INSERT INTO metric_rollups (metric, resolution, bucket, {_PART_COLUMNS}) VALUES %s
+                        ON CONFLICT (metric, resolution, bucket) DO UPDATE SET
+                            first_ts = EXCLUDED.first_ts, last_ts = EXCLUDED.last_ts,
+                            open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low,
+                            close = EXCLUDED.close, sum = EXCLUDED.sum, count = EXCLUDED.count
+                    ''', rows, page_size=5000)
+                else:
+                    cursor.executemany(f'''
+                        INSERT OR REPLACE INTO metric_rollups (metric, resolution, bucket, {_PART_COLUMNS})
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', rows)
+            source = resolution
+
+    def _read_parts(self, cursor, metric, resolution, start, end):
+        """Raw points (resolution 0) or rollup buckets in [start, end) as a parts array, oldest first"""
+        import numpy as np
+        if resolution == 0:
+            if self.db.use_postgres:
+                cursor.execute('''
+                    SELECT ts, value FROM metric_points
+                    WHERE metric = %s AND ts >= %s AND ts < %s
+                    ORDER BY ts
+                ''', (metric, start, end))
+            else:
+                cursor.execute('''
+                    SELECT ts, value FROM metric_points
+                    WHERE metric = ? AND ts >= ? AND ts < ?
+                    ORDER BY ts
+                ''', (metric, start, end))
+            rows = cursor.fetchall()
+            # A point is a part that opens, closes, peaks and troughs at its own value
+            points = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=2 * len(rows)).reshape(-1, 2)
+            parts = np.empty((len(rows), 8))
+            parts[:, FIRST_TS:LAST_TS + 1] = points[:, :1]
+            parts[:, OPEN:SUM + 1] = points[:, 1:]
+            parts[:, COUNT] = 1
+            return parts
+        else:
+            if self.db.use_postgres:
+                cursor.execute(f'''
+                    SELECT {_PART_COLUMNS} FROM metric_rollups
+                    WHERE metric = %s AND resolution = %s AND bucket >= %s AND bucket < %s
+                    ORDER BY bucket
+                ''', (metric, resolution, start, end))
+            else:
+                cursor.execute(f'''
+                    SELECT {_PART_COLUMNS} FROM metric_rollups
+                    WHERE metric = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+                    ORDER BY bucket
+                ''', (metric, resolution, start, end))
+        rows = cursor.fetchall()
+        return np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=8 * len(rows)).reshape(-1, 8)
+
+    def rebuild_rollups(self, metric, window=30 * DAY):
+        """Rebuild all of a metric's rollups from its raw points, a window at a time (after upgrading)"""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('SELECT MIN(ts), MAX(ts) FROM metric_points WHERE metric = %s', (metric,))
+            else:
+                cursor.execute('SELECT MIN(ts), MAX(ts) FROM metric_points WHERE metric = ?', (metric,))
+            first, last = cursor.fetchone()
+            if first is None:
+                return 0
+            windows = 0
+            for start in range(int(first) // DAY * DAY, int(last) + 1, window):
+                self._refresh_span(cursor, metric, start, min(start + window, int(last) + 1) - 1)
+                conn.commit()
+                windows += 1
+        return windows
+
+    def range(self, metric, start=None, end=None):
+        """
+        Points with start <= ts < end (epoch seconds; None for unbounded),
+        oldest first, as (timestamps int64 array, values float64 array).
+        """
+        import numpy as np
+        start = -2 ** 62 if start is None else int(start)
+        end = 2 ** 62 if end is None else int(end)
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('''
+                    SELECT ts, value FROM metric_points
+                    WHERE metric = %s AND ts >= %s AND ts < %s
+                    ORDER BY ts
+                ''', (metric, start, end))
+            else:
+                cursor.execute('''
+                    SELECT ts, value FROM metric_points
+                    WHERE metric = ? AND ts >= ? AND ts < ?
+                    ORDER BY ts
+                ''', (metric, start, end))
+            rows = cursor.fetchall()
+
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        # Flattened straight into one buffer (several times faster than np.array on
+        # a list of tuples); epoch seconds are exact in float64
+        points = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=2 * len(rows)).reshape(-1, 2)
+        return points[:, 0].astype(np.int64), points[:, 1].copy()
+
+    def rollups(self, metric, resolution, start, end):
+        """
+        Buckets of ``resolution`` seconds (0 = raw points, one per "bucket") with
+        start <= bucket < end, as a dict of arrays: bucket, open, high, low, close,
+        sum, count, mean.
+        """
+        import numpy as np
+        with self.db.get_connection() as conn:
+            parts = self._read_parts(conn.cursor(), metric, resolution, int(start), int(end))
+        first_ts = parts[:, FIRST_TS].astype(np.int64)
+        return {
+            'bucket': first_ts // resolution * resolution if resolution else first_ts,
+            'open': parts[:, OPEN],
+            'high': parts[:, HIGH],
+            'low': parts[:, LOW],
+            'close': parts[:, CLOSE],
+            'sum': parts[:, SUM],
+            'count': parts[:, COUNT].astype(np.int64),
+            'mean': parts[:, SUM] / parts[:, COUNT] if len(parts) else parts[:, SUM],
+        }
+
+    def series(self, metric, start, end=None, width_px=1400, value='close'):
+        """
+        A chart's worth of [start, end) at the coarsest resolution with at least
+        one bucket per pixel (plan_resolution): (bucket timestamps, ``value`` per
+        bucket - close, mean or sum - and the bucket lows and highs for an envelope).
+        Years of data read a few thousand rollup rows instead of every point.
+        """
+        end = time.time() + 1 if end is None else end
+        buckets = self.rollups(metric, plan_resolution(start, end, width_px), start, end)
+        return buckets['bucket'], buckets[value], buckets['low'], buckets['high']
+
+    def aggregate(self, metric, start, end):
+        """
+        open/high/low/close/sum/count/mean over [start, end), read from whole
+        buckets of the coarsest resolutions that fit plus the raw points at the
+        ragged edges (_cover). None if there are no points.
+        """
+        import numpy as np
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            parts = [self._read_parts(cursor, metric, resolution, lo, hi)
+                     for resolution, lo, hi in _cover(int(start), int(end))]
+        parts = np.concatenate(parts) if parts else np.empty((0, 8))
+        if not len(parts):
+            return None
+        total, count = float(parts[:, SUM].sum()), int(parts[:, COUNT].sum())
+        return {
+            'open': float(parts[0, OPEN]),
+            'high': float(parts[:, HIGH].max()),
+            'low': float(parts[:, LOW].min()),
+            'close': float(parts[-1, CLOSE]),
+            'sum': total,
+            'count': count,
+            'mean': total / count,
+        }
+
+    def latest(self, metric):
+        """(ts, value) of the newest point, or None"""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('SELECT ts, value FROM metric_points WHERE metric = %s ORDER BY ts DESC LIMIT 1', (metric,))
+            else:
+                cursor.execute('SELECT ts, value FROM metric_points WHERE metric = ? ORDER BY ts DESC LIMIT 1', (metric,))
+            row = cursor.fetchone()
+        return (int(row[0]), float(row[1])) if row else None
+
+    def value_at(self, metric, ts):
+        """Value of the newest point at or before ``ts``, or NaN"""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.db.use_postgres:
+                cursor.execute('''
+                    SELECT value FROM metric_points WHERE metric = %s AND ts <= %s ORDER BY ts DESC LIMIT 1
+                ''', (metric, int(ts)))
+            else:
+                cursor.execute('''
+                    SELECT value FROM metric_points WHERE metric = ? AND ts <= ? ORDER BY ts DESC LIMIT 1
+                ''', (metric, int(ts)))
+            row = cursor.fetchone()
+        return float(row[0]) if row else float('nan')
+
+    def change(self, metric, seconds):
+        """(newest value, % change from the value ``seconds`` before it); two index seeks"""
+        latest = self.latest(metric)
+        if latest is None:
+            return float('nan'), float('nan')
+        return latest[1], pct_change(latest[1], self.value_at(metric, latest[0] - seconds))
+
+    def window_change(self, metric, seconds):
+        """(mean of the last ``seconds`` up to the newest point, % change from the window before it)"""
+        latest = self.latest(metric)
+        if latest is None:
+            return float('nan'), float('nan')
+        end = latest[0] + 1
+        current = self.aggregate(metric, end - seconds, end)
+        previous = self.aggregate(metric, end - 2 * seconds, end - seconds)
+        current = current['mean'] if current else float('nan')
+        return current, pct_change(current, previous['mean'] if previous else float('nan'))
+
+
+def to_datetimes(timestamps):
+    """Epoch seconds to datetime64 for plotting (no per-point Python objects)"""
+    import numpy as np
+    return np.asarray(timestamps, dtype='datetime64[s]')
+
+
+def pct_change(new, old):
+    """Percentage change from ``old`` to ``new``; NaN when it isn't defined"""
+    if not old or math.isnan(old) or math.isnan(new):
+        return float('nan')
+    return float((new - old) / old * 100)
+
+
+def format_delta(pct):
+    """st.metric delta for a percentage change (None hides it)"""
+    return None if math.isnan(pct) else f"{pct:+.1f}%"
+
+
+def format_value(value, fmt):
+    """st.metric value: ``fmt(value)``, or an em dash when there is no data (NaN)"""
+    return "—" if math.isnan(value) else fmt(value)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metric_store():
+    """Process-wide MetricStore on the shared database service"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from services import get_database
+                _store = MetricStore(get_database())
+    return _store
+
+
+# Sample history: (start value, hourly volatility) per metric
+_SAMPLE_SHAPES = {
+    'hashrate': (1.2e18, 0.004),
+    'difficulty': (15.5e12, 0.004),
+    'price': (0.125, 0.006),
+    'volume': (5e6, 0.05),
+    'market_cap': (3.1e9, 0.006),
+    'volume_24h': (45e6, 0.01),
+}
+
+
+def seed_sample(store, days=365, seed=42):
+    """Fill empty metrics with a reproducible random walk of hourly points ending now"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    end = int(time.time()) // HOUR * HOUR
+    timestamps = np.arange(end - days * DAY, end + 1, HOUR)
+    written = {}
+    for metric, (start_value, volatility) in _SAMPLE_SHAPES.items():
+        if store.latest(metric) is not None:
+            continue
+        steps = rng.normal(0.0002 if metric in ('hashrate', 'difficulty') else 0, volatility, len(timestamps))
+        values = start_value * np.exp(np.cumsum(steps))
+        written[metric] = store.append(metric, timestamps, values)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Metric store utilities")
+    parser.add_argument('--seed-sample', action='store_true', help="write a year of sample hourly points to empty metrics")
+    parser.add_argument('--rebuild-rollups', action='store_true', help="rebuild every metric's rollups from its raw points")
+    parser.add_argument('--bench', action='store_true', help="time a year of reads: raw points, planned series, window mean")
+    args = parser.parse_args(argv)
+
+    from database import Database
+    store = MetricStore(Database())
+
+    if args.seed_sample:
+        print("Seeded:", seed_sample(store) or "nothing (metrics already have data)")
+
+    if args.rebuild_rollups:
+        for metric in METRICS:
+            print(f"{metric}: {store.rebuild_rollups(metric)} windows rebuilt")
+
+    if args.bench:
+        now = time.time()
+        start = now - 365 * DAY
+        for metric in METRICS:
+            for name, read in (
+                ("raw", lambda: store.range(metric, start, now + HOUR)[0]),
+                ("series", lambda: store.series(metric, start, now + HOUR, 1400)[0]),
+                ("aggregate", lambda: [store.aggregate(metric, start, now + HOUR)]),
+            ):
+                timings = []
+                for _ in range(20):
+                    started = time.perf_counter()
+                    rows = len(read())
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                print(f"{metric:<10} {name:<9} {rows:7d} rows  "
+                      f"median {timings[len(timings) // 2] * 1000:.2f} ms  max {timings[-1] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each migration is (version, description, postgres statements, sqlite statements).
+# Append new migrations at the end; never edit one that has shipped.
+MIGRATIONS = [
+    (1, "users and job_runs tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            is_premium BOOLEAN DEFAULT FALSE,
+            premium_expires_at TIMESTAMP NULL,
+            stripe_customer_id VARCHAR(100),
+            stripe_subscription_id VARCHAR(100),
+            reset_token VARCHAR(100) NULL,
+            reset_token_expires TIMESTAMP NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_name VARCHAR(50) PRIMARY KEY,
+            last_run_at DOUBLE PRECISION NULL,
+            last_result TEXT NULL,
+            locked_by VARCHAR(100) NULL,
+            locked_until DOUBLE PRECISION NULL
+        )
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_premium BOOLEAN DEFAULT FALSE,
+            premium_expires_at TIMESTAMP NULL,
+            stripe_customer_id TEXT,
+            stripe_subscription_id TEXT,
+            reset_token TEXT NULL,
+            reset_token_expires TIMESTAMP NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_name TEXT PRIMARY KEY,
+            last_run_at REAL NULL,
+            last_result TEXT NULL,
+            locked_by TEXT NULL,
+            locked_until REAL NULL
+        )
+        ''',
+    ]),
+
+    (2, "indexes for renewal and reset-token lookups", [
+        # Renewal sweep: premium users with a subscription, range scan on expiry
+        '''
+        CREATE INDEX IF NOT EXISTS idx_users_premium_expiry
+        ON users (premium_expires_at)
+        WHERE is_premium = TRUE AND stripe_subscription_id IS NOT NULL
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_users_reset_token
+        ON users (reset_token)
+        WHERE reset_token IS NOT NULL
+        ''',
+        'ANALYZE users',
+    ], [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_users_premium_expiry
+        ON users (premium_expires_at)
+        WHERE is_premium = 1 AND stripe_subscription_id IS NOT NULL
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_users_reset_token
+        ON users (reset_token)
+        WHERE reset_token IS NOT NULL
+        ''',
+        'ANALYZE users',
+    ]),
+
+    (3, "ISO-sortable timestamps on SQLite", [
+        # Postgres already stores native TIMESTAMP values
+    ], [
+        # Rewrite 'YYYY-MM-DDTHH:MM:SS.ffffff' (and friends) as 'YYYY-MM-DD HH:MM:SS'
+        # so text comparisons and index range scans order correctly
+        '''
+        UPDATE users SET premium_expires_at = strftime('%Y-%m-%d %H:%M:%S', premium_expires_at)
+        WHERE premium_expires_at IS NOT NULL
+        ''',
+        '''
+        UPDATE users SET reset_token_expires = strftime('%Y-%m-%d %H:%M:%S', reset_token_expires)
+        WHERE reset_token_expires IS NOT NULL
+        ''',
+    ]),
+
+    (4, "login_throttle token buckets shared across replicas", [
+        '''
+        CREATE TABLE IF NOT EXISTS login_throttle (
+            bucket_key VARCHAR(200) PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_login_throttle_updated ON login_throttle (updated_at)',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS login_throttle (
+            bucket_key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_login_throttle_updated ON login_throttle (updated_at)',
+    ]),
+
+    (5, "user_sessions for remember-me cookies", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id_hash CHAR(64) PRIMARY KEY,
+            username VARCHAR(50) NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            created_at DOUBLE PRECISION NOT NULL,
+            last_seen_at DOUBLE PRECISION NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_sessions_username ON user_sessions (username)',
+        'CREATE INDEX IF NOT EXISTS idx_user_sessions_expires ON user_sessions (expires_at)',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            created_at REAL NOT NULL,
+            last_seen_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_sessions_username ON user_sessions (username)',
+        'CREATE INDEX IF NOT EXISTS idx_user_sessions_expires ON user_sessions (expires_at)',
+    ]),
+
+    (6, "password_reset_tokens keyed by token hash", [
+        '''
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            token_hash CHAR(64) PRIMARY KEY,
+            username VARCHAR(50) NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            created_at DOUBLE PRECISION NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_username ON password_reset_tokens (username, expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_expires ON password_reset_tokens (expires_at)',
+        # Plaintext tokens on users are no longer read; don't leave them lying around
+        'DROP INDEX IF EXISTS idx_users_reset_token',
+        'UPDATE users SET reset_token = NULL, reset_token_expires = NULL WHERE reset_token IS NOT NULL',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_username ON password_reset_tokens (username, expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_reset_tokens_expires ON password_reset_tokens (expires_at)',
+        'DROP INDEX IF EXISTS idx_users_reset_token',
+        'UPDATE users SET reset_token = NULL, reset_token_expires = NULL WHERE reset_token IS NOT NULL',
+    ]),
+
+    (7, "email_outbox for queued outbound email", [
+        '''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id SERIAL PRIMARY KEY,
+            idempotency_key VARCHAR(200) UNIQUE NOT NULL,
+            to_email VARCHAR(100) NOT NULL,
+            to_name VARCHAR(100),
+            subject TEXT NOT NULL,
+            text_part TEXT,
+            html_part TEXT,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at DOUBLE PRECISION NOT NULL,
+            last_error TEXT,
+            created_at DOUBLE PRECISION NOT NULL,
+            sent_at DOUBLE PRECISION
+        )
+        ''',
+        # Pending and in-flight rows only; sent and dead rows drop out of the index
+        '''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            to_email TEXT NOT NULL,
+            to_name TEXT,
+            subject TEXT NOT NULL,
+            text_part TEXT,
+            html_part TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+        ''',
+    ]),
+
+    (8, "email campaigns with per-recipient results and a resume checkpoint", [
+        '''
+        CREATE TABLE IF NOT EXISTS email_campaigns (
+            campaign_id VARCHAR(100) PRIMARY KEY,
+            subject TEXT NOT NULL,
+            audience VARCHAR(20) NOT NULL,
+            status VARCHAR(10) NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS email_campaign_results (
+            campaign_id VARCHAR(100) NOT NULL REFERENCES email_campaigns (campaign_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            error TEXT,
+            PRIMARY KEY (campaign_id, user_id)
+        )
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS email_campaigns (
+            campaign_id TEXT PRIMARY KEY,
+            subject TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS email_campaign_results (
+            campaign_id TEXT NOT NULL REFERENCES email_campaigns (campaign_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            PRIMARY KEY (campaign_id, user_id)
+        )
+        ''',
+    ]),
+
+    (9, "stripe_events for webhook dedupe and ordering", [
+        '''
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            event_id VARCHAR(255) PRIMARY KEY,
+            event_type VARCHAR(100) NOT NULL,
+            subscription_id VARCHAR(100),
+            created DOUBLE PRECISION NOT NULL,
+            received_at DOUBLE PRECISION NOT NULL,
+            outcome VARCHAR(20) NOT NULL
+        )
+        ''',
+        # Latest applied event per subscription, so late deliveries can be skipped
+        'CREATE INDEX IF NOT EXISTS idx_stripe_events_subscription ON stripe_events (subscription_id, created)',
+        'CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (stripe_subscription_id)',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            subscription_id TEXT,
+            created REAL NOT NULL,
+            received_at REAL NOT NULL,
+            outcome TEXT NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_stripe_events_subscription ON stripe_events (subscription_id, created)',
+        'CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (stripe_subscription_id)',
+    ]),
+
+    (10, "processed_checkouts so each Stripe checkout is applied once", [
+        '''
+        CREATE TABLE IF NOT EXISTS processed_checkouts (
+            session_id VARCHAR(255) PRIMARY KEY,
+            status VARCHAR(10) NOT NULL DEFAULT 'pending',
+            locked_by VARCHAR(100),
+            locked_until DOUBLE PRECISION,
+            username VARCHAR(50),
+            subscription_id VARCHAR(100),
+            expires_at TIMESTAMP NULL,
+            amount INTEGER,
+            plan_type VARCHAR(50),
+            error TEXT,
+            created_at DOUBLE PRECISION NOT NULL,
+            processed_at DOUBLE PRECISION
+        )
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS processed_checkouts (
+            session_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            locked_by TEXT,
+            locked_until REAL,
+            username TEXT,
+            subscription_id TEXT,
+            expires_at TEXT NULL,
+            amount INTEGER,
+            plan_type TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            processed_at REAL
+        )
+        ''',
+    ]),
+
+    (11, "metric_points time series keyed by (metric, ts)", [
+        '''
+        CREATE TABLE IF NOT EXISTS metric_points (
+            metric VARCHAR(32) NOT NULL,
+            ts BIGINT NOT NULL,
+            value DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (metric, ts)
+        )
+        ''',
+    ], [
+        # WITHOUT ROWID stores the rows in the primary key's b-tree: a range read is one index scan
+        '''
+        CREATE TABLE IF NOT EXISTS metric_points (
+            metric TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (metric, ts)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+
+    (12, "backfill_chunks checkpoints for resumable metric backfills", [
+        '''
+        CREATE TABLE IF NOT EXISTS backfill_chunks (
+            source VARCHAR(32) NOT NULL,
+            chunk_start BIGINT NOT NULL,
+            chunk_end BIGINT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (source, chunk_start, chunk_end)
+        )
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS backfill_chunks (
+            source TEXT NOT NULL,
+            chunk_start INTEGER NOT NULL,
+            chunk_end INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            rows_written INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (source, chunk_start, chunk_end)
+        )
+        ''',
+    ]),
+
+    (13, "metric_rollups: 1m to 1d OHLC buckets over metric_points", [
+        '''
+        CREATE TABLE IF NOT EXISTS metric_rollups (
+            metric VARCHAR(32) NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket BIGINT NOT NULL,
+            open DOUBLE PRECISION NOT NULL,
+            high DOUBLE PRECISION NOT NULL,
+            low DOUBLE PRECISION NOT NULL,
+            close DOUBLE PRECISION NOT NULL,
+            sum DOUBLE PRECISION NOT NULL,
+            count INTEGER NOT NULL,
+            first_ts BIGINT NOT NULL,
+            last_ts BIGINT NOT NULL,
+            PRIMARY KEY (metric, resolution, bucket)
+        )
+        ''',
+    ], [
+        '''
+        CREATE TABLE IF NOT EXISTS metric_rollups (
+            metric TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            open REAL NOT NULL,
+            high REAL NOT NULL,
+            low REAL NOT NULL,
+            close REAL NOT NULL,
+            sum REAL NOT NULL,
+            count INTEGER NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            PRIMARY KEY (metric, resolution, bucket)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+
+    (14, "clear the bodies of sent and dead email_outbox rows", [
+        # Reset emails carry a live token in their body; delivered mail no longer needs it
+        "UPDATE email_outbox SET text_part = NULL, html_part = NULL WHERE status IN ('sent', 'dead')",
+    ], [
+        "UPDATE email_outbox SET text_part = NULL, html_part = NULL WHERE status IN ('sent', 'dead')",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _create_version_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+
+def current_version(cursor):
+    """Highest applied migration, or 0 for a fresh database"""
+    cursor.execute('SELECT MAX(version) FROM schema_migrations')
+    row = cursor.fetchone()
+    return row[0] or 0
+
+
+def is_current(conn):
+    """
+    Startup fast path: one query telling whether the schema is already at
+    LATEST_VERSION. A missing schema_migrations table counts as not current.
+    """
+    cursor = conn.cursor()
+    try:
+        current = current_version(cursor) >= LATEST_VERSION
+    except Exception:
+        current = False
+    conn.rollback()
+    return current
+
+
+def apply_migrations(conn, use_postgres):
+    """
+    Bring the schema up to LATEST_VERSION. Each migration runs in its own
+    transaction together with its schema_migrations row, so re-running is
+    a no-op and concurrent starts can't apply the same step twice.
+    Returns the list of versions applied.
+    """
+    cursor = conn.cursor()
+    _create_version_table(cursor)
+    conn.commit()
+
+    applied = []
+    for version, description, postgres_statements, sqlite_statements in MIGRATIONS:
+        # Serialise concurrent processes starting at the same time
+        if use_postgres:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (7_340_001,))
+        else:
+            # Explicit BEGIN so the DDL is part of the transaction too
+            cursor.execute('BEGIN IMMEDIATE')
+        if current_version(cursor) >= version:
+            conn.rollback()
+            continue
+
+        try:
+            for statement in (postgres_statements if use_postgres else sqlite_statements):
+                cursor.execute(statement)
+
+            if use_postgres:
+                cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)', (version, description))
+            else:
+                cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (?, ?)', (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception("Schema migration %d failed", version)
+            raise
+        applied.append(version)
+        logger.info("Applied schema migration %d: %s", version, description)
+
+    return applied
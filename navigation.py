@@ -1,8 +1,19 @@
 import streamlit as st
+from datetime import datetime
+from entitlements import current_entitlement, premium_expiry
+from sessions import restore_session, end_session
 
 def add_navigation():
     """Add organized navigation to sidebar AND header (shared across all pages)"""
     
+    # Sign a returning browser back in from its remember-me cookie (one indexed lookup)
+    restore_session()
+    
+    # Verify the signed entitlement once per rerun (no DB read unless it is about to expire);
+    # this also keeps st.session_state['is_premium'] in step for every page below
+    entitlement = current_entitlement()
+    expires = premium_expiry(entitlement)
+    
     # CRITICAL FIX: Inject CSS IMMEDIATELY to prevent flickering
     # This runs before Streamlit renders its default header
     st.markdown("""
@@ -334,20 +345,15 @@ def add_navigation():
             status_class = "premium"
             
             # Add expiration info if available
-            if st.session_state.get('premium_expires_at'):
-                try:
-                    from datetime import datetime
-                    expires = datetime.fromisoformat(str(st.session_state['premium_expires_at']).replace('Z', '+00:00'))
-                    days_left = (expires - datetime.now()).days
-                    if days_left > 0:
-                        status_text += f" ({days_left}d left)"
-                    elif days_left == 0:
-                        status_text += " (Expires today)"
-                    else:
-                        status_text = "🔒 EXPIRED"
-                        status_class = "free"
-                except:
-                    pass
+            if expires:
+                days_left = (expires - datetime.now()).days
+                if days_left > 0:
+                    status_text += f" ({days_left}d left)"
+                elif days_left == 0:
+                    status_text += " (Expires today)"
+                else:
+                    status_text = "🔒 EXPIRED"
+                    status_class = "free"
         else:
             status_text = "🔒 FREE TIER"
             status_class = "free"
@@ -414,7 +420,7 @@ def add_navigation():
                 st.switch_page("pages/A_👤_Account.py")
         with col2:
             if st.button("🚪 Logout", key="nav_logout", use_container_width=True):
-                st.session_state.clear()
+                end_session()
                 st.switch_page("Home.py")
     else:
         # User not logged in
@@ -481,12 +487,8 @@ def add_navigation():
     
     if st.session_state.get('is_premium'):
         st.sidebar.success("👑 Premium Active")
-        if st.session_state.get('premium_expires_at'):
-            try:
-                expires_str = str(st.session_state['premium_expires_at'])[:10]
-                st.sidebar.write(f"Expires: {expires_str}")
-            except:
-                st.sidebar.write("Expires: Active")
+        if expires:
+            st.sidebar.write(f"Expires: {expires:%Y-%m-%d}")
         else:
             st.sidebar.write("Expires: Active")
     elif st.session_state.get('authentication_status'):
@@ -1,34 +1,29 @@
 import streamlit as st
+from datetime import datetime
 
 # Page config MUST be first!
 st.set_page_config(page_title="Login", page_icon="🔑", layout="wide")
 
-import sys
-import os
-
-# Add parent directory to path for imports
-parent_dir = os.path.dirname(os.path.dirname(__file__))
-sys.path.append(parent_dir)
-
-from database import Database
-from auth_handler import AuthHandler
-from payment_handler import PaymentHandler
-from email_handler import EmailHandler
+from services import get_database, get_auth_handler, get_email_handler
 from navigation import add_navigation
+from password_hasher import HasherBusy
+from rate_limiter import RateLimited, client_key
+from entitlements import grant
+from sessions import remember_login, end_session
 
 # Add shared navigation to sidebar
 add_navigation()
 
-# Initialize handlers
-@st.cache_resource
-def init_handlers():
-    db = Database()
-    auth_handler = AuthHandler(db)
-    payment_handler = PaymentHandler()
-    email_handler = EmailHandler()
-    return db, auth_handler, payment_handler, email_handler
+# Shared, lazily built services (the email handler is only built when an email is sent)
+db = get_database()
+auth_handler = get_auth_handler()
 
-db, auth_handler, payment_handler, email_handler = init_handlers()
+# Who is signing in, for per-client login throttling
+try:
+    client = client_key(st.context.headers, getattr(st.context, 'ip_address', None))
+except Exception:
+    # st.context arrived in Streamlit 1.37; before that only the per-user budget applies
+    client = None
 
 # Check for password reset token in URL - Multiple ways to get it
 query_params = st.query_params
@@ -59,8 +54,14 @@ if reset_token:
     st.title("🔄 Reset Your Password")
     st.info("You've been redirected from a password reset email. Please set your new password below.")
     
-    # Verify token
-    user = db.verify_reset_token(reset_token)
+    # Verify token once per form: reruns reuse the verified result until the token expires
+    verified = st.session_state.get('verified_reset_token')
+    if verified and verified[0] == reset_token and verified[1]['reset_token_expires'] > datetime.now():
+        user = verified[1]
+    else:
+        user = db.verify_reset_token(reset_token)
+        if user:
+            st.session_state['verified_reset_token'] = (reset_token, user)
     if user:
         st.success(f"✅ Token verified for {user['username']}!")
         
@@ -75,6 +76,7 @@ if reset_token:
                     if new_password == confirm_password:
                         if len(new_password) >= 6:
                             if db.reset_password(reset_token, new_password):
+                                st.session_state.pop('verified_reset_token', None)
                                 st.success("🎉 Password reset successfully!")
                                 st.info("👆 You can now login with your new password using the form below")
                                 st.balloons()
@@ -82,6 +84,8 @@ if reset_token:
                                 st.query_params.clear()
                                 st.rerun()
                             else:
+                                # The token may have been used or expired meanwhile; verify afresh next time
+                                st.session_state.pop('verified_reset_token', None)
                                 st.error("❌ Failed to reset password. Please try again.")
                         else:
                             st.error("⚠️ Password must be at least 6 characters long")
@@ -128,7 +132,7 @@ if st.session_state.get('authentication_status'):
             st.switch_page("pages/A_👤_Account.py")
     with col3:
         if st.button("🚪 Logout", use_container_width=True):
-            st.session_state.clear()
+            end_session()
             st.rerun()
     st.stop()
 
@@ -153,34 +157,49 @@ with col1:
         
         if login_button:
             if username and password:
-                if auth_handler.authenticate(username, password):
-                    user = db.get_user(username)
-                    is_premium, expiry_info = db.check_premium_expiration(username)
-                    
+                # One round trip: password hash, profile and expiry check together
+                notice = None
+                try:
+                    profile = auth_handler.login(username, password, client=client)
+                except RateLimited as e:
+                    profile, notice = None, f"⏳ Too many sign-in attempts. Please try again in {e.retry_after:.0f} seconds."
+                except HasherBusy:
+                    profile, notice = None, "⏳ Too many sign-in attempts right now. Please try again in a moment."
+                if profile:
                     st.session_state['authentication_status'] = True
                     st.session_state['username'] = username
-                    st.session_state['name'] = user['name']
-                    st.session_state['is_premium'] = is_premium
-                    st.session_state['premium_expires_at'] = user.get('premium_expires_at')
+                    st.session_state['name'] = profile['name']
+                    # Signed entitlement: pages check premium without a DB read
+                    grant(username, profile)
+                    # Remember-me cookie: new tabs resume without a password check
+                    remember_login(username)
                     
-                    st.success(f"✅ Welcome back, {user['name']}!")
+                    st.success(f"✅ Welcome back, {profile['name']}!")
                     st.balloons()
                     st.switch_page("Home.py")
+                elif notice:
+                    st.warning(notice)
                 else:
                     st.error("❌ Invalid username or password")
             else:
                 st.error("⚠️ Please enter both username and password")
         
         if demo_button:
-            if auth_handler.authenticate("demo_user", "demo123"):
-                user = db.get_user("demo_user")
-                is_premium, expiry_info = db.check_premium_expiration("demo_user")
-                
+            try:
+                # The demo account is shared by every visitor, so only the client budget applies
+                profile = auth_handler.login("demo_user", "demo123", client=client, limit_user=False)
+            except RateLimited as e:
+                profile = None
+                st.warning(f"⏳ Too many sign-in attempts. Please try again in {e.retry_after:.0f} seconds.")
+            except HasherBusy:
+                profile = None
+                st.warning("⏳ Too many sign-in attempts right now. Please try again in a moment.")
+            if profile:
                 st.session_state['authentication_status'] = True
                 st.session_state['username'] = "demo_user"
-                st.session_state['name'] = user['name']
-                st.session_state['is_premium'] = is_premium
-                st.session_state['premium_expires_at'] = user.get('premium_expires_at')
+                st.session_state['name'] = profile['name']
+                grant("demo_user", profile)
+                remember_login("demo_user")
                 
                 st.success("🎮 Logged in as Demo User!")
                 st.switch_page("Home.py")
@@ -203,7 +222,7 @@ with col1:
                         token = db.create_reset_token(reset_email)
                         if token:
                             # Send email
-                            if email_handler.send_password_reset_email(reset_email, token, user['username']):
+                            if get_email_handler().send_password_reset_email(reset_email, token, user['username']):
                                 st.success("📧 Password reset email sent!")
                                 st.info("Check your inbox for the reset link. The link expires in 1 hour.")
                             else:
@@ -236,7 +255,7 @@ with col2:
                         
                         # Send welcome email to new user
                         try:
-                            email_handler.send_welcome_email(new_email, new_name)
+                            get_email_handler().send_welcome_email(new_email, new_name)
                             st.success("📧 Welcome email sent! Check your inbox.")
                         except Exception as e:
                             st.warning("⚠️ Account created but welcome email could not be sent.")
@@ -1,48 +1,47 @@
 import streamlit as st
 # Page config MUST be first!
 st.set_page_config(page_title="Mining Hashrate", page_icon="📈", layout="wide")
-import plotly.graph_objects as go
-import pandas as pd
-import numpy as np
-import sys
-import os
-# Add parent directory to path for imports
-parent_dir = os.path.dirname(os.path.dirname(__file__))
-sys.path.append(parent_dir)
-from database import Database
-from auth_handler import AuthHandler
-from payment_handler import PaymentHandler
 from navigation import add_navigation
 # NOW add navigation (after page config)
 add_navigation()
-# Initialize handlers
-@st.cache_resource
-def init_handlers():
-    db = Database()
-    auth_handler = AuthHandler(db)
-    payment_handler = PaymentHandler()
-    return db, auth_handler, payment_handler
-db, auth_handler, payment_handler = init_handlers()
 
 # Main content
 st.title("📈 Kaspa Network Hashrate")
 st.write("Current network hashrate metrics and mining trends")
-# Sample data - replace with real Kaspa API data later
-dates = pd.date_range(start='2024-01-01', end='2024-06-01', freq='D')
-hashrate_data = np.random.normal(1.2, 0.1, len(dates))  # EH/s
-# Current metrics
+# Charting libraries are imported here, after the header and navigation
+# have rendered, because they dominate the page's import time
+import time
+import plotly.graph_objects as go
+from metrics_store import get_metric_store, to_datetimes, format_delta, format_value, DAY
+from downsample import downsample, envelope, envelope_traces, FULL_WIDTH_PX, HALF_WIDTH_PX
+# A year at the coarsest rollup resolution with a bucket per pixel (a few thousand rows, not every point)
+store = get_metric_store()
+now = time.time()
+timestamps, hashrate_data, hashrate_low, hashrate_high = store.series('hashrate', now - 365 * DAY, now + 1, FULL_WIDTH_PX, value='mean')
+hashrate_data, hashrate_low, hashrate_high = hashrate_data / 1e18, hashrate_low / 1e18, hashrate_high / 1e18  # H/s -> EH/s
+if len(timestamps) == 0:
+    st.info("No hashrate data stored yet.")
+    st.stop()
+# Current metrics - window averages come from whole rollup buckets
+current, current_change = store.change('hashrate', DAY)
+avg_7d, change_7d = store.window_change('hashrate', 7 * DAY)
+avg_30d, change_30d = store.window_change('hashrate', 30 * DAY)
+current, avg_7d, avg_30d = current / 1e18, avg_7d / 1e18, avg_30d / 1e18
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.metric("Current Hashrate", "1.24 EH/s", "+2.1%")
+    st.metric("Current Hashrate", format_value(current, lambda v: f"{v:.2f} EH/s"), format_delta(current_change))
 with col2:
-    st.metric("7d Average", "1.18 EH/s", "+0.8%")
+    st.metric("7d Average", format_value(avg_7d, lambda v: f"{v:.2f} EH/s"), format_delta(change_7d))
 with col3:
-    st.metric("30d Average", "1.15 EH/s", "+5.2%")
-# Hashrate chart
+    st.metric("30d Average", format_value(avg_30d, lambda v: f"{v:.2f} EH/s"), format_delta(change_30d))
+# Hashrate chart - reduced to what the chart can show (LTTB line over a min/max band)
+line_ts, line_data = downsample(timestamps, hashrate_data, FULL_WIDTH_PX)
+band_ts, band_low, band_high = envelope(timestamps, hashrate_low, FULL_WIDTH_PX, high=hashrate_high)
 fig = go.Figure()
+fig.add_traces(envelope_traces(to_datetimes(band_ts), band_low, band_high, 'rgba(31, 119, 180, 0.15)'))
 fig.add_trace(go.Scatter(
-    x=dates,
-    y=hashrate_data,
+    x=to_datetimes(line_ts),
+    y=line_data,
     mode='lines',
     name='Hashrate (EH/s)',
     line=dict(color='#1f77b4', width=2)
@@ -68,14 +67,15 @@ with col1:
     """)
 with col2:
     # Mini chart for recent trends
-    recent_dates = dates[-30:]
-    recent_data = hashrate_data[-30:]
+    recent_ts, recent_data, _, _ = store.series('hashrate', now - 30 * DAY, now + 1, HALF_WIDTH_PX, value='mean')
+    recent_ts, recent_data = downsample(recent_ts, recent_data / 1e18, HALF_WIDTH_PX)
+    recent_dates = to_datetimes(recent_ts)
     
     mini_fig = go.Figure()
     mini_fig.add_trace(go.Scatter(
         x=recent_dates,
         y=recent_data,
-        mode='lines+markers',
+        mode='lines',
         name='30-Day Trend',
         line=dict(color='#ff7f0e', width=3)
     ))
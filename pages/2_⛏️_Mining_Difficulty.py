@@ -3,33 +3,12 @@ import streamlit as st
 # Page config
 st.set_page_config(page_title="Mining Difficulty", page_icon="⚙️", layout="wide")
 
-import plotly.graph_objects as go
-import pandas as pd
-import numpy as np
-import sys
-import os
-
-# Add parent directory to path for imports
-sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from database import Database
-from auth_handler import AuthHandler
-from payment_handler import PaymentHandler
-
 from navigation import add_navigation
+from sessions import end_session
 
 # NOW add navigation (after page config)
 add_navigation()
 
-# Initialize handlers
-@st.cache_resource
-def init_handlers():
-    db = Database()
-    auth_handler = AuthHandler(db)
-    payment_handler = PaymentHandler()
-    return db, auth_handler, payment_handler
-
-db, auth_handler, payment_handler = init_handlers()
-
 # Header with user info
 col1, col2 = st.columns([3, 1])
 with col1:
@@ -41,7 +20,7 @@ with col2:
             welcome_msg += " 👑"
         st.write(welcome_msg)
         if st.button("Logout", key="logout_difficulty"):
-            st.session_state.clear()
+            end_session()
             st.switch_page("Home.py")
     else:
         if st.button("Login", key="login_difficulty"):
@@ -51,24 +30,52 @@ with col2:
 st.title("⚙️ Mining Difficulty")
 st.write("Network difficulty adjustments and mining complexity metrics")
 
-# Sample difficulty data
-dates = pd.date_range(start='2024-01-01', end='2024-06-01', freq='D')
-difficulty_data = np.random.normal(15.5e12, 1e12, len(dates))
+# Charting libraries are imported here, after the header and navigation
+# have rendered, because they dominate the page's import time
+import time
+import plotly.graph_objects as go
+import numpy as np
+from metrics_store import get_metric_store, to_datetimes, pct_change, format_delta, format_value, DAY, HOUR
+from downsample import downsample, envelope, envelope_traces, FULL_WIDTH_PX
+# A year at the coarsest rollup resolution with a bucket per pixel (a few thousand rows, not every point)
+store = get_metric_store()
+now = time.time()
+timestamps, difficulty_data, difficulty_low, difficulty_high = store.series('difficulty', now - 365 * DAY, now + 1, FULL_WIDTH_PX, value='mean')
+if len(timestamps) == 0:
+    st.info("No difficulty data stored yet.")
+    st.stop()
+
+# 14-day projection from the trend of the last 30 days of hourly means (log-linear fit)
+latest = store.latest('difficulty')
+last_ts = latest[0] if latest else int(now)
+hourly = store.rollups('difficulty', HOUR, last_ts - 30 * DAY, last_ts + 1)
+future_days = np.arange(1, 15)
+future_timestamps = last_ts + future_days * DAY
+if len(hourly['bucket']) >= 2:
+    slope, intercept = np.polyfit((hourly['bucket'] - last_ts) / DAY, np.log(hourly['mean']), 1)
+    predicted_difficulty = np.exp(intercept + slope * future_days)
+else:
+    predicted_difficulty = np.full(len(future_timestamps), np.nan)
 
 # Current metrics
+current, current_change = store.change('difficulty', DAY)
+_, week_change = store.change('difficulty', 7 * DAY)
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.metric("Current Difficulty", "15.8T", "+1.2%")
+    st.metric("Current Difficulty", format_value(current, lambda v: f"{v / 1e12:.1f}T"), format_delta(current_change))
 with col2:
-    st.metric("Next Adjustment", "~2 days", "")
+    st.metric("7d Change", format_delta(week_change) or "—", "")
 with col3:
-    st.metric("Est. Change", "+0.8%", "")
+    st.metric("Est. Change (14d)", format_delta(pct_change(predicted_difficulty[-1], current)) or "—", "")
 
-# Difficulty chart
+# Difficulty chart - reduced to what the chart can show (LTTB line over a min/max band)
+line_ts, line_data = downsample(timestamps, difficulty_data, FULL_WIDTH_PX)
+band_ts, band_low, band_high = envelope(timestamps, difficulty_low, FULL_WIDTH_PX, high=difficulty_high)
 fig = go.Figure()
+fig.add_traces(envelope_traces(to_datetimes(band_ts), band_low, band_high, 'rgba(255, 127, 14, 0.15)'))
 fig.add_trace(go.Scatter(
-    x=dates,
-    y=difficulty_data,
+    x=to_datetimes(line_ts),
+    y=line_data,
     mode='lines',
     name='Difficulty',
     line=dict(color='#ff7f0e', width=2)
@@ -99,20 +106,19 @@ with col1:
 
 with col2:
     # Adjustment prediction chart
-    future_dates = pd.date_range(start='2024-06-01', periods=14, freq='D')
-    predicted_difficulty = np.random.normal(16.0e12, 0.5e12, 14)
+    future_dates = to_datetimes(future_timestamps)
     
     pred_fig = go.Figure()
     pred_fig.add_trace(go.Scatter(
         x=future_dates,
         y=predicted_difficulty,
         mode='lines+markers',
-        name='Predicted Difficulty',
+        name='Projected Difficulty',
         line=dict(color='#2ca02c', width=2, dash='dash')
     ))
     
     pred_fig.update_layout(
-        title="14-Day Difficulty Prediction",
+        title="14-Day Difficulty Projection",
         height=250,
         template="plotly_white"
     )
@@ -3,34 +3,12 @@ import streamlit as st
 # Page config MUST be first!
 st.set_page_config(page_title="Kaspa Price", page_icon="💵", layout="wide")
 
-import plotly.graph_objects as go
-import pandas as pd
-import numpy as np
-import sys
-import os
-
-# Add parent directory to path for imports
-parent_dir = os.path.dirname(os.path.dirname(__file__))
-sys.path.append(parent_dir)
-
-from database import Database
-from auth_handler import AuthHandler
-from payment_handler import PaymentHandler
 from navigation import add_navigation
+from sessions import end_session
 
 # Add shared navigation to sidebar
 add_navigation()
 
-# Initialize handlers
-@st.cache_resource
-def init_handlers():
-    db = Database()
-    auth_handler = AuthHandler(db)
-    payment_handler = PaymentHandler()
-    return db, auth_handler, payment_handler
-
-db, auth_handler, payment_handler = init_handlers()
-
 # Header with user info
 col1, col2 = st.columns([3, 1])
 with col1:
@@ -42,7 +20,7 @@ with col2:
             welcome_msg += " 👑"
         st.write(welcome_msg)
         if st.button("Logout", key="logout_price"):
-            st.session_state.clear()
+            end_session()
             st.switch_page("Home.py")
     else:
         if st.button("Login", key="login_price"):
@@ -52,26 +30,45 @@ with col2:
 st.title("💵 Kaspa Price")
 st.write("Real-time price data and market trends")
 
-# Sample price data
-dates = pd.date_range(start='2024-01-01', end='2024-06-01', freq='h')
-price_data = np.random.normal(0.125, 0.01, len(dates))
-
-# Current metrics
+# Charting libraries are imported here, after the header and navigation
+# have rendered, because they dominate the page's import time
+import time
+import plotly.graph_objects as go
+from metrics_store import get_metric_store, to_datetimes, format_delta, format_value, DAY, HOUR
+from downsample import downsample, envelope, envelope_traces, FULL_WIDTH_PX
+# Last 7 days at the coarsest rollup resolution with a bucket per pixel
+store = get_metric_store()
+now = time.time()
+timestamps, price_data, price_low, price_high = store.series('price', now - 7 * DAY, now + 1, FULL_WIDTH_PX)
+if len(timestamps) == 0:
+    st.info("No price data stored yet.")
+    st.stop()
+
+# Current metrics - the 24h range comes from whole rollup buckets plus the raw points at its edges
+current, change_pct = store.change('price', DAY)
+latest = store.latest('price')
+last_day = store.aggregate('price', latest[0] - DAY, latest[0] + 1) if latest else None
+high_24h = last_day['high'] if last_day else float('nan')
+low_24h = last_day['low'] if last_day else float('nan')
+change_abs = current - current / (1 + change_pct / 100)
 col1, col2, col3, col4 = st.columns(4)
 with col1:
-    st.metric("Current Price", "$0.1247", "+2.4%")
+    st.metric("Current Price", format_value(current, lambda v: f"${v:.4f}"), format_delta(change_pct))
 with col2:
-    st.metric("24h High", "$0.1289", "")
+    st.metric("24h High", format_value(high_24h, lambda v: f"${v:.4f}"), "")
 with col3:
-    st.metric("24h Low", "$0.1205", "")
+    st.metric("24h Low", format_value(low_24h, lambda v: f"${v:.4f}"), "")
 with col4:
-    st.metric("24h Change", "+$0.0029", "+2.4%")
+    st.metric("24h Change", format_value(change_abs, lambda v: f"{'-' if v < 0 else '+'}${abs(v):.4f}"), format_delta(change_pct))
 
-# Price chart
+# Price chart - reduced to what the chart can show (LTTB line over a min/max band)
+line_ts, line_data = downsample(timestamps, price_data, FULL_WIDTH_PX)
+band_ts, band_low, band_high = envelope(timestamps, price_low, FULL_WIDTH_PX, high=price_high)
 fig = go.Figure()
+fig.add_traces(envelope_traces(to_datetimes(band_ts), band_low, band_high, 'rgba(44, 160, 44, 0.15)'))
 fig.add_trace(go.Scatter(
-    x=dates[-168:],  # Last 7 days
-    y=price_data[-168:],
+    x=to_datetimes(line_ts),  # Last 7 days
+    y=line_data,
     mode='lines',
     name='KAS/USD',
     line=dict(color='#2ca02c', width=2)
@@ -102,8 +99,9 @@ with col1:
 
 with col2:
     # Volume chart
-    volume_dates = dates[-24:]  # Last 24 hours
-    volume_data = np.random.normal(5000000, 1000000, 24)
+    hourly_volume = store.rollups('volume', HOUR, now // HOUR * HOUR - 23 * HOUR, now + 1)
+    volume_dates = to_datetimes(hourly_volume['bucket'])  # Last 24 hours
+    volume_data = hourly_volume['sum']
     
     vol_fig = go.Figure()
     vol_fig.add_trace(go.Bar(
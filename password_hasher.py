@@ -0,0 +1,181 @@
+"""
+Bounded bcrypt executor.
+
+bcrypt releases the GIL while it hashes, so a small thread pool gives real
+parallelism without pickling anything across processes. Capping the pool
+keeps a burst of logins (or a credential-stuffing run) from taking every
+core away from the Streamlit script threads. Work beyond ``max_queue``
+waiting jobs is refused instead of queued.
+
+    python password_hasher.py --logins 50     # p50/p99 login latency benchmark
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+
+_COST = re.compile(r'^\$2[abxy]?\$(\d\d)\$')
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full or a job does not finish in time"""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, size-capped thread pool and records queue and hash timings"""
+
+    def __init__(self, max_workers=None, rounds=None, timeout=None, max_queue=None):
+        self.max_workers = int(max_workers or os.getenv('HASH_MAX_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+        self.rounds = int(rounds or os.getenv('BCRYPT_ROUNDS', '12'))
+        self.timeout = float(timeout or os.getenv('HASH_TIMEOUT_SECONDS', '5'))
+        self.max_queue = int(max_queue or os.getenv('HASH_MAX_QUEUE', '64'))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bcrypt')
+        self._lock = threading.Lock()
+        self._pending = 0
+        # Recent (queue_seconds, hash_seconds) samples for percentiles
+        self._samples = deque(maxlen=1000)
+        self._stats = {'jobs': 0, 'rejected': 0, 'timeouts': 0, 'rehashed': 0}
+
+    def _run(self, submitted, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            finished = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                self._samples.append((started - submitted, finished - started))
+
+    def submit(self, func, *args):
+        """Queue ``func(*args)`` on the hashing pool and return its future"""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._stats['rejected'] += 1
+                raise HasherBusy("Password hashing queue is full")
+            self._pending += 1
+            self._stats['jobs'] += 1
+        try:
+            return self._executor.submit(self._run, time.perf_counter(), func, *args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # A job still in the queue is dropped; one already hashing just finishes unobserved
+            cancelled = future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+                if cancelled:
+                    self._pending -= 1
+            raise HasherBusy("Password hashing timed out")
+
+    def hash(self, password):
+        """bcrypt hash of ``password`` at the configured cost"""
+        return self._wait(self.submit(_hash, password, self.rounds))
+
+    def verify(self, password, hashed):
+        return self._wait(self.submit(_check, password, hashed))
+
+    def needs_rehash(self, hashed):
+        """True when the stored hash was made with a different cost than the target"""
+        match = _COST.match(hashed or '')
+        return match is not None and int(match.group(1)) != self.rounds
+
+    def rehash_in_background(self, password, on_hashed):
+        """Hash ``password`` at the target cost and pass the result to ``on_hashed`` on the pool"""
+        def work():
+            on_hashed(_hash(password, self.rounds))
+            with self._lock:
+                self._stats['rehashed'] += 1
+        try:
+            self.submit(work)
+        except HasherBusy:
+            # Not urgent; the next login tries again
+            pass
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+            stats = dict(self._stats, pending=self._pending, max_workers=self.max_workers, rounds=self.rounds)
+        queue_times = sorted(sample[0] for sample in samples)
+        hash_times = sorted(sample[1] for sample in samples)
+        stats['queue_p50_ms'] = _percentile(queue_times, 50) * 1000
+        stats['queue_p99_ms'] = _percentile(queue_times, 99) * 1000
+        stats['hash_p50_ms'] = _percentile(hash_times, 50) * 1000
+        return stats
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    """Process-wide PasswordHasher, so every session shares the same concurrency cap"""
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                _hasher = PasswordHasher()
+    return _hasher
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark concurrent bcrypt logins")
+    parser.add_argument('--logins', type=int, default=50, help="concurrent login attempts")
+    parser.add_argument('--workers', type=int, default=None, help="hashing pool size (default: HASH_MAX_WORKERS)")
+    parser.add_argument('--rounds', type=int, default=12, help="bcrypt cost")
+    args = parser.parse_args(argv)
+
+    hasher = PasswordHasher(max_workers=args.workers, rounds=args.rounds, timeout=120,
+                            max_queue=args.logins)
+    stored = _hash('correct horse', args.rounds)
+    barrier = threading.Barrier(args.logins)
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def login():
+        barrier.wait()
+        started = time.perf_counter()
+        hasher.verify('correct horse', stored)
+        with latencies_lock:
+            latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=login) for _ in range(args.logins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    print(f"{args.logins} concurrent logins, {hasher.max_workers} hashing threads, cost {args.rounds}")
+    print(f"  login p50 {_percentile(latencies, 50) * 1000:.0f} ms, p99 {_percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"  pool: {hasher.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,80 @@
-import stripe
+import logging
 import os
+import socket
+import threading
+import time
+import uuid
 import streamlit as st
 
+logger = logging.getLogger(__name__)
+
+
+class StripeObjectCache:
+    """
+    Short-TTL cache of Stripe API objects, shared by every session in the process.
+
+    Concurrent requests for the same object wait for the first fetch instead
+    of making their own call. Objects are stored as plain dicts so they can be
+    shared between threads and don't depend on the stripe library's object type.
+    A fetched object that ``cacheable`` rejects is returned but not stored.
+    """
+
+    def __init__(self, ttl=60, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}  # key -> (expires_at, object)
+        self._inflight = {}  # key -> Event set when the fetch finishes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_fetch(self, key, fetch, cacheable=None):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hits += 1
+                    return entry[1]
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    waiter = self._inflight[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is fetching it; use their result (or retry if it failed)
+            waiter.wait(30)
+
+        try:
+            value = fetch().to_dict()
+            if cacheable is not None and not cacheable(value):
+                return value
+            with self._lock:
+                if len(self._entries) >= self.max_size:
+                    now = time.monotonic()
+                    self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                    if len(self._entries) >= self.max_size:
+                        self._entries.clear()
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            waiter.set()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+stripe_objects = StripeObjectCache(ttl=float(os.getenv('STRIPE_CACHE_TTL', '60')))
+
+# A checkout claimed by a session that died is retried after this long
+CHECKOUT_LEASE_SECONDS = float(os.getenv('CHECKOUT_LEASE_SECONDS', '60'))
+
+
+def plan_type_for_amount(amount):
+    return "Annual Premium" if (amount or 0) >= 9900 else "Monthly Premium"
+
+
 class PaymentHandler:
     def __init__(self):
         # Load Stripe keys from Streamlit secrets
@@ -15,9 +88,12 @@ class PaymentHandler:
             self.stripe_secret_key = None
             self.stripe_publishable_key = None
             self.domain = "http://localhost:8501"
-        
-        if self.stripe_secret_key:
-            stripe.api_key = self.stripe_secret_key
+
+    def _stripe(self):
+        """Import and configure the Stripe client on first use (it is slow to import)"""
+        import stripe
+        stripe.api_key = self.stripe_secret_key
+        return stripe
 
     def create_checkout_session(self, username):
         """Create a Stripe checkout session for premium upgrade"""
@@ -31,6 +107,8 @@ class PaymentHandler:
         interval = plan['interval']
             
         try:
+            stripe = self._stripe()
+            
             # Create product description based on interval
             if interval == 'year':
                 description = f'Annual subscription to premium analytics features (${price_amount/100:.2f}/year)'
@@ -58,6 +136,11 @@ class PaymentHandler:
                 cancel_url=f'{self.domain}/?upgrade=cancelled',
                 metadata={
                     'username': username
+                },
+                # Copied onto the subscription and its invoices, so webhook events
+                # (stripe_webhook.py) can find the user before checkout completes
+                subscription_data={
+                    'metadata': {'username': username}
                 }
             )
             
@@ -67,107 +150,95 @@ class PaymentHandler:
             st.error(f"Error creating checkout session: {str(e)}")
             return None
 
-    def handle_successful_payment(self, session_id, username):
-        """✅ FIXED: Handle successful payment and upgrade user with proper time calculation"""
+    def retrieve_checkout_session(self, session_id):
+        """Checkout session with its subscription expanded (one API call), as a dict.
+        Served from the process-wide cache for STRIPE_CACHE_TTL seconds."""
+        stripe = self._stripe()
+        return stripe_objects.get_or_fetch(
+            ('checkout.session', session_id),
+            lambda: stripe.checkout.Session.retrieve(session_id, expand=['subscription']),
+            # An unpaid session can be paid any moment; only the final state is worth keeping
+            cacheable=lambda session: session.get('payment_status') == 'paid'
+        )
+
+    def handle_successful_payment(self, session_id, username=None):
+        """Work out what a completed checkout pays for. Stripe errors propagate to the caller."""
         if not self.stripe_secret_key:
             return {'success': False}
-            
+
+        from datetime import datetime, timedelta
+        from stripe_subscriptions import current_period_end
+
+        session = self.retrieve_checkout_session(session_id)
+        if session.get('payment_status') != 'paid':
+            return {'success': False}
+
+        amount = session.get('amount_total') or 0
+        subscription = session.get('subscription')
+        subscription_id = subscription.get('id') if isinstance(subscription, dict) else subscription
+        expires_at = current_period_end(subscription) if isinstance(subscription, dict) else None
+        if not expires_at:
+            # No period end available: determine the plan from the Stripe amount ($99 or more = Annual)
+            expires_at = datetime.now() + timedelta(days=365 if amount >= 9900 else 30)
+
+        return {
+            'success': True,
+            'username': (session.get('metadata') or {}).get('username') or username,
+            'expires_at': expires_at.isoformat(),
+            'subscription_id': subscription_id,
+            'amount': amount
+        }
+
+    def process_checkout(self, db, session_id, email_handler=None):
+        """
+        Apply a completed checkout exactly once across sessions and replicas.
+
+        The first view claims the session in processed_checkouts, fetches it from
+        Stripe, upgrades the user, queues the welcome email and stores the result;
+        every later view (refresh, other tab, other replica) reads the stored result.
+        Returns the processed_checkouts row; status is 'done', 'processing'
+        (another view holds the claim) or 'failed'.
+        """
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        claimed, checkout = db.claim_checkout(session_id, owner, CHECKOUT_LEASE_SECONDS)
+        if not claimed:
+            if checkout['status'] != 'done':
+                checkout['status'] = 'processing'
+            return checkout
+
         try:
-            # Retrieve the session from Stripe
-            session = stripe.checkout.Session.retrieve(session_id)
-            
-            if session.payment_status == 'paid':
-                # Get subscription details to set expiration
-                subscription_id = session.subscription
-                
-                if subscription_id:
-                    try:
-                        subscription = stripe.Subscription.retrieve(subscription_id)
-                        
-                        # ✅ FIXED: Calculate expiration date from subscription properly
-                        from datetime import datetime
-                        
-                        # Check if current_period_end exists and is valid
-                        if hasattr(subscription, 'current_period_end') and subscription.current_period_end:
-                            current_period_end = subscription.current_period_end
-                            expires_at = datetime.fromtimestamp(current_period_end)
-                            
-                            st.write(f"Debug: Stripe subscription expires at: {expires_at.isoformat()}")
-                            
-                            return {
-                                'success': True,
-                                'expires_at': expires_at.isoformat(),
-                                'subscription_id': subscription_id,
-                                'amount': session.amount_total if hasattr(session, 'amount_total') else 0
-                            }
-                        else:
-                            # No current_period_end, fall back to manual calculation
-                            st.write("Debug: No current_period_end in subscription, using fallback")
-                            raise Exception("No current_period_end available")
-                            
-                    except Exception as sub_error:
-                        st.write(f"Debug: Error retrieving subscription: {sub_error}")
-                        # ✅ FIXED: Determine plan from Stripe amount instead of session state
-                        from datetime import datetime, timedelta
-                        
-                        # Use Stripe amount to determine plan type (more reliable)
-                        amount = session.amount_total if hasattr(session, 'amount_total') else 0
-                        now = datetime.now()
-                        
-                        if amount >= 9900:  # $99 or more = Annual
-                            expires_at = now + timedelta(days=365)
-                            st.write(f"Debug: Fallback calculation (YEARLY from amount ${amount/100:.2f}) - expires at: {expires_at.isoformat()}")
-                        else:  # Less than $99 = Monthly
-                            expires_at = now + timedelta(days=30)
-                            st.write(f"Debug: Fallback calculation (MONTHLY from amount ${amount/100:.2f}) - expires at: {expires_at.isoformat()}")
-                        
-                        return {
-                            'success': True,
-                            'expires_at': expires_at.isoformat(),
-                            'subscription_id': subscription_id,
-                            'amount': amount
-                        }
-                else:
-                    # ✅ FIXED: Determine plan from Stripe amount instead of session state
-                    from datetime import datetime, timedelta
-                    
-                    # Use Stripe amount to determine plan type (more reliable)
-                    amount = session.amount_total if hasattr(session, 'amount_total') else 0
-                    now = datetime.now()
-                    
-                    if amount >= 9900:  # $99 or more = Annual
-                        expires_at = now + timedelta(days=365)
-                        st.write(f"Debug: No subscription ID (YEARLY from amount ${amount/100:.2f}) - expires at: {expires_at.isoformat()}")
-                    else:  # Less than $99 = Monthly
-                        expires_at = now + timedelta(days=30)
-                        st.write(f"Debug: No subscription ID (MONTHLY from amount ${amount/100:.2f}) - expires at: {expires_at.isoformat()}")
-                    
-                    return {
-                        'success': True,
-                        'expires_at': expires_at.isoformat(),
-                        'subscription_id': None,
-                        'amount': amount
-                    }
-            else:
-                st.write(f"Debug: Payment not completed. Status: {session.payment_status}")
-                return {'success': False}
+            payment = self.handle_successful_payment(session_id)
+            if not payment.get('success'):
+                raise ValueError("Payment verification failed")
+            username = payment['username']
+            if not username:
+                raise ValueError("Could not identify user from payment")
+
+            # (update_premium_status handles resubscription after cancellation)
+            if not db.update_premium_status(username, True, payment['expires_at'], payment['subscription_id']):
+                raise RuntimeError(f"Could not upgrade {username}")
+            profile = db.load_session_profile(username)
+            plan_type = plan_type_for_amount(payment['amount'])
+
+            if email_handler is not None and profile:
+                # Keyed by checkout session: the outbox sends it once even if this is retried
+                email_handler.send_premium_subscription_email(
+                    profile['email'], profile['name'], plan_type, idempotency_key=f"premium:{session_id}")
+
+            expires_at = profile['premium_expires_at'] if profile else payment['expires_at']
+            db.complete_checkout(session_id, owner, username, payment['subscription_id'],
+                                 expires_at, payment['amount'], plan_type)
+            checkout.update({
+                'status': 'done',
+                'username': username,
+                'subscription_id': payment['subscription_id'],
+                'expires_at': expires_at,
+                'amount': payment['amount'],
+                'plan_type': plan_type,
+                'error': None
+            })
         except Exception as e:
-            st.write(f"Debug: Error in handle_successful_payment: {e}")
-            # ✅ FIXED: Use session state as fallback when Stripe data unavailable
-            from datetime import datetime, timedelta
-            plan = st.session_state.get('selected_plan', {'interval': 'month'})
-            
-            now = datetime.now()
-            if plan['interval'] == 'year':
-                expires_at = now + timedelta(days=365)
-                st.write(f"Debug: Exception fallback (YEARLY from session) - expires at: {expires_at.isoformat()}")
-            else:
-                expires_at = now + timedelta(days=30)
-                st.write(f"Debug: Exception fallback (MONTHLY from session) - expires at: {expires_at.isoformat()}")
-            
-            return {
-                'success': True,
-                'expires_at': expires_at.isoformat(),
-                'subscription_id': None,
-                'amount': 0
-            }
+            logger.warning("Could not process checkout %s: %s", session_id, e)
+            db.fail_checkout(session_id, owner, e)
+            checkout.update({'status': 'failed', 'error': str(e)})
+        return checkout
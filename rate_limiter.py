@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    """Raised when a login attempt is throttled; ``retry_after`` is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many attempts, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def client_key(headers, fallback=None, trusted_proxies=None):
+    """
+    Client identity from request headers (``st.context.headers``).
+
+    Every proxy appends the address it received the request from to
+    X-Forwarded-For, so only the right-most ``trusted_proxies`` hops
+    (LOGIN_TRUSTED_PROXIES, default 1) were written by our own proxies; the
+    hop the outermost of them appended is the client. Anything to its left
+    came from the client and is ignored. With no trusted proxies, or no
+    header, returns ``fallback`` (e.g. ``st.context.ip_address``).
+    """
+    if trusted_proxies is None:
+        trusted_proxies = int(os.getenv('LOGIN_TRUSTED_PROXIES', '1'))
+    try:
+        forwarded = headers.get('X-Forwarded-For') if trusted_proxies > 0 else None
+        hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()] if forwarded else []
+        if hops:
+            return hops[-min(trusted_proxies, len(hops))]
+        return fallback
+    except Exception:
+        return fallback
+
+
+class RateLimiter:
+    """Spaces calls evenly so that at most ``rate`` start per second across all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TokenBucketLimiter:
+    """In-process token buckets with LRU eviction.
+
+    Each key holds only (tokens, last_refill), refilled lazily on access, so
+    memory is O(1) per key and bounded by ``max_keys``. An evicted key comes
+    back with a full bucket, which only ever errs towards allowing.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last_refill)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, key):
+        """Take one token for ``key``. Returns 0 when allowed, else seconds until a token is free"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last_refill = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last_refill) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+                self.allowed += 1
+            else:
+                retry_after = (1 - tokens) / self.rate
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._buckets),
+                'max_keys': self.max_keys,
+                'allowed': self.allowed,
+                'rejected': self.rejected
+            }
+
+
+class LoginThrottle:
+    """
+    Per-username and per-client login throttling, checked before any bcrypt work.
+
+    Buckets live in process memory. With ``shared=True`` every attempt that
+    passes locally is also charged against the login_throttle table, so all
+    replicas share one budget per key; if the database is unreachable the
+    local buckets still apply.
+    """
+
+    def __init__(self, db=None, user_rate_per_minute=None, user_burst=None,
+                 client_rate_per_minute=None, client_burst=None, max_keys=None, shared=None):
+        user_rate = float(user_rate_per_minute or os.getenv('LOGIN_USER_RATE_PER_MINUTE', '5')) / 60
+        client_rate = float(client_rate_per_minute or os.getenv('LOGIN_CLIENT_RATE_PER_MINUTE', '20')) / 60
+        max_keys = int(max_keys or os.getenv('LOGIN_THROTTLE_MAX_KEYS', '10000'))
+
+        self.user_limiter = TokenBucketLimiter(user_rate, float(user_burst or os.getenv('LOGIN_USER_BURST', '5')), max_keys)
+        self.client_limiter = TokenBucketLimiter(client_rate, float(client_burst or os.getenv('LOGIN_CLIENT_BURST', '20')), max_keys)
+
+        if shared is None:
+            shared = os.getenv('LOGIN_THROTTLE_SHARED', '').lower() in ('1', 'true', 'yes')
+        self.db = db if shared else None
+        self._last_purge = time.monotonic()
+
+    def _check_shared(self, key, limiter):
+        if self.db is None:
+            return 0
+        if not self.db.consume_throttle_token(key, limiter.rate, limiter.burst):
+            return 1 / limiter.rate
+        return 0
+
+    def _purge_shared(self):
+        # Buckets idle long enough to be full again carry no information
+        if self.db is None or time.monotonic() - self._last_purge < 600:
+            return
+        self._last_purge = time.monotonic()
+        slowest = min(self.user_limiter.rate, self.client_limiter.rate)
+        longest_refill = max(self.user_limiter.burst, self.client_limiter.burst) / slowest
+        self.db.purge_throttle_buckets(time.time() - longest_refill)
+
+    def check(self, username=None, client=None):
+        """Raise RateLimited if this attempt is over either budget"""
+        checks = []
+        if client:
+            checks.append(('client:' + client, self.client_limiter))
+        if username:
+            checks.append(('user:' + username.lower(), self.user_limiter))
+
+        for key, limiter in checks:
+            retry_after = limiter.acquire(key) or self._check_shared(key, limiter)
+            if retry_after:
+                raise RateLimited(retry_after)
+        self._purge_shared()
+
+    def stats(self):
+        return {
+            'user': self.user_limiter.stats(),
+            'client': self.client_limiter.stats(),
+            'shared': self.db is not None
+        }
@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from rate_limiter import RateLimiter
+from stripe_subscriptions import ACTIVE_STATUSES, REVOKED_STATUSES, billing_interval, current_period_end
+
+logger = logging.getLogger(__name__)
+
+
+class RenewalEngine:
+    """
+    Batched subscription renewal sweep.
+
+    1. Load every candidate row in one query.
+    2. Check Stripe subscription status on a bounded thread pool, rate limited.
+    3. Apply all extensions and cancellations of a batch in one transaction.
+
+    Renewal emails go out through a single EmailHandler after each batch commits.
+    """
+
+    def __init__(self, db, max_workers=None, requests_per_second=None, batch_size=None):
+        self.db = db
+        self.max_workers = int(max_workers or os.getenv('RENEWAL_MAX_WORKERS', '8'))
+        # One Stripe call per candidate, so a sweep takes about candidates / rate seconds
+        # (5,000 expired subscriptions: ~1 minute at 80/s). Live mode allows ~100 reads/s;
+        # set RENEWAL_STRIPE_RPS to 20 or less against a test-mode key (limit 25/s).
+        self.rate_limiter = RateLimiter(float(requests_per_second or os.getenv('RENEWAL_STRIPE_RPS', '80')))
+        self.batch_size = int(batch_size or os.getenv('RENEWAL_BATCH_SIZE', '500'))
+        self._email_handler = None
+
+    def _configure_stripe(self):
+        import stripe
+        stripe.api_key = st.secrets["default"]["STRIPE_SECRET_KEY"]
+        # Let the client retry 429s and network errors with its own backoff
+        stripe.max_network_retries = 2
+        return stripe
+
+    def _check_subscription(self, stripe, candidate):
+        """
+        Return ('renew', new_expiry, plan_name), ('cancel', status, None),
+        ('unchanged', status, None) or ('unknown', error, None). Statuses are
+        read the way reconciliation and webhooks read them.
+        """
+        self.rate_limiter.wait()
+        try:
+            subscription = stripe.Subscription.retrieve(candidate['stripe_subscription_id'])
+        except Exception as e:
+            return 'unknown', str(e), None
+
+        if subscription.status in ACTIVE_STATUSES:
+            annual = billing_interval(subscription) == 'year'
+            # Same expiry reconciliation and webhooks use: the end of the paid period
+            new_expiry = current_period_end(subscription) or datetime.now() + timedelta(days=365 if annual else 30)
+            return 'renew', new_expiry, "Annual" if annual else "Monthly"
+        if subscription.status in REVOKED_STATUSES:
+            return 'cancel', subscription.status, None
+        # past_due / incomplete / paused: Stripe is still retrying payment
+        return 'unchanged', subscription.status, None
+
+    def _send_renewal_emails(self, renewed):
+        if not renewed:
+            return
+        try:
+            if self._email_handler is None:
+                # Import here to avoid circular imports
+                from services import get_email_handler
+                self._email_handler = get_email_handler()
+            for candidate, new_expiry, plan_name in renewed:
+                try:
+                    self._email_handler.send_renewal_notification_email(
+                        candidate['email'],
+                        candidate['name'],
+                        plan_name,
+                        new_expiry.strftime('%Y-%m-%d'),
+                        idempotency_key=f"renewal:{candidate['username']}:{new_expiry:%Y-%m-%d}"
+                    )
+                except Exception as e:
+                    logger.warning("Could not send renewal email to %s: %s", candidate['email'], e)
+        except Exception as e:
+            # Don't fail the renewal if email fails
+            logger.warning("Could not send renewal emails: %s", e)
+
+    def run(self):
+        """Run one sweep and return a report with counts and per-batch timings"""
+        started = time.perf_counter()
+        report = {'candidates': 0, 'renewed': 0, 'cancelled': 0, 'unchanged': 0, 'unknown': 0, 'batches': []}
+
+        candidates = self.db.get_renewal_candidates()
+        report['candidates'] = len(candidates)
+        report['load_seconds'] = time.perf_counter() - started
+        if not candidates:
+            report['total_seconds'] = report['load_seconds']
+            return report
+
+        stripe = self._configure_stripe()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='renewal') as pool:
+            for offset in range(0, len(candidates), self.batch_size):
+                batch = candidates[offset:offset + self.batch_size]
+                batch_started = time.perf_counter()
+
+                results = list(pool.map(lambda c: self._check_subscription(stripe, c), batch))
+                checked = time.perf_counter()
+
+                extensions, cancellations, renewed = [], [], []
+                unchanged = unknown = 0
+                for candidate, (action, detail, plan_name) in zip(batch, results):
+                    if action == 'renew':
+                        extensions.append((candidate['username'], detail.isoformat()))
+                        renewed.append((candidate, detail, plan_name))
+                    elif action == 'cancel':
+                        cancellations.append(candidate['username'])
+                        logger.info("%s: subscription %s - premium access removed", candidate['username'], detail)
+                    elif action == 'unchanged':
+                        # Left as is; checked again next sweep
+                        unchanged += 1
+                        logger.info("%s: subscription %s - waiting on Stripe", candidate['username'], detail)
+                    else:
+                        # If we can't reach Stripe, don't change anything
+                        unknown += 1
+                        logger.warning("Could not check Stripe for %s: %s", candidate['username'], detail)
+
+                self.db.apply_renewal_batch(extensions, cancellations)
+                applied = time.perf_counter()
+
+                self._send_renewal_emails(renewed)
+
+                batch_report = {
+                    'size': len(batch),
+                    'renewed': len(extensions),
+                    'cancelled': len(cancellations),
+                    'unchanged': unchanged,
+                    'unknown': unknown,
+                    'stripe_seconds': checked - batch_started,
+                    'apply_seconds': applied - checked,
+                    'email_seconds': time.perf_counter() - applied
+                }
+                report['batches'].append(batch_report)
+                report['renewed'] += len(extensions)
+                report['cancelled'] += len(cancellations)
+                report['unchanged'] += unchanged
+                report['unknown'] += unknown
+                logger.info("Renewal batch %d: %s", len(report['batches']), batch_report)
+
+        report['total_seconds'] = time.perf_counter() - started
+        logger.info("Renewal sweep complete: %d candidates, %d renewed, %d cancelled, %d unchanged, %d unknown in %.2fs",
+                    report['candidates'], report['renewed'], report['cancelled'], report['unchanged'], report['unknown'],
+                    report['total_seconds'])
+        return report
@@ -0,0 +1,118 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+RENEWAL_JOB = 'subscription_renewal'
+RESET_TOKEN_PURGE_JOB = 'reset_token_purge'
+OUTBOX_PURGE_JOB = 'email_outbox_purge'
+
+
+def _setting(name, default):
+    """Read a scheduler setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+class RenewalScheduler(threading.Thread):
+    """
+    Process-wide background thread that runs the subscription renewal sweep.
+
+    Every replica runs one of these, but a sweep only starts after the
+    replica claims the job's lease in the job_runs table, so at most one
+    replica sweeps at a time and the last run is shared by all of them.
+    Expired password reset tokens and old sent/dead outbox messages are
+    purged on the same thread, each under its own job lease.
+    """
+
+    def __init__(self, db, interval_hours=None, poll_seconds=None, lease_seconds=None):
+        super().__init__(name='renewal-scheduler', daemon=True)
+        self.db = db
+        self.interval_seconds = float(interval_hours or _setting('RENEWAL_INTERVAL_HOURS', 24)) * 3600
+        # How often to ask the database whether a sweep is due
+        self.poll_seconds = float(poll_seconds or _setting('RENEWAL_POLL_SECONDS', 300))
+        # A crashed sweep's lease expires after this long and another replica takes over
+        self.lease_seconds = float(lease_seconds or _setting('RENEWAL_LEASE_SECONDS', 1800))
+        self.purge_interval_seconds = float(_setting('RESET_TOKEN_PURGE_HOURS', 1)) * 3600
+        self.outbox_purge_interval_seconds = float(_setting('OUTBOX_PURGE_HOURS', 24)) * 3600
+        # Sent and dead messages are kept this long for inspection, then deleted
+        self.outbox_retention_seconds = float(_setting('EMAIL_OUTBOX_RETENTION_DAYS', 7)) * 86400
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # Don't compete with the app's first page render for the database
+        if self._stop_event.wait(5):
+            return
+        while not self._stop_event.is_set():
+            self.run_once()
+            self.purge_reset_tokens_once()
+            self.purge_outbox_once()
+            self._stop_event.wait(self.poll_seconds)
+
+    def run_once(self):
+        """Run a sweep if it is due and this replica wins the lease. Returns True if it ran."""
+        if not self.db.claim_due_job(RENEWAL_JOB, self.owner, self.interval_seconds, self.lease_seconds):
+            return False
+
+        result = 'error'
+        try:
+            renewed, cancelled = self.db.run_renewal_sweep()
+            result = f"{renewed} renewed, {cancelled} cancelled"
+        except Exception as e:
+            logger.exception("Renewal sweep failed: %s", e)
+        finally:
+            self.db.complete_job(RENEWAL_JOB, self.owner, result)
+        return True
+
+    def purge_reset_tokens_once(self):
+        """Delete expired reset tokens if the purge is due and this replica wins the lease"""
+        if not self.db.claim_due_job(RESET_TOKEN_PURGE_JOB, self.owner, self.purge_interval_seconds, self.lease_seconds):
+            return False
+
+        result = 'error'
+        try:
+            result = f"{self.db.purge_expired_reset_tokens()} purged"
+        except Exception as e:
+            logger.exception("Reset token purge failed: %s", e)
+        finally:
+            self.db.complete_job(RESET_TOKEN_PURGE_JOB, self.owner, result)
+        return True
+
+    def purge_outbox_once(self):
+        """Delete old sent and dead outbox messages if the purge is due and this replica wins the lease"""
+        if not self.db.claim_due_job(OUTBOX_PURGE_JOB, self.owner, self.outbox_purge_interval_seconds, self.lease_seconds):
+            return False
+
+        result = 'error'
+        try:
+            result = f"{self.db.purge_outbox(self.outbox_retention_seconds)} purged"
+        except Exception as e:
+            logger.exception("Email outbox purge failed: %s", e)
+        finally:
+            self.db.complete_job(OUTBOX_PURGE_JOB, self.owner, result)
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_renewal_scheduler(db):
+    """Start the process-wide renewal scheduler once; later calls are no-ops"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = RenewalScheduler(db)
+            _scheduler.start()
+        return _scheduler
@@ -0,0 +1,139 @@
+import threading
+import time
+
+
+class ServiceRegistry:
+    """
+    Process-wide registry of lazily built services.
+
+    Each service is constructed once, on first use, by whichever thread asks
+    first; other threads asking for the same service wait for that build
+    instead of starting their own. Services that are never used are never
+    built.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._health_checks = {}
+        self._instances = {}
+        self._errors = {}
+        self._init_seconds = {}
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def register(self, name, factory, health_check=None):
+        with self._registry_lock:
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+            if health_check is not None:
+                self._health_checks[name] = health_check
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                started = time.perf_counter()
+                try:
+                    instance = self._factories[name]()
+                except Exception as e:
+                    # Keep the error for status(); the next call retries the build
+                    self._errors[name] = str(e)
+                    raise
+                self._init_seconds[name] = time.perf_counter() - started
+                self._errors.pop(name, None)
+                self._instances[name] = instance
+        return instance
+
+    def is_ready(self, name):
+        return name in self._instances
+
+    def status(self):
+        """Readiness of every registered service without building anything"""
+        return {
+            name: {
+                'ready': name in self._instances,
+                'init_seconds': self._init_seconds.get(name),
+                'error': self._errors.get(name)
+            }
+            for name in self._factories
+        }
+
+    def health(self):
+        """Run the health check of every service that has been built"""
+        results = {}
+        for name, status in self.status().items():
+            check = self._health_checks.get(name)
+            if status['ready'] and check is not None:
+                try:
+                    status['healthy'], status['detail'] = check(self._instances[name])
+                except Exception as e:
+                    status['healthy'], status['detail'] = False, str(e)
+            else:
+                status['healthy'] = status['ready'] if check is None else None
+            results[name] = status
+        return results
+
+
+def _build_database():
+    from database import Database
+    return Database()
+
+
+def _build_auth_handler():
+    from auth_handler import AuthHandler
+    return AuthHandler(get_database())
+
+
+def _build_payment_handler():
+    from payment_handler import PaymentHandler
+    return PaymentHandler()
+
+
+def _build_email_handler():
+    from email_handler import EmailHandler
+    return EmailHandler()
+
+
+def _database_health(db):
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+    return True, db.pool_stats()
+
+
+registry = ServiceRegistry()
+registry.register('database', _build_database, _database_health)
+registry.register('auth_handler', _build_auth_handler)
+registry.register('payment_handler', _build_payment_handler,
+                  lambda handler: (bool(handler.stripe_secret_key), "Stripe configured" if handler.stripe_secret_key else "Stripe not configured"))
+registry.register('email_handler', _build_email_handler,
+                  lambda handler: (handler.mailjet is not None, "Mailjet configured" if handler.mailjet else "Mailjet not configured"))
+
+
+def get_database():
+    return registry.get('database')
+
+
+def get_auth_handler():
+    return registry.get('auth_handler')
+
+
+def get_payment_handler():
+    return registry.get('payment_handler')
+
+
+def get_email_handler():
+    return registry.get('email_handler')
+
+
+def service_status():
+    return registry.status()
+
+
+def service_health():
+    return registry.health()
@@ -0,0 +1,188 @@
+"""
+Remember-me sessions.
+
+A signed-in browser gets a random session id in the cookie configured by
+config.yaml's ``cookie`` block. The server keeps only its sha256 in
+user_sessions, so a leaked table can't be replayed as cookies. A new tab
+resumes with one primary-key lookup instead of a password check.
+
+Expiry slides with use: last-seen times are collected in memory and
+written in one batched UPDATE every SESSION_FLUSH_SECONDS.
+"""
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# session_state keys
+SESSION_ID_KEY = 'session_id_hash'
+PENDING_COOKIE_KEY = 'pending_session_cookie'
+# st.context.cookies is fixed for the life of the websocket, so look it up once
+RESTORE_CHECKED_KEY = 'session_restore_checked'
+
+
+def _cookie_settings():
+    """Cookie name and lifetime from config.yaml, with safe defaults"""
+    name, expiry_days = 'kaspa_auth_cookie', 30
+    try:
+        import yaml
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')) as f:
+            cookie = (yaml.safe_load(f) or {}).get('cookie') or {}
+        name = cookie.get('name') or name
+        expiry_days = float(cookie.get('expiry_days') or expiry_days)
+    except Exception as e:
+        logger.warning("Could not read cookie settings from config.yaml: %s", e)
+    return name, expiry_days
+
+
+COOKIE_NAME, COOKIE_EXPIRY_DAYS = _cookie_settings()
+
+
+def hash_session_id(session_id):
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+
+
+class SessionStore:
+    """Server side of remember-me sessions, with batched last-seen writes"""
+
+    def __init__(self, db, ttl_seconds=None, flush_seconds=None):
+        self.db = db
+        self.ttl_seconds = float(ttl_seconds or COOKIE_EXPIRY_DAYS * 86400)
+        self.flush_seconds = float(flush_seconds or os.getenv('SESSION_FLUSH_SECONDS', '60'))
+        self._seen = {}  # id_hash -> last seen epoch seconds
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._last_purge = time.monotonic()
+
+    def create(self, username):
+        """Start a session and return the raw id for the cookie (None if it couldn't be stored)"""
+        session_id = secrets.token_urlsafe(32)
+        if self.db.create_user_session(hash_session_id(session_id), username, time.time() + self.ttl_seconds):
+            return session_id
+        return None
+
+    def resume(self, session_id):
+        """Profile for a live session id, or None"""
+        if not session_id:
+            return None
+        return self.db.resume_user_session(hash_session_id(session_id))
+
+    def touch(self, id_hash):
+        """Record activity; written to the database with everyone else's on the next flush"""
+        with self._lock:
+            self._seen[id_hash] = time.time()
+            if time.monotonic() - self._last_flush < self.flush_seconds:
+                return
+            seen, self._seen = self._seen, {}
+            self._last_flush = time.monotonic()
+        self.db.touch_user_sessions(seen, self.ttl_seconds)
+
+        if time.monotonic() - self._last_purge > 3600:
+            self._last_purge = time.monotonic()
+            self.db.purge_expired_sessions()
+
+    def revoke(self, id_hash):
+        with self._lock:
+            self._seen.pop(id_hash, None)
+        self.db.delete_user_session(id_hash)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from services import get_database
+                _store = SessionStore(get_database())
+    return _store
+
+
+def _apply_pending_cookie():
+    """
+    Cookies can only be written by a browser component, which needs a
+    page that stays rendered; login and logout switch pages straight away,
+    so the write is queued and applied on the next page.
+    """
+    pending = st.session_state.get(PENDING_COOKIE_KEY)
+    if not pending:
+        return
+    import extra_streamlit_components as stx
+    cookie_manager = stx.CookieManager(key='session_cookie_manager')
+    action, value = pending
+    if action == 'set':
+        # lax, not strict, so the cookie comes along on the redirect back from Stripe Checkout
+        cookie_manager.set(COOKIE_NAME, value, key='session_cookie_set', same_site='lax',
+                           expires_at=datetime.now() + timedelta(days=COOKIE_EXPIRY_DAYS))
+    else:
+        cookie_manager.delete(COOKIE_NAME, key='session_cookie_delete')
+    del st.session_state[PENDING_COOKIE_KEY]
+
+
+def remember_login(username):
+    """Start a remember-me session for a user who just signed in"""
+    session_id = get_session_store().create(username)
+    if session_id:
+        st.session_state[SESSION_ID_KEY] = hash_session_id(session_id)
+        st.session_state[PENDING_COOKIE_KEY] = ('set', session_id)
+
+
+def restore_session():
+    """
+    Called on every page (from add_navigation). Signs the browser back in
+    from its session cookie when this Streamlit session isn't, and records
+    activity for sliding expiry when it is.
+    """
+    _apply_pending_cookie()
+
+    if st.session_state.get('authentication_status'):
+        id_hash = st.session_state.get(SESSION_ID_KEY)
+        if id_hash:
+            get_session_store().touch(id_hash)
+        return
+
+    if st.session_state.get(RESTORE_CHECKED_KEY):
+        return
+    st.session_state[RESTORE_CHECKED_KEY] = True
+    try:
+        session_id = st.context.cookies.get(COOKIE_NAME)
+    except Exception:
+        session_id = None
+    if not session_id or not isinstance(session_id, str):
+        return
+
+    store = get_session_store()
+    profile = store.resume(session_id)
+    if profile is None:
+        # Expired or revoked: drop the stale cookie
+        st.session_state[PENDING_COOKIE_KEY] = ('delete', None)
+        _apply_pending_cookie()
+        return
+
+    from entitlements import grant
+    st.session_state['authentication_status'] = True
+    st.session_state['username'] = profile['username']
+    st.session_state['name'] = profile['name']
+    st.session_state[SESSION_ID_KEY] = hash_session_id(session_id)
+    grant(profile['username'], profile)
+    store.touch(st.session_state[SESSION_ID_KEY])
+
+
+def end_session():
+    """Log out: revoke the server-side session, clear state and drop the cookie"""
+    id_hash = st.session_state.get(SESSION_ID_KEY)
+    if id_hash:
+        get_session_store().revoke(id_hash)
+    st.session_state.clear()
+    st.session_state[PENDING_COOKIE_KEY] = ('delete', None)
+    st.session_state[RESTORE_CHECKED_KEY] = True
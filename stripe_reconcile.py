@@ -0,0 +1,141 @@
+"""
+Full reconciliation of Stripe subscriptions against the users table.
+
+Pages through every subscription in Stripe (list API, auto-pagination) into
+a compact in-memory list sorted by id, streams users with a subscription id
+from the database, merge-joins the two on subscription id and applies the
+differences with set-based UPDATEs.
+
+Run headless:
+
+    python stripe_reconcile.py [--dry-run] [--api-base http://localhost:12111]
+
+--api-base points the Stripe client at a local stand-in such as stripe-mock.
+"""
+import argparse
+import logging
+import os
+import time
+from datetime import timedelta
+
+from stripe_subscriptions import ACTIVE_STATUSES, REVOKED_STATUSES, current_period_end
+
+logger = logging.getLogger(__name__)
+
+# Expiry differences smaller than this are treated as equal
+EXPIRY_TOLERANCE = timedelta(minutes=1)
+
+
+def fetch_stripe_subscriptions(stripe, page_size=100):
+    """
+    Every subscription in Stripe as compact (id, status, period_end) tuples, sorted by id.
+    Pages are read one at a time, but the tuples are all held in memory so they can be sorted.
+    """
+    subscriptions = [
+        (subscription['id'], subscription['status'], current_period_end(subscription))
+        for subscription in stripe.Subscription.list(status='all', limit=page_size).auto_paging_iter()
+    ]
+    # Stripe pages by creation date; the merge join needs id order
+    subscriptions.sort(key=lambda sub: sub[0])
+    return subscriptions
+
+
+def diff_subscriptions(stripe_subscriptions, user_rows):
+    """
+    Merge-join Stripe subscriptions with user rows, both sorted by subscription id.
+    Returns (extensions, cancellations, stats) in the shape Database.apply_renewal_batch takes.
+    """
+    from database import parse_timestamp
+
+    extensions, cancellations = [], []
+    stats = {'users': 0, 'stripe': len(stripe_subscriptions), 'matched': 0,
+             'missing_in_stripe': 0, 'unchanged': 0}
+
+    stripe_iter = iter(stripe_subscriptions)
+    current = next(stripe_iter, None)
+
+    for username, subscription_id, is_premium, expires_at in user_rows:
+        stats['users'] += 1
+        while current is not None and current[0] < subscription_id:
+            current = next(stripe_iter, None)
+
+        if current is None or current[0] != subscription_id:
+            stats['missing_in_stripe'] += 1
+            logger.warning("%s: subscription %s not found in Stripe", username, subscription_id)
+            continue
+
+        stats['matched'] += 1
+        _, status, period_end = current
+
+        if status in ACTIVE_STATUSES and period_end:
+            stored_expiry = parse_timestamp(expires_at)
+            if (not is_premium or stored_expiry is None
+                    or abs(stored_expiry - period_end) > EXPIRY_TOLERANCE):
+                extensions.append((username, period_end.isoformat()))
+                continue
+        elif status in REVOKED_STATUSES:
+            cancellations.append(username)
+            continue
+
+        stats['unchanged'] += 1
+
+    return extensions, cancellations, stats
+
+
+def reconcile(db, stripe, dry_run=False, apply_batch_size=1000):
+    """Run a full reconciliation and return a report dict"""
+    started = time.perf_counter()
+
+    stripe_subscriptions = fetch_stripe_subscriptions(stripe)
+    fetched = time.perf_counter()
+
+    extensions, cancellations, report = diff_subscriptions(stripe_subscriptions, db.iter_subscribed_users())
+    diffed = time.perf_counter()
+
+    if not dry_run:
+        # Applied after the stream is closed so no read cursor is held open meanwhile
+        for offset in range(0, max(len(extensions), len(cancellations)), apply_batch_size):
+            db.apply_renewal_batch(extensions[offset:offset + apply_batch_size],
+                                   cancellations[offset:offset + apply_batch_size])
+
+    report.update({
+        'extended': len(extensions),
+        'cancelled': len(cancellations),
+        'dry_run': dry_run,
+        'stripe_seconds': fetched - started,
+        'diff_seconds': diffed - fetched,
+        'apply_seconds': time.perf_counter() - diffed,
+    })
+    logger.info("Stripe reconciliation: %s", report)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile Stripe subscriptions with the users table")
+    parser.add_argument('--dry-run', action='store_true', help="compute differences without writing them")
+    parser.add_argument('--api-base', default=os.getenv('STRIPE_API_BASE'),
+                        help="Stripe API base URL, e.g. a local stripe-mock server")
+    parser.add_argument('--api-key', default=os.getenv('STRIPE_SECRET_KEY'),
+                        help="Stripe secret key (defaults to STRIPE_SECRET_KEY or Streamlit secrets)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    import stripe
+    from database import Database
+
+    api_key = args.api_key
+    if not api_key:
+        import streamlit as st
+        api_key = st.secrets["default"]["STRIPE_SECRET_KEY"]
+    stripe.api_key = api_key
+    stripe.max_network_retries = 2
+    if args.api_base:
+        stripe.api_base = args.api_base
+
+    report = reconcile(Database(), stripe, dry_run=args.dry_run)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Helpers for reading Stripe subscription payloads.
+
+Shared by every path that turns a subscription into a premium expiry (the
+renewal sweep, reconciliation, webhooks and checkout) so they all agree on
+when a paid period ends.
+"""
+from datetime import datetime
+
+# Statuses that keep premium access; anything in REVOKED_STATUSES removes it.
+# past_due / incomplete / paused are left alone while Stripe retries payment.
+ACTIVE_STATUSES = ('active', 'trialing')
+REVOKED_STATUSES = ('canceled', 'unpaid', 'incomplete_expired')
+
+
+def _as_dict(obj):
+    """Plain dict of a webhook payload or a StripeObject (which isn't a dict in newer clients)"""
+    return obj.to_dict() if hasattr(obj, 'to_dict') else obj
+
+
+def current_period_end(subscription):
+    """
+    End of the subscription's current paid period as a naive local datetime, or None.
+    current_period_end moved from the subscription to its items in newer API versions.
+    """
+    subscription = _as_dict(subscription)
+    end = subscription.get('current_period_end')
+    if not end:
+        items = (subscription.get('items') or {}).get('data') or []
+        end = max((item.get('current_period_end') or 0 for item in items), default=0)
+    return datetime.fromtimestamp(end) if end else None
+
+
+def billing_interval(subscription):
+    """'month', 'year' or None, from the subscription's plan or its first item's price"""
+    subscription = _as_dict(subscription)
+    plan = subscription.get('plan') or {}
+    if plan.get('interval'):
+        return plan['interval']
+    items = (subscription.get('items') or {}).get('data') or []
+    if items:
+        item = items[0]
+        recurring = (item.get('price') or {}).get('recurring') or {}
+        return recurring.get('interval') or (item.get('plan') or {}).get('interval')
+    return None
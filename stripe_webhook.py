@@ -0,0 +1,259 @@
+"""
+Stripe webhook sidecar.
+
+A small ASGI app that receives Stripe events, verifies their signature,
+records each event id in stripe_events (so redeliveries are no-ops) and
+applies the premium change through Database in the same transaction. No
+Stripe API calls are made while handling an event: everything needed is in
+the payload.
+
+    checkout.session.completed       link the subscription to the user
+    invoice.paid                     premium until the end of the paid period
+    customer.subscription.updated    extend while active, revoke once ended
+    customer.subscription.deleted    revoke
+
+Subscriptions already keep expiry current this way, so the renewal sweep
+only finds the ones whose events were missed.
+
+    uvicorn stripe_webhook:app --port 8502          # or: python stripe_webhook.py
+    python stripe_webhook.py --send event.json      # sign a local payload and POST it
+
+Point a Stripe webhook endpoint at https://<host>/stripe/webhook and set
+STRIPE_WEBHOOK_SECRET to its signing secret.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from stripe_subscriptions import ACTIVE_STATUSES, REVOKED_STATUSES, current_period_end
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/stripe/webhook'
+# Stripe events are a few KB; anything far bigger isn't one
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def _setting(name, default):
+    """Read a webhook setting from Streamlit secrets, then the environment"""
+    try:
+        return st.secrets["default"][name]
+    except Exception:
+        return os.getenv(name, default)
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header for ``payload`` (bytes), as Stripe would send it; for local testing"""
+    timestamp = int(timestamp or time.time())
+    signed = f"{timestamp}.".encode('utf-8') + payload
+    signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def _id(value):
+    """Expandable fields arrive as an id or, when expanded, as the object"""
+    return value.get('id') if isinstance(value, dict) else value
+
+
+def _subscription_details(invoice):
+    # Newer API versions moved these under invoice.parent
+    return ((invoice.get('parent') or {}).get('subscription_details')
+            or invoice.get('subscription_details') or {})
+
+
+def event_change(event):
+    """The premium change an event calls for, in Database.apply_stripe_event's shape, or None"""
+    event_type = event.get('type')
+    obj = (event.get('data') or {}).get('object') or {}
+
+    if event_type == 'checkout.session.completed':
+        username = (obj.get('metadata') or {}).get('username')
+        subscription_id = _id(obj.get('subscription'))
+        if obj.get('mode') != 'subscription' or obj.get('payment_status') != 'paid' or not username or not subscription_id:
+            return None
+        # Provisional until the subscription's invoice.paid brings the real period end;
+        # same rule as PaymentHandler's fallback: $99 or more is the annual plan
+        days = 365 if (obj.get('amount_total') or 0) >= 9900 else 30
+        return {'action': 'link', 'username': username, 'subscription_id': subscription_id,
+                'expires_at': datetime.now() + timedelta(days=days)}
+
+    if event_type == 'invoice.paid':
+        details = _subscription_details(obj)
+        subscription_id = _id(obj.get('subscription') or details.get('subscription'))
+        lines = (obj.get('lines') or {}).get('data') or []
+        period_end = max(((line.get('period') or {}).get('end') or 0 for line in lines), default=0)
+        if not subscription_id or not period_end:
+            return None
+        return {'action': 'extend', 'username': (details.get('metadata') or {}).get('username'),
+                'subscription_id': subscription_id, 'expires_at': datetime.fromtimestamp(period_end)}
+
+    if event_type in ('customer.subscription.updated', 'customer.subscription.deleted'):
+        username = (obj.get('metadata') or {}).get('username')
+        status = 'canceled' if event_type == 'customer.subscription.deleted' else obj.get('status')
+        if status in REVOKED_STATUSES:
+            return {'action': 'revoke', 'username': username, 'subscription_id': obj.get('id')}
+        period_end = current_period_end(obj)
+        if status in ACTIVE_STATUSES and period_end:
+            return {'action': 'extend', 'username': username, 'subscription_id': obj.get('id'),
+                    'expires_at': period_end}
+        # past_due / incomplete / paused: left alone while Stripe retries payment
+        return None
+
+    return None
+
+
+class WebhookApp:
+    """ASGI application: POST /stripe/webhook for events, GET /healthz for probes"""
+
+    def __init__(self, db=None, secret=None, tolerance=None):
+        self._db = db
+        self.secret = secret or _setting('STRIPE_WEBHOOK_SECRET', None)
+        self.tolerance = int(tolerance or _setting('STRIPE_WEBHOOK_TOLERANCE', 300))
+        self.counts = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            from database import Database
+            self._db = Database()
+        return self._db
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        if scope['path'] == '/healthz' and scope['method'] == 'GET':
+            return await self._respond(send, 200, {'ok': True, 'events': self.counts})
+        if scope['path'] != WEBHOOK_PATH:
+            return await self._respond(send, 404, {'error': 'not found'})
+        if scope['method'] != 'POST':
+            return await self._respond(send, 405, {'error': 'method not allowed'})
+
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._respond(send, 413, {'error': 'payload too large'})
+        headers = dict(scope.get('headers') or [])
+        status, result = await self.handle(body, headers.get(b'stripe-signature', b'').decode('latin-1'))
+        await self._respond(send, status, result)
+
+    async def handle(self, payload, signature):
+        """Verify and apply one delivery. Returns (http status, response body)."""
+        if not self.secret:
+            logger.error("STRIPE_WEBHOOK_SECRET is not set; refusing webhook")
+            return 500, {'error': 'webhook secret not configured'}
+        try:
+            from stripe import WebhookSignature
+            WebhookSignature.verify_header(payload.decode('utf-8'), signature, self.secret, self.tolerance)
+            event = json.loads(payload)
+        except Exception as e:
+            logger.warning("Rejected webhook: %s", e)
+            return 400, {'error': 'invalid signature or payload'}
+
+        try:
+            change = event_change(event)
+            # The database driver blocks; keep the event loop free for other deliveries
+            outcome = await asyncio.to_thread(
+                self.db.apply_stripe_event, event['id'], event['type'], event.get('created') or time.time(), change)
+        except Exception as e:
+            # A non-2xx makes Stripe redeliver; nothing was committed
+            logger.exception("Could not apply Stripe event %s: %s", event.get('id'), e)
+            return 500, {'error': 'could not apply event'}
+
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        log = logger.warning if outcome in ('unmatched', 'stale') else logger.info
+        log("Stripe event %s (%s): %s", event['id'], event['type'], outcome)
+        return 200, {'received': True, 'outcome': outcome}
+
+    @staticmethod
+    async def _read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                return None
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    async def _respond(send, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Connect and migrate before the first delivery rather than during it
+                try:
+                    await asyncio.to_thread(lambda: self.db)
+                    # This process outlives app restarts; let it deliver queued mail too
+                    from email_outbox import start_outbox_worker
+                    start_outbox_worker(self.db)
+                    await send({'type': 'lifespan.startup.complete'})
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = WebhookApp()
+
+
+def send_test_event(path, url, secret):
+    """Sign a local event payload and POST it to a running sidecar; returns (status, body)"""
+    import urllib.error
+    import urllib.request
+
+    with open(path, 'rb') as f:
+        payload = f.read()
+    request = urllib.request.Request(url, data=payload, method='POST', headers={
+        'Content-Type': 'application/json',
+        'Stripe-Signature': sign_payload(payload, secret)
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stripe webhook sidecar")
+    parser.add_argument('--host', default=os.getenv('STRIPE_WEBHOOK_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('STRIPE_WEBHOOK_PORT', '8502')))
+    parser.add_argument('--send', metavar='EVENT_JSON',
+                        help="sign EVENT_JSON with the webhook secret and POST it to --url instead of serving")
+    parser.add_argument('--url', help="endpoint for --send (default: this host/port)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.send:
+        if not app.secret:
+            parser.error("STRIPE_WEBHOOK_SECRET is not set")
+        url = args.url or f"http://{args.host}:{args.port}{WEBHOOK_PATH}"
+        print(*send_test_event(args.send, url, app.secret))
+        return
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level='info')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A Database on a fresh SQLite file (migrated, with the demo users)"""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    from database import Database, user_cache
+    user_cache.clear()
+    return Database()
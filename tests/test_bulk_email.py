@@ -0,0 +1,59 @@
+import pytest
+
+from email_handler import BulkEmailSender
+
+
+class FakeBulkSender:
+    """Records every message; the call numbered ``fail_on`` raises like a dropped connection"""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.calls = 0
+        self.delivered = []
+
+    def build_message(self, to_email, to_name, subject, text_part, html_part, custom_id=None, campaign=None):
+        return {'to': to_email, 'subject': subject, 'text': text_part, 'custom_id': custom_id}
+
+    def send_many(self, messages):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise ConnectionError("connection reset")
+        self.delivered.extend(message['to'] for message in messages)
+        return [True] * len(messages), [None] * len(messages), False
+
+
+@pytest.fixture
+def audience(db):
+    """Ten extra users, every other one premium; returns the premium audience's emails"""
+    with db.get_connection() as conn:
+        conn.executemany('INSERT INTO users (username, email, password, name, is_premium) VALUES (?, ?, ?, ?, ?)',
+                         [(f"user{i}", f"user{i}@example.com", 'x', f"User {i}", i % 2 == 0) for i in range(10)])
+        conn.commit()
+    return [email for _, _, email, _ in db.iter_campaign_recipients('premium')]
+
+
+def send(db, sender, audience='premium'):
+    bulk = BulkEmailSender(db, sender=sender, batch_size=2, max_workers=1, requests_per_second=1000)
+    return bulk.send_campaign('spring-digest', 'News for $name', 'Hello $name', audience=audience)
+
+
+def test_campaign_renders_each_recipient(db, audience):
+    sender = FakeBulkSender()
+    report = send(db, sender)
+    assert sender.delivered == audience
+    assert report['sent'] == len(audience) and report['failed'] == 0
+
+
+def test_resume_uses_the_stored_audience(db, audience):
+    crashed = FakeBulkSender(fail_on=2)
+    with pytest.raises(ConnectionError):
+        send(db, crashed)
+    assert crashed.delivered[:2] == audience[:2]
+
+    resumed = FakeBulkSender()
+    report = send(db, resumed, audience='all')
+
+    assert report['audience'] == 'premium'
+    assert report['resumed_from'] > 0
+    # Only batches that were in flight at the crash can go out twice
+    assert resumed.delivered == audience[2:]
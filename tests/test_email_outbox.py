@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import email_outbox
+from email_outbox import MailjetSender, OutboxWorker, start_outbox_worker
+
+
+class FakeSender:
+    """Answers each send with the next scripted (sent, error, retryable), then succeeds"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        return self.results.pop(0) if self.results else (True, None, False)
+
+
+def enqueue(db, key='welcome:alice', to_email='alice@example.com'):
+    return db.enqueue_email(key, to_email, 'Alice', 'Welcome', 'text', '<p>html</p>')
+
+
+def outbox_row(db, message_id):
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT status, attempts, next_attempt_at, last_error, sent_at FROM email_outbox WHERE id = ?',
+                       (message_id,))
+        return dict(zip(('status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'), cursor.fetchone()))
+
+
+def make_worker(db, sender, **kwargs):
+    kwargs.setdefault('max_attempts', 3)
+    kwargs.setdefault('base_backoff_seconds', 30)
+    return OutboxWorker(db, sender=sender, poll_seconds=30, batch_size=10, lease_seconds=300, **kwargs)
+
+
+def test_enqueue_ignores_a_repeated_idempotency_key(db):
+    assert enqueue(db)
+    assert not enqueue(db)
+    assert db.get_outbox_stats() == {'pending': 1}
+
+
+def test_claim_leases_messages_until_the_lease_runs_out(db):
+    enqueue(db)
+    [message] = db.claim_outbox_batch(10, lease_seconds=300)
+    assert message['attempts'] == 1
+    assert outbox_row(db, message['id'])['status'] == 'sending'
+    # Leased: another worker can't take it
+    assert db.claim_outbox_batch(10, lease_seconds=300) == []
+
+    # An expired lease (the worker died mid-send) makes it due again
+    with db.get_connection() as conn:
+        conn.execute('UPDATE email_outbox SET next_attempt_at = ?', (time.time() - 1,))
+        conn.commit()
+    [again] = db.claim_outbox_batch(10, lease_seconds=300)
+    assert again['id'] == message['id'] and again['attempts'] == 2
+
+
+def test_sent_message_is_marked_sent(db):
+    enqueue(db)
+    sender = FakeSender()
+    assert make_worker(db, sender).run_once() == 1
+    row = outbox_row(db, sender.sent[0]['id'])
+    assert row['status'] == 'sent' and row['sent_at'] is not None
+    assert make_worker(db, sender).run_once() == 0
+
+
+def test_retryable_failure_backs_off(db):
+    enqueue(db)
+    worker = make_worker(db, FakeSender((False, 'Mailjet API error 503', True)))
+    started = time.time()
+
+    assert worker.run_once() == 1
+    row = outbox_row(db, 1)
+    assert row['status'] == 'pending'
+    assert row['last_error'] == 'Mailjet API error 503'
+    # Full jitter over base * 2^(attempts - 1): within 30s for the first retry
+    assert started <= row['next_attempt_at'] <= time.time() + 30
+    assert all(0 <= worker.backoff(attempts) <= min(3600, 30 * 2 ** (attempts - 1)) for attempts in range(1, 12))
+
+
+def test_dead_letter_after_max_attempts(db):
+    enqueue(db)
+    failure = (False, 'Mailjet API error 503', True)
+    worker = make_worker(db, FakeSender(failure, failure, failure), max_attempts=3)
+    worker.backoff = lambda attempts: -1  # due again straight away
+
+    for _ in range(3):
+        assert worker.run_once() == 1
+    assert outbox_row(db, 1)['status'] == 'dead'
+    assert outbox_row(db, 1)['attempts'] == 3
+    assert worker.run_once() == 0
+
+
+def test_rejected_message_is_dead_lettered_without_retrying(db):
+    enqueue(db)
+    make_worker(db, FakeSender((False, 'Invalid email address', False))).run_once()
+    row = outbox_row(db, 1)
+    assert row['status'] == 'dead' and row['attempts'] == 1
+
+
+def message_body(db, message_id):
+    with db.get_connection() as conn:
+        return conn.execute('SELECT text_part, html_part FROM email_outbox WHERE id = ?', (message_id,)).fetchone()
+
+
+def test_body_is_cleared_once_a_message_is_finished(db):
+    # Reset emails carry a live token; it must not outlive delivery
+    enqueue(db, 'reset:alice', 'alice@example.com')
+    enqueue(db, 'reset:bad', 'bad@example.com')
+    failure = (False, 'Mailjet API error 503', True)
+    worker = make_worker(db, FakeSender(failure, (False, 'Invalid email address', False)))
+
+    worker.run_once()
+    assert message_body(db, 1) == ('text', '<p>html</p>')  # kept for the retry
+    assert message_body(db, 2) == (None, None)  # dead
+
+    with db.get_connection() as conn:
+        conn.execute('UPDATE email_outbox SET next_attempt_at = ? WHERE id = 1', (time.time() - 1,))
+        conn.commit()
+    worker.run_once()
+    assert outbox_row(db, 1)['status'] == 'sent'
+    assert message_body(db, 1) == (None, None)
+
+
+def test_purge_deletes_only_old_finished_messages(db):
+    for key in ('old:sent', 'old:dead', 'new:sent', 'old:pending'):
+        enqueue(db, key)
+    day = 86400
+    with db.get_connection() as conn:
+        conn.executemany('UPDATE email_outbox SET status = ?, next_attempt_at = ? WHERE idempotency_key = ?', [
+            ('sent', time.time() - 8 * day, 'old:sent'),
+            ('dead', time.time() - 8 * day, 'old:dead'),
+            ('sent', time.time() - day, 'new:sent'),
+            ('pending', time.time() - 8 * day, 'old:pending'),
+        ])
+        conn.commit()
+
+    assert db.purge_outbox(7 * day, batch_size=1) == 2
+    with db.get_connection() as conn:
+        keys = sorted(row[0] for row in conn.execute('SELECT idempotency_key FROM email_outbox'))
+    assert keys == ['new:sent', 'old:pending']
+
+
+def test_outbox_purge_runs_as_a_scheduled_job(db):
+    from renewal_scheduler import RenewalScheduler
+
+    enqueue(db)
+    with db.get_connection() as conn:
+        conn.execute("UPDATE email_outbox SET status = 'sent', next_attempt_at = ?", (time.time() - 30 * 86400,))
+        conn.commit()
+    scheduler = RenewalScheduler(db)
+    assert scheduler.purge_outbox_once()
+    assert db.get_outbox_stats() == {}
+    # Not due again until OUTBOX_PURGE_HOURS have passed
+    assert not scheduler.purge_outbox_once()
+
+
+def test_wake_during_a_drain_is_not_lost(db):
+    sender = FakeSender()
+    worker = make_worker(db, sender)
+    claim = db.claim_outbox_batch
+    state = {'passes': 0}
+
+    def claim_then_enqueue(limit, lease_seconds):
+        messages = claim(limit, lease_seconds)
+        if not messages and state['passes'] == 0:
+            # A page queues an email just as the worker finds the outbox empty
+            state['passes'] += 1
+            enqueue(db)
+            worker.wake()
+        return messages
+
+    db.claim_outbox_batch = claim_then_enqueue
+    worker.start()
+    try:
+        deadline = time.time() + 5
+        while not sender.sent and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+        worker.join(5)
+    # Delivered on the wake, not after the 30s poll interval
+    assert len(sender.sent) == 1
+
+
+def test_worker_started_at_process_start_drains_earlier_messages(db, monkeypatch):
+    # Left behind by a previous process: one never tried, one mid-backoff, one leased by a worker that died
+    for key in ('welcome:alice', 'welcome:bob', 'welcome:carol'):
+        enqueue(db, key, f"{key.split(':')[1]}@example.com")
+    with db.get_connection() as conn:
+        conn.execute("UPDATE email_outbox SET attempts = 2, last_error = '503' WHERE idempotency_key = 'welcome:bob'")
+        conn.execute("UPDATE email_outbox SET status = 'sending', attempts = 1 WHERE idempotency_key = 'welcome:carol'")
+        conn.commit()
+
+    sender = FakeSender()
+    monkeypatch.setattr(email_outbox, '_sender', sender)
+    monkeypatch.setattr(email_outbox, '_worker', None)
+    worker = start_outbox_worker(db)
+    try:
+        deadline = time.time() + 5
+        while len(sender.sent) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+        worker.join(5)
+    assert sorted(message['idempotency_key'] for message in sender.sent) == [
+        'welcome:alice', 'welcome:bob', 'welcome:carol']
+    assert db.get_outbox_stats() == {'sent': 3}
+
+
+class MailjetStandIn(BaseHTTPRequestHandler):
+    """POST /v3.1/send: 503 while ``failures`` remain, 400 with per-message errors for bad@ addresses"""
+    failures = 0
+    received = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        cls = type(self)
+        if cls.failures:
+            cls.failures -= 1
+            return self._reply(503, {'ErrorMessage': 'busy'})
+        cls.received.append((self.path, body))
+        results = [
+            {'Status': 'error', 'Errors': [{'ErrorMessage': 'Invalid email'}]}
+            if message['To'][0]['Email'].startswith('bad@') else {'Status': 'success'}
+            for message in body['Messages']
+        ]
+        self._reply(400 if any(result['Status'] == 'error' for result in results) else 200, {'Messages': results})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mailjet():
+    MailjetStandIn.failures = 0
+    MailjetStandIn.received = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MailjetStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield MailjetSender('key', 'secret', 'noreply@example.com', 'Kaspa Analytics',
+                        api_url=f"http://127.0.0.1:{server.server_address[1]}/", timeout=5)
+    server.shutdown()
+
+
+def test_worker_drains_the_outbox_through_mailjet(db, mailjet):
+    enqueue(db, 'welcome:alice', 'alice@example.com')
+    enqueue(db, 'welcome:bad', 'bad@example.com')
+    MailjetStandIn.failures = 1
+    worker = make_worker(db, mailjet)
+    worker.backoff = lambda attempts: -1
+
+    while worker.run_once():
+        pass
+
+    assert db.get_outbox_stats() == {'sent': 1, 'dead': 1}
+    delivered = [(path, message['CustomID']) for path, body in MailjetStandIn.received for message in body['Messages']]
+    assert delivered == [('/v3.1/send', 'welcome:bad'), ('/v3.1/send', 'welcome:alice')]
+
+
+def test_mailjet_errors_are_classified(mailjet):
+    good = mailjet.build_message('alice@example.com', 'Alice', 'Hi', 'text', '<p>html</p>')
+    bad = mailjet.build_message('bad@example.com', 'Bad', 'Hi', 'text', '<p>html</p>')
+
+    MailjetStandIn.failures = 1
+    sent, errors, retryable = mailjet.send_many([good])
+    assert sent == [False] and retryable
+
+    sent, errors, retryable = mailjet.send_many([good, bad])
+    assert sent == [True, False] and not retryable
+    assert errors == [None, 'Invalid email']
@@ -0,0 +1,26 @@
+import glob
+import os
+
+import pytest
+
+import import_profile
+
+PAGES = ['Home.py'] + sorted(os.path.relpath(page, import_profile.ROOT)
+                             for page in glob.glob(os.path.join(import_profile.ROOT, 'pages', '*.py')))
+
+# Only the chart pages may load these, and only once the page needs them
+DEFERRED = ('numpy', 'pandas', 'plotly', 'stripe', 'mailjet_rest', 'psycopg2')
+CHART_PAGES = ('Mining_Hashrate', 'Mining_Difficulty', 'Spot_Price')
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_cold_imports_within_budget(page):
+    imports = import_profile.import_times(os.path.join(import_profile.ROOT, page))
+    total_ms = sum(micros for _, micros, depth in imports if depth == 0) / 1000
+    assert total_ms <= import_profile.DEFAULT_BUDGET_MS, (
+        f"{page}: {total_ms:.0f} ms of cold imports, budget {import_profile.DEFAULT_BUDGET_MS:.0f} ms "
+        f"(python import_profile.py {page} for the breakdown)")
+
+    if not any(name in page for name in CHART_PAGES):
+        deferred = sorted({name.split('.')[0] for name, _, _ in imports} & set(DEFERRED))
+        assert not deferred, f"{page} imports {deferred} at load"
@@ -0,0 +1,27 @@
+import time
+
+from database import hash_token
+
+
+def test_reset_revokes_remember_me_sessions(db):
+    db.add_user('alice', 'alice@example.com', 'password123', 'Alice')
+    db.add_user('bob', 'bob@example.com', 'password123', 'Bob')
+    db.create_user_session('alice-cookie', 'alice', time.time() + 3600)
+    db.create_user_session('bob-cookie', 'bob', time.time() + 3600)
+    assert db.resume_user_session('alice-cookie')['username'] == 'alice'
+
+    token = db.create_reset_token('alice@example.com')
+    assert db.reset_password(token, 'new-password-456')
+
+    assert db.resume_user_session('alice-cookie') is None
+    assert db.resume_user_session('bob-cookie')['username'] == 'bob'
+
+
+def test_reset_token_is_single_use(db):
+    db.add_user('alice', 'alice@example.com', 'password123', 'Alice')
+    token = db.create_reset_token('alice@example.com')
+
+    assert db.reset_password(token, 'new-password-456')
+    assert not db.reset_password(token, 'another-password')
+    assert db.verify_reset_token(token) is None
+    assert hash_token(token) != token
@@ -0,0 +1,44 @@
+import stripe
+
+from payment_handler import StripeObjectCache
+
+
+def checkout_session(payment_status):
+    return stripe.StripeObject.construct_from({
+        'id': 'cs_test_1',
+        'payment_status': payment_status,
+        'subscription': {'id': 'sub_1', 'current_period_end': 1893456000},
+    }, 'sk_test')
+
+
+def is_paid(session):
+    return session.get('payment_status') == 'paid'
+
+
+def test_objects_are_cached_as_plain_dicts():
+    cache = StripeObjectCache(ttl=60)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return checkout_session('paid')
+
+    first = cache.get_or_fetch(('checkout.session', 'cs_test_1'), fetch, cacheable=is_paid)
+    second = cache.get_or_fetch(('checkout.session', 'cs_test_1'), fetch, cacheable=is_paid)
+    assert type(first) is dict and type(first['subscription']) is dict
+    assert second == first
+    assert len(calls) == 1
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+
+def test_unpaid_checkout_is_fetched_again():
+    cache = StripeObjectCache(ttl=60)
+    statuses = ['unpaid', 'paid']
+
+    def fetch():
+        return checkout_session(statuses.pop(0))
+
+    assert cache.get_or_fetch('cs', fetch, cacheable=is_paid)['payment_status'] == 'unpaid'
+    # Paid a moment later: the next view sees it instead of a stale 'unpaid'
+    assert cache.get_or_fetch('cs', fetch, cacheable=is_paid)['payment_status'] == 'paid'
+    assert cache.stats()['size'] == 1
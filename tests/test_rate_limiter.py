@@ -0,0 +1,32 @@
+import pytest
+
+from rate_limiter import LoginThrottle, RateLimited, client_key
+
+
+def test_client_key_takes_the_hop_our_proxy_appended():
+    headers = {'X-Forwarded-For': '6.6.6.6, 203.0.113.7'}
+    assert client_key(headers, '10.0.0.2', trusted_proxies=1) == '203.0.113.7'
+
+
+def test_spoofed_forwarded_for_does_not_change_the_key():
+    keys = {client_key({'X-Forwarded-For': f"10.9.{i}.1, 203.0.113.7"}, trusted_proxies=1) for i in range(50)}
+    assert keys == {'203.0.113.7'}
+
+
+def test_client_key_counts_back_through_trusted_proxies():
+    headers = {'X-Forwarded-For': '6.6.6.6, 203.0.113.7, 10.0.0.5'}
+    assert client_key(headers, trusted_proxies=2) == '203.0.113.7'
+
+
+def test_client_key_falls_back_to_the_socket_address():
+    assert client_key({}, '198.51.100.4', trusted_proxies=1) == '198.51.100.4'
+    headers = {'X-Forwarded-For': '6.6.6.6'}
+    assert client_key(headers, '198.51.100.4', trusted_proxies=0) == '198.51.100.4'
+
+
+def test_rotating_forwarded_for_is_throttled_as_one_client():
+    throttle = LoginThrottle(client_rate_per_minute=1, client_burst=3, user_rate_per_minute=600, user_burst=100)
+    for i in range(3):
+        throttle.check(client=client_key({'X-Forwarded-For': f"10.0.0.{i}, 203.0.113.7"}, trusted_proxies=1))
+    with pytest.raises(RateLimited):
+        throttle.check(client=client_key({'X-Forwarded-For': '10.0.0.99, 203.0.113.7'}, trusted_proxies=1))
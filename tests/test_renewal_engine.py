@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from stripe import StripeObject
+
+from renewal_engine import RenewalEngine
+
+
+class FakeSubscriptions:
+    def __init__(self, statuses, period_end):
+        self.statuses = statuses
+        self.period_end = period_end
+
+    def retrieve(self, subscription_id):
+        return StripeObject.construct_from({
+            'id': subscription_id,
+            'object': 'subscription',
+            'status': self.statuses[subscription_id],
+            'items': {'object': 'list', 'data': [{
+                'current_period_end': int(self.period_end.timestamp()),
+                'price': {'recurring': {'interval': 'month'}},
+            }]},
+        }, 'sk_test')
+
+
+class FakeStripe:
+    def __init__(self, statuses, period_end):
+        self.Subscription = FakeSubscriptions(statuses, period_end)
+
+
+class FakeEmailHandler:
+    def __init__(self):
+        self.renewals = []
+
+    def send_renewal_notification_email(self, email, name, plan_name, expiry, idempotency_key=None):
+        self.renewals.append((email, plan_name, expiry))
+
+
+def expires_at(user):
+    return datetime.fromisoformat(str(user['premium_expires_at']))
+
+
+def test_sweep_reads_statuses_like_reconcile_and_webhooks(db):
+    period_end = (datetime.now() + timedelta(days=30)).replace(microsecond=0)
+    expired = (datetime.now() - timedelta(days=1)).replace(microsecond=0)
+    statuses = {
+        'sub_active': 'active',
+        'sub_trialing': 'trialing',
+        'sub_past_due': 'past_due',
+        'sub_incomplete': 'incomplete',
+        'sub_canceled': 'canceled',
+        'sub_unpaid': 'unpaid',
+    }
+    for subscription_id in statuses:
+        username = subscription_id[4:]
+        db.add_user(username, f"{username}@example.com", 'password123', username)
+        db.update_premium_status(username, True, expired.isoformat(), subscription_id)
+
+    engine = RenewalEngine(db, max_workers=2, requests_per_second=1000)
+    engine._configure_stripe = lambda: FakeStripe(statuses, period_end)
+    engine._email_handler = FakeEmailHandler()
+    report = engine.run()
+
+    assert (report['renewed'], report['cancelled'], report['unchanged'], report['unknown']) == (2, 2, 2, 0)
+    for username in ('active', 'trialing'):
+        user = db.get_user(username)
+        assert user['is_premium']
+        assert expires_at(user) == period_end
+    # Stripe is still retrying payment: nothing changes until it settles
+    for username in ('past_due', 'incomplete'):
+        user = db.get_user(username)
+        assert user['is_premium'] and expires_at(user) == expired
+        assert user['stripe_subscription_id'] == f"sub_{username}"
+    for username in ('canceled', 'unpaid'):
+        user = db.get_user(username)
+        assert not user['is_premium'] and user['stripe_subscription_id'] == 'CANCELLED'
+    assert sorted(email for email, _, _ in engine._email_handler.renewals) == [
+        'active@example.com', 'trialing@example.com']
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+from stripe import StripeObject
+
+import stripe_reconcile
+
+
+class FakeListPage:
+    """One page of a Stripe list call; auto_paging_iter follows has_more like the real client"""
+
+    def __init__(self, client, data, has_more, params):
+        self.client = client
+        self.data = data
+        self.has_more = has_more
+        self.params = params
+
+    def auto_paging_iter(self):
+        page = self
+        while True:
+            yield from page.data
+            if not page.has_more:
+                return
+            page = self.client.list(**dict(page.params, starting_after=page.data[-1]['id']))
+
+
+class FakeSubscriptions:
+    """Subscription.list stand-in: newest first, ``limit`` per page, counts requests"""
+
+    def __init__(self, subscriptions):
+        self.subscriptions = sorted(subscriptions, key=lambda sub: -sub['created'])
+        self.requests = []
+
+    def list(self, status='all', limit=10, starting_after=None):
+        self.requests.append(starting_after)
+        start = 0
+        if starting_after:
+            start = next(i for i, sub in enumerate(self.subscriptions) if sub['id'] == starting_after) + 1
+        data = self.subscriptions[start:start + limit]
+        return FakeListPage(self, data, start + limit < len(self.subscriptions),
+                            {'status': status, 'limit': limit})
+
+
+class FakeStripe:
+    def __init__(self, subscriptions):
+        self.Subscription = FakeSubscriptions(subscriptions)
+
+
+def subscription(sub_id, status, period_end, created):
+    """A subscription as the client returns it, with the period end on its item (newer API versions)"""
+    return StripeObject.construct_from({
+        'id': sub_id,
+        'object': 'subscription',
+        'status': status,
+        'created': created,
+        'items': {'object': 'list', 'data': [{'current_period_end': int(period_end.timestamp())}]},
+    }, 'sk_test')
+
+
+def test_fetch_pages_through_every_subscription_in_id_order():
+    period_end = datetime(2030, 1, 1)
+    stripe = FakeStripe([subscription(f"sub_{i:03d}", 'active', period_end, created=i) for i in range(250)])
+
+    fetched = stripe_reconcile.fetch_stripe_subscriptions(stripe, page_size=100)
+
+    assert [sub_id for sub_id, _, _ in fetched] == [f"sub_{i:03d}" for i in range(250)]
+    assert fetched[0][1:] == ('active', period_end)
+    assert len(stripe.Subscription.requests) == 3
+
+
+def test_reconcile_extends_revokes_and_leaves_the_rest(db):
+    period_end = (datetime.now() + timedelta(days=30)).replace(microsecond=0)
+    stale = datetime.now() - timedelta(days=2)
+    for username in ('extend', 'current', 'revoke', 'missing'):
+        db.add_user(username, f"{username}@example.com", 'password123', username)
+    db.update_premium_status('extend', True, stale.isoformat(), 'sub_a')
+    db.update_premium_status('current', True, period_end.isoformat(), 'sub_b')
+    db.update_premium_status('revoke', True, stale.isoformat(), 'sub_c')
+    db.update_premium_status('missing', True, stale.isoformat(), 'sub_z')
+    stripe = FakeStripe([
+        subscription('sub_a', 'active', period_end, created=3),
+        subscription('sub_b', 'trialing', period_end, created=2),
+        subscription('sub_c', 'canceled', stale, created=1),
+    ])
+
+    report = stripe_reconcile.reconcile(db, stripe)
+
+    assert report['extended'] == 1
+    assert report['cancelled'] == 1
+    assert report['missing_in_stripe'] == 1
+    assert report['unchanged'] == 1
+    db.user_cache.clear()
+    assert datetime.fromisoformat(str(db.get_user('extend')['premium_expires_at'])) == period_end
+    revoked = db.get_user('revoke')
+    assert not revoked['is_premium'] and revoked['stripe_subscription_id'] == 'CANCELLED'
+    assert db.get_user('missing')['is_premium']
+
+
+def test_dry_run_writes_nothing(db):
+    stale = datetime.now() - timedelta(days=2)
+    db.add_user('lapsed', 'lapsed@example.com', 'password123', 'Lapsed')
+    db.update_premium_status('lapsed', True, stale.isoformat(), 'sub_a')
+    stripe = FakeStripe([subscription('sub_a', 'canceled', stale, created=1)])
+
+    report = stripe_reconcile.reconcile(db, stripe, dry_run=True)
+
+    assert report['cancelled'] == 1
+    db.user_cache.clear()
+    assert db.get_user('lapsed')['stripe_subscription_id'] == 'sub_a'
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from stripe_webhook import WebhookApp, sign_payload
+
+SECRET = 'whsec_test_secret'
+
+
+@pytest.fixture
+def app(db):
+    return WebhookApp(db=db, secret=SECRET, tolerance=300)
+
+
+@pytest.fixture
+def alice(db):
+    db.add_user('alice', 'alice@example.com', 'password123', 'Alice')
+    return 'alice'
+
+
+def deliver(app, event, secret=SECRET):
+    payload = json.dumps(event).encode('utf-8')
+    return asyncio.run(app.handle(payload, sign_payload(payload, secret)))
+
+
+def invoice_paid(event_id, subscription_id, period_end, created, username='alice'):
+    return {
+        'id': event_id, 'type': 'invoice.paid', 'created': created,
+        'data': {'object': {
+            'object': 'invoice',
+            'parent': {'subscription_details': {'subscription': subscription_id, 'metadata': {'username': username}}},
+            'lines': {'data': [{'period': {'end': int(period_end.timestamp())}}]},
+        }},
+    }
+
+
+def subscription_event(event_id, event_type, subscription_id, status, period_end, created, username='alice'):
+    return {
+        'id': event_id, 'type': event_type, 'created': created,
+        'data': {'object': {
+            'id': subscription_id, 'object': 'subscription', 'status': status,
+            'metadata': {'username': username},
+            'items': {'data': [{'current_period_end': int(period_end.timestamp())}]},
+        }},
+    }
+
+
+def user(db, username='alice'):
+    db.user_cache.clear()
+    profile = db.get_user(username)
+    expires_at = profile['premium_expires_at']
+    return bool(profile['is_premium']), profile['stripe_subscription_id'], (
+        datetime.fromisoformat(str(expires_at)) if expires_at else None)
+
+
+NOW = datetime.now().replace(microsecond=0)
+
+
+def period(days):
+    return NOW + timedelta(days=days)
+
+
+def test_bad_signature_is_rejected(app, alice, db):
+    event = invoice_paid('evt_1', 'sub_1', period(30), created=100)
+    status, body = deliver(app, event, secret='whsec_someone_else')
+    assert status == 400
+    payload = json.dumps(event).encode('utf-8')
+    stale = sign_payload(payload, SECRET, timestamp=time.time() - 3600)
+    assert asyncio.run(app.handle(payload, stale))[0] == 400
+    assert user(db) == (False, None, None)
+
+
+def test_redelivery_is_a_no_op(app, alice, db):
+    event = invoice_paid('evt_1', 'sub_1', period(30), created=100)
+    assert deliver(app, event) == (200, {'received': True, 'outcome': 'applied'})
+    assert user(db) == (True, 'sub_1', period(30))
+
+    db.update_premium_status('alice', True, period(5).isoformat(), 'sub_1')
+    assert deliver(app, event)[1]['outcome'] == 'duplicate'
+    assert user(db)[2] == period(5)
+
+
+def test_events_arriving_out_of_order(app, alice, db):
+    assert deliver(app, subscription_event('evt_2', 'customer.subscription.updated', 'sub_1', 'active',
+                                           period(60), created=200))[1]['outcome'] == 'applied'
+    # An older invoice delivered late doesn't roll the expiry back
+    assert deliver(app, invoice_paid('evt_1', 'sub_1', period(30), created=100))[1]['outcome'] == 'stale'
+    assert user(db) == (True, 'sub_1', period(60))
+
+    # Nor does a cancellation that happened before the newer update
+    assert deliver(app, subscription_event('evt_0', 'customer.subscription.deleted', 'sub_1', 'canceled',
+                                           period(0), created=50))[1]['outcome'] == 'stale'
+    assert deliver(app, subscription_event('evt_3', 'customer.subscription.deleted', 'sub_1', 'canceled',
+                                           period(0), created=300))[1]['outcome'] == 'applied'
+    assert user(db) == (False, 'CANCELLED', None)
+
+
+def test_invoice_paid_reactivates_a_cancelled_user(app, alice, db):
+    db.update_premium_status('alice', True, period(30).isoformat(), 'sub_old')
+    db.cancel_premium_subscription('alice')
+    assert user(db)[1] == 'CANCELLED'
+
+    status, body = deliver(app, invoice_paid('evt_9', 'sub_new', period(365), created=100))
+
+    assert (status, body['outcome']) == (200, 'applied')
+    assert user(db) == (True, 'sub_new', period(365))
+
+
+def test_unrelated_event_is_recorded_and_ignored(app, alice):
+    event = {'id': 'evt_x', 'type': 'customer.created', 'created': 1, 'data': {'object': {}}}
+    assert deliver(app, event)[1]['outcome'] == 'ignored'
+    assert deliver(app, event)[1]['outcome'] == 'duplicate'
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """Bounded, TTL-limited LRU cache of user records.
+
+    Records are stored once under their username; a secondary index maps
+    email addresses to usernames so both lookups share the same entry.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> (expires_at, user)
+        self._emails = {}  # email -> username
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, username):
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(username)
+            return None
+        self._entries.move_to_end(username)
+        return entry[1]
+
+    def _remove(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._unindex(username, entry[1])
+
+    def _unindex(self, username, user):
+        email = user.get('email')
+        if self._emails.get(email) == username:
+            del self._emails[email]
+
+    def get(self, username):
+        with self._lock:
+            user = self._get(username)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(user)
+
+    def get_by_email(self, email):
+        with self._lock:
+            username = self._emails.get(email)
+            user = self._get(username) if username is not None else None
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(user)
+
+    def put(self, user):
+        with self._lock:
+            username = user['username']
+            self._remove(username)
+            self._entries[username] = (time.monotonic() + self.ttl, dict(user))
+            if user.get('email'):
+                self._emails[user['email']] = username
+            while len(self._entries) > self.max_size:
+                oldest, (_, evicted) = self._entries.popitem(last=False)
+                self._unindex(oldest, evicted)
+
+    def invalidate(self, username=None, email=None):
+        with self._lock:
+            if email is not None and username is None:
+                username = self._emails.pop(email, None)
+            if username is not None:
+                self._remove(username)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._emails.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl
+            }